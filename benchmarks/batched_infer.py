@@ -0,0 +1,81 @@
+"""Compare chunks/sec of Svc.infer_silence with and without batching.
+
+Each batch of speech chunks of similar lengths runs HuBERT and the synthesizer once.
+
+Usage:
+    python benchmarks/batched_infer.py -m logs/44k/G_0.pth -c configs/44k/config.json -i input.wav -bs 1 -bs 4 -bs 8
+"""
+
+from __future__ import annotations
+
+from logging import WARNING, basicConfig, getLogger
+from pathlib import Path
+
+import click
+import librosa
+import numpy as np
+import torch
+from cm_time import timer
+
+import so_vits_svc_fork.f0
+from so_vits_svc_fork.inference.core import Svc, _bucket_by_length, split_silence
+
+
+@click.command()
+@click.option("-m", "--model-path", type=click.Path(exists=True), required=True)
+@click.option("-c", "--config-path", type=click.Path(exists=True), required=True)
+@click.option("-i", "--input-path", type=click.Path(exists=True), required=True)
+@click.option("-s", "--speaker", type=str, default=None)
+@click.option("-bs", "--batch-size", type=int, multiple=True, default=[1, 4, 8])
+@click.option("-mc", "--max-chunk-seconds", type=float, default=10)
+@click.option("-d", "--device", type=str, default="cpu")
+def main(
+    model_path: Path,
+    config_path: Path,
+    input_path: Path,
+    speaker: str | None,
+    batch_size: list[int],
+    max_chunk_seconds: float,
+    device: str,
+) -> None:
+    basicConfig(level=WARNING)
+    getLogger("so_vits_svc_fork").setLevel(WARNING)
+    svc = Svc(net_g_path=str(model_path), config_path=str(config_path), device=device)
+    if speaker is None:
+        speaker = next(iter(svc.spk2id.__dict__))
+    audio, _ = librosa.load(str(input_path), sr=svc.target_sample)
+    audio = audio.astype(np.float32)
+    kwargs = dict(
+        speaker=speaker,
+        db_thresh=-40,
+        max_chunk_seconds=max_chunk_seconds,
+        auto_predict_f0=False,
+    )
+    chunk_length_min = int(min(svc.target_sample / so_vits_svc_fork.f0.f0_min * 20 + 1, 0.5 * svc.target_sample)) // 2
+    chunks = list(
+        split_silence(
+            audio,
+            top_db=40,
+            frame_length=chunk_length_min * 2,
+            hop_length=chunk_length_min,
+            ref=np.max,
+            max_chunk_length=int(max_chunk_seconds * svc.target_sample),
+        )
+    )
+    # lengths of the chunks padded by pad_seconds=0.5
+    lengths = {i: len(chunk.audio) + svc.target_sample for i, chunk in enumerate(chunks) if chunk.is_speech}
+    n_chunks = len(lengths)
+    print(f"{input_path}: {len(audio) / svc.target_sample:.1f}s, {n_chunks} speech chunks, torch threads: {torch.get_num_threads()}")
+
+    # warmup
+    svc.infer_silence(audio[: svc.target_sample * 2], **kwargs)
+    for bs in batch_size:
+        with timer() as t:
+            out = svc.infer_silence(audio, batch_size=bs, **kwargs)
+        assert len(out) == len(audio)
+        n_batches = len(_bucket_by_length(lengths, bs))
+        print(f"batch_size={bs:3d}: {n_batches:4d} batches, {t.elapsed:7.2f}s, {n_chunks / t.elapsed:7.2f} chunks/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Compare the vectorized interpolate_f0 with the original loop on long f0 tracks.
+
+Usage (from the repository root):
+    python benchmarks/interpolate_f0.py -m 10
+"""
+
+from __future__ import annotations
+
+import click
+import numpy as np
+from cm_time import timer
+
+from so_vits_svc_fork.f0 import interpolate_f0
+from tests.test_f0 import interpolate_f0_reference, random_f0
+
+
+@click.command()
+@click.option("-m", "--minutes", type=float, default=10)
+@click.option("-sr", "--sampling-rate", type=int, default=44100)
+@click.option("-hl", "--hop-length", type=int, default=512)
+def main(minutes: float, sampling_rate: int, hop_length: int) -> None:
+    rng = np.random.default_rng(0)
+    n_frames = int(minutes * 60 * sampling_rate / hop_length)
+    tracks = {
+        "mixed": random_f0(rng, n_frames, np.float64),
+        "long unvoiced runs": np.where(np.arange(n_frames) % 2000 < 10, 200.0, 0.0),
+    }
+    for name, f0 in tracks.items():
+        with timer() as t_ref:
+            expected = interpolate_f0_reference(f0)
+        with timer() as t:
+            actual = interpolate_f0(f0)
+        np.testing.assert_array_equal(actual[0], expected[0])
+        print(f"{name:>20} ({n_frames} frames): loop {t_ref.elapsed:8.3f}s, vectorized {t.elapsed:8.4f}s, x{t_ref.elapsed / t.elapsed:.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Measure the per-step cost of building the DSP modules of MB-iSTFT-VITS, which are now built once.
+
+Inference: TorchSTFT and PQMF were built in every forward of Multiband_iSTFT_Generator.
+Training: PQMF and MultiResolutionSTFTLoss were built in every training step.
+Both are compared to the step with the modules built once.
+
+Usage (from the repository root):
+    python benchmarks/mb_istft_dsp.py -t 32 -b 4
+"""
+
+from __future__ import annotations
+
+import json
+import warnings
+from logging import WARNING, getLogger
+from pathlib import Path
+from types import SimpleNamespace
+
+import click
+import torch
+from cm_time import timer
+
+from so_vits_svc_fork import utils
+from so_vits_svc_fork.modules.decoders.mb_istft import PQMF, get_subband_stft_loss, subband_stft_loss
+from so_vits_svc_fork.modules.decoders.mb_istft._stft import TorchSTFT
+from so_vits_svc_fork.modules.synthesizers import SynthesizerTrn
+
+CONFIG_TEMPLATES = Path(__file__).parents[1] / "src/so_vits_svc_fork/preprocessing/config_templates"
+
+
+def _time(f, repeat: int) -> float:
+    f()
+    with timer() as t:
+        for _ in range(repeat):
+            f()
+    return t.elapsed / repeat * 1e3
+
+
+@click.command()
+@click.option("-t", "--block-frames", type=int, default=32)
+@click.option("-b", "--batch-size", type=int, default=4)
+@click.option("-r", "--repeat", type=int, default=20)
+@click.option("-d", "--device", type=str, default="cpu")
+def main(block_frames: int, batch_size: int, repeat: int, device: str) -> None:
+    getLogger("so_vits_svc_fork").setLevel(WARNING)
+    config = json.loads((CONFIG_TEMPLATES / "quickvc.json").read_text())
+    model_config = {**config["model"], "type_": "mb-istft", "n_speakers": 2}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        net_g = SynthesizerTrn(
+            config["data"]["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // config["data"]["hop_length"],
+            **model_config,
+        ).eval()
+    for m in net_g.modules():
+        utils.remove_weight_norm_if_exists(m)
+    net_g.to(device)
+    dec = net_g.dec
+
+    def build_inference_modules() -> None:
+        TorchSTFT(filter_length=dec.gen_istft_n_fft, hop_length=dec.gen_istft_hop_size, win_length=dec.gen_istft_n_fft).to(device)
+        PQMF(device, subbands=dec.subbands).to(device)
+
+    z = torch.randn(1, model_config["inter_channels"], block_frames, device=device)
+    with torch.no_grad():
+        build = _time(build_inference_modules, repeat)
+        forward = _time(lambda: dec(z), repeat)
+    print(f"inference ({block_frames} frames): forward {forward:8.3f} ms, building TorchSTFT + PQMF {build:8.3f} ms saved per call")
+
+    h = SimpleNamespace(train=SimpleNamespace(**config["train"]))
+    segment_size = config["train"]["segment_size"]
+    y = torch.randn(batch_size, 1, segment_size, device=device)
+    y_hat_mb = torch.randn(batch_size, dec.subbands, segment_size // dec.subbands, device=device, requires_grad=True)
+    pqmf = PQMF(device, subbands=dec.subbands)
+    stft_loss = get_subband_stft_loss(h).to(device)
+
+    def build_training_modules() -> None:
+        PQMF(device, subbands=dec.subbands)
+        get_subband_stft_loss(h).to(device)
+
+    def loss() -> None:
+        subband_stft_loss(h, pqmf.analysis(y), y_hat_mb, stft_loss).backward()
+
+    build = _time(build_training_modules, repeat)
+    step = _time(loss, repeat)
+    print(f"training (batch {batch_size}): subband loss {step:8.3f} ms, building PQMF + MultiResolutionSTFTLoss {build:8.3f} ms saved per step")
+
+
+if __name__ == "__main__":
+    main()
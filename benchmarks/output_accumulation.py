@@ -0,0 +1,74 @@
+"""Show that the per-chunk cost of assembling output audio stays flat as the input grows.
+
+The model is replaced by an identity function so that only the bookkeeping
+around it is measured (silence splitting included).
+
+Usage:
+    python benchmarks/output_accumulation.py -s 60 -s 600 -s 3600
+"""
+
+from __future__ import annotations
+
+from logging import WARNING, basicConfig, getLogger
+from typing import Any
+
+import click
+import numpy as np
+import torch
+from cm_time import timer
+
+from so_vits_svc_fork.inference.core import RealtimeVC2, Svc
+
+
+class _IdentitySvc(Svc):
+    def __init__(self, target_sample: int) -> None:
+        self.target_sample = target_sample
+
+    def infer(self, *, audio: np.ndarray, **kwargs: Any) -> tuple[torch.Tensor, int]:
+        return torch.from_numpy(audio.copy()), len(audio)
+
+    def _infer_chunks_padded(self, speaker: Any, transpose: int, chunks: Any, pad_len: int, batch_size: int, **kwargs: Any):
+        return {i: chunk.audio for i, chunk in enumerate(chunks) if chunk.is_speech}
+
+
+def _make_audio(seconds: float, sr: int, rng: np.random.Generator) -> np.ndarray:
+    """Alternating ~1s phrases and ~0.3s pauses."""
+    audio = np.zeros(int(seconds * sr), dtype=np.float32)
+    pos = 0
+    while pos < len(audio):
+        phrase = int(rng.uniform(0.5, 1.5) * sr)
+        audio[pos : pos + phrase] = rng.uniform(-0.5, 0.5, size=len(audio[pos : pos + phrase]))
+        pos += phrase + int(rng.uniform(0.2, 0.4) * sr)
+    return audio
+
+
+@click.command()
+@click.option("-s", "--seconds", type=float, multiple=True, default=[60, 600, 1800])
+@click.option("-sr", "--sampling-rate", type=int, default=44100)
+@click.option("-b", "--block-seconds", type=float, default=0.5)
+def main(seconds: list[float], sampling_rate: int, block_seconds: float) -> None:
+    basicConfig(level=WARNING)
+    getLogger("so_vits_svc_fork").setLevel(WARNING)
+    rng = np.random.default_rng(0)
+    svc = _IdentitySvc(target_sample=sampling_rate)
+    for seconds_ in seconds:
+        audio = _make_audio(seconds_, sampling_rate, rng)
+
+        # infer_silence
+        n_chunks = len(svc._split_silence(audio, -40, 0.5, False, 40))
+        with timer() as t:
+            svc.infer_silence(audio, speaker=0)
+        print(f"{seconds_:7.0f}s infer_silence: {n_chunks:6d} chunks, {t.elapsed / n_chunks * 1e3:8.2f} ms/chunk")
+
+        # RealtimeVC2 session
+        model = RealtimeVC2(svc)
+        block = int(block_seconds * sampling_rate)
+        n_blocks = len(audio) // block
+        with timer() as t:
+            for i in range(n_blocks):
+                model.process(audio[i * block : (i + 1) * block], speaker=0, transpose=0)
+        print(f"{seconds_:7.0f}s RealtimeVC2  : {n_blocks:6d} blocks, {t.elapsed / n_blocks * 1e3:8.2f} ms/block")
+
+
+if __name__ == "__main__":
+    main()
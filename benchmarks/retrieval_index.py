@@ -0,0 +1,60 @@
+"""Measure the query latency of the retrieval index against an exhaustive search.
+
+Queries are blocks of consecutive frames of a random walk between training frames,
+as in a realtime block of content frames.
+
+Usage (from the repository root):
+    python benchmarks/retrieval_index.py -n 500000 -t 100
+"""
+
+from __future__ import annotations
+
+from logging import WARNING, getLogger
+
+import click
+import numpy as np
+import torch
+from cm_time import timer
+
+from so_vits_svc_fork.cluster.retrieval import IVFIndex, build_ivf_index
+
+
+@click.command()
+@click.option("-n", "--n-frames", type=int, default=500_000)
+@click.option("-f", "--n-features", type=int, default=256)
+@click.option("-t", "--block-frames", type=int, default=100)
+@click.option("-k", "--top-k", type=int, default=4)
+@click.option("-p", "--n-probe", type=int, multiple=True, default=[1, 4, 8, 16])
+@click.option("-r", "--repeat", type=int, default=20)
+def main(n_frames: int, n_features: int, block_frames: int, top_k: int, n_probe: list[int], repeat: int) -> None:
+    getLogger("so_vits_svc_fork").setLevel(WARNING)
+    rng = np.random.default_rng(0)
+    blobs = rng.normal(scale=3, size=(n_frames // 200, n_features)).astype(np.float32)
+    features = blobs[rng.integers(0, len(blobs), n_frames)] + rng.normal(size=(n_frames, n_features)).astype(np.float32)
+    with timer() as t:
+        arrays = build_ivf_index(features, half=True)
+    print(f"build: {t.elapsed:.1f}s, {len(arrays['centroids'])} lists")
+    index = IVFIndex(**arrays)
+    vectors = index.vectors.float()
+
+    # interpolations between a few random training frames
+    queries = []
+    for _ in range(repeat):
+        ends = torch.from_numpy(features[rng.integers(0, n_frames, 2)])
+        weights = torch.linspace(0, 1, block_frames)[:, None]
+        queries.append((1 - weights) * ends[0] + weights * ends[1] + torch.randn(block_frames, n_features) * 0.5)
+
+    with timer() as t:
+        expected = [(index.sq_norms - 2 * (query @ vectors.T)).topk(top_k, dim=1, largest=False).indices for query in queries]
+    print(f"exhaustive: {t.elapsed / repeat * 1e3:8.2f} ms/block")
+    for n_probe_ in n_probe:
+        index.n_probe = n_probe_
+        index.search(queries[0], top_k)
+        with timer() as t:
+            results = [index.search(query, top_k)[1] for query in queries]
+        recall = np.mean([np.isin(e.numpy(), r.numpy()).mean() for e, r in zip(expected, results)])
+        print(f"n_probe={n_probe_:3d}: {t.elapsed / repeat * 1e3:8.2f} ms/block, recall@{top_k}: {recall:.3f}")
+
+
+if __name__ == "__main__":
+    main()
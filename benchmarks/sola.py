@@ -0,0 +1,58 @@
+"""Measure get_sola_shift (direct convolution for small sizes, FFT otherwise) against direct convolution.
+
+crossfade_len and sola_search_len are those of realtime inference at 44.1 kHz and 48 kHz
+(crossfade of 0.01-0.05 s, the default search of 384 samples and longer ones).
+
+Usage (from the repository root):
+    python benchmarks/sola.py -d cpu
+"""
+
+from __future__ import annotations
+
+import click
+import numpy as np
+import torch
+from cm_time import timer
+
+from so_vits_svc_fork.inference.core import _sola_scores_direct, get_sola_shift
+
+
+@click.command()
+@click.option("-d", "--device", type=str, multiple=True, default=["cpu"])
+@click.option("-r", "--repeat", type=int, default=50)
+def main(device: list[str], repeat: int) -> None:
+    rng = np.random.default_rng(0)
+    print(f"{'sr':>6} {'crossfade':>9} {'search':>6} {'direct':>10} {'numpy':>10} " + " ".join(f"{d:>10}" for d in device))
+    for sr in [44100, 48000]:
+        for crossfade_seconds in [0.01, 0.02, 0.05]:
+            for sola_search_len in [384, 1024, 2048]:
+                crossfade_len = int(sr * crossfade_seconds)
+                t = np.arange(sola_search_len + 2 * crossfade_len)
+                signal = (np.sin(t * 2 * np.pi * 220 / sr) + rng.normal(scale=0.1, size=len(t))).astype(np.float32)
+                first_tail = signal[:crossfade_len]
+                second_window = signal[crossfade_len // 2 :][: sola_search_len + crossfade_len]
+                expected = int(np.argmax(_sola_scores_direct(first_tail, second_window)))
+
+                with timer() as t_direct:
+                    for _ in range(repeat):
+                        _sola_scores_direct(first_tail, second_window).argmax()
+                with timer() as t_fft:
+                    for _ in range(repeat):
+                        assert get_sola_shift(first_tail, second_window) == expected
+                times = []
+                for d in device:
+                    # including the copies from and to the device, as in sola_crossfade
+                    get_sola_shift(torch.from_numpy(first_tail).to(d), torch.from_numpy(second_window).to(d))
+                    with timer() as t_torch:
+                        for _ in range(repeat):
+                            shift = get_sola_shift(torch.from_numpy(first_tail).to(d), torch.from_numpy(second_window).to(d))
+                            assert shift == expected
+                    times.append(t_torch.elapsed)
+                print(
+                    f"{sr:6d} {crossfade_len:9d} {sola_search_len:6d} "
+                    + " ".join(f"{elapsed / repeat * 1e3:8.3f}ms" for elapsed in [t_direct.elapsed, t_fft.elapsed, *times])
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Measure SynthesizerTrn.infer on short blocks with and without a cached speaker conditioning.
+
+The model has the architecture of the config template with random weights.
+
+Usage (from the repository root):
+    python benchmarks/speaker_conditioning.py -t 8 -t 16 -t 32
+"""
+
+from __future__ import annotations
+
+import json
+import warnings
+from logging import WARNING, getLogger
+from pathlib import Path
+
+import click
+import torch
+from cm_time import timer
+
+from so_vits_svc_fork import utils
+from so_vits_svc_fork.modules.synthesizers import SynthesizerTrn
+
+CONFIG_TEMPLATES = Path(__file__).parents[1] / "src/so_vits_svc_fork/preprocessing/config_templates"
+
+
+@click.command()
+@click.option("-c", "--config-template", type=str, default="so-vits-svc-4.0v1.json")
+@click.option("-t", "--block-frames", type=int, multiple=True, default=[8, 16, 32])
+@click.option("-p", "--predict-f0", is_flag=True)
+@click.option("-r", "--repeat", type=int, default=50)
+@click.option("-d", "--device", type=str, default="cpu")
+def main(config_template: str, block_frames: list[int], predict_f0: bool, repeat: int, device: str) -> None:
+    getLogger("so_vits_svc_fork").setLevel(WARNING)
+    config = json.loads((CONFIG_TEMPLATES / config_template).read_text())
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        net_g = SynthesizerTrn(
+            config["data"]["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // config["data"]["hop_length"],
+            **{**config["model"], "n_speakers": 2},
+        ).eval()
+    for m in net_g.modules():
+        utils.remove_weight_norm_if_exists(m)
+    net_g.to(device)
+    sid = torch.LongTensor([[1]]).to(device)
+
+    with torch.no_grad():
+        cond = net_g.get_speaker_conditioning(sid)
+        with timer() as t:
+            for _ in range(repeat):
+                net_g.get_speaker_conditioning(sid)
+        print(f"conditioning: {t.elapsed / repeat * 1e3:8.3f} ms")
+        for n_frames in block_frames:
+            c = torch.randn(1, config["model"]["ssl_dim"], n_frames, device=device)
+            f0 = torch.full((1, n_frames), 220.0, device=device)
+            uv = torch.ones(1, n_frames, device=device)
+            times = {}
+            for name, kwargs in [("uncached", {"g": sid}), ("cached", {"cond": cond})]:
+                net_g.infer(c, f0, uv, predict_f0=predict_f0, **kwargs)
+                with timer() as t:
+                    for _ in range(repeat):
+                        net_g.infer(c, f0, uv, predict_f0=predict_f0, **kwargs)
+                times[name] = t.elapsed / repeat * 1e3
+            print(
+                f"{n_frames:4d} frames: uncached {times['uncached']:8.3f} ms/block, cached {times['cached']:8.3f} ms/block "
+                f"({times['uncached'] / times['cached']:.2f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Compare the sklearn and torch minibatch k-means trainers on synthetic features.
+
+The features are gaussian blobs written to a memory-mapped file,
+as train_cluster reads them from its feature store.
+
+Usage:
+    python benchmarks/train_cluster.py -n 1000000 -f 256 -k 10000
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+import numpy as np
+import torch
+from cm_time import timer
+from sklearn.cluster import MiniBatchKMeans
+
+from so_vits_svc_fork.cluster import ClusterCenters
+from so_vits_svc_fork.cluster.torch_kmeans import TorchMiniBatchKMeans
+
+
+def _make_features(path: Path, n_samples: int, n_features: int, n_blobs: int, rng: np.random.Generator) -> np.memmap:
+    blobs = rng.normal(scale=3, size=(n_blobs, n_features)).astype(np.float32)
+    features = np.memmap(path, dtype=np.float32, mode="w+", shape=(n_samples, n_features))
+    for start in range(0, n_samples, 65536):
+        end = min(start + 65536, n_samples)
+        features[start:end] = blobs[rng.integers(0, n_blobs, end - start)] + rng.normal(size=(end - start, n_features))
+    features.flush()
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(n_samples, n_features))
+
+
+@click.command()
+@click.option("-n", "--n-samples", type=int, default=1_000_000)
+@click.option("-f", "--n-features", type=int, default=256)
+@click.option("-k", "--n-clusters", type=int, default=10000)
+@click.option("-b", "--batch-size", type=int, default=4096)
+@click.option("-d", "--device", type=str, default="cpu")
+def main(n_samples: int, n_features: int, n_clusters: int, batch_size: int, device: str) -> None:
+    rng = np.random.default_rng(0)
+    with TemporaryDirectory() as tempdir:
+        features = _make_features(Path(tempdir) / "features.f32", n_samples, n_features, n_clusters * 2, rng)
+        sample = torch.from_numpy(np.asarray(features[np.sort(rng.choice(n_samples, 20000, replace=False))]))
+        print(f"{n_samples}x{n_features} features, {n_clusters} clusters, batch size {batch_size}, {torch.get_num_threads()} threads")
+        trainers = {
+            "sklearn": lambda: MiniBatchKMeans(
+                n_clusters=n_clusters, batch_size=batch_size, max_iter=80, n_init="auto", compute_labels=False, random_state=0
+            ),
+            "torch": lambda: TorchMiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, max_iter=80, random_state=0, device=device),
+        }
+        for name, trainer in trainers.items():
+            with timer() as t:
+                kmeans = trainer().fit(features)
+            distances, _ = ClusterCenters(kmeans.cluster_centers_).kneighbors(sample)
+            n_steps = getattr(kmeans, "n_steps_", None)
+            print(f"{name:>8}: {t.elapsed:8.1f}s, {n_steps} steps, inertia per sample on 20000 samples: {float(distances.mean()):.2f}")
+
+
+if __name__ == "__main__":
+    main()
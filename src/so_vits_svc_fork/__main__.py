@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import os
+from collections.abc import Sequence
+from itertools import product
 from logging import getLogger
 from multiprocessing import freeze_support
 from pathlib import Path
@@ -224,6 +226,80 @@ def gui():
     default=40,
     help="maximum allowed single chunk length, set lower if you get out of memory (0 to disable)",
 )
+@click.option(
+    "-bs",
+    "--batch-size",
+    type=int,
+    default=None,
+    help="number of speech chunks of similar length (or of --sweep combinations) converted at once, set lower if you get out of memory "
+    "(default: 1, or all combinations of --sweep)",
+)
+@click.option(
+    "-wf/-nwf",
+    "--whole-file-features/--no-whole-file-features",
+    type=bool,
+    default=False,
+    help="compute HuBERT and f0 once over the whole file and slice them per chunk instead of per padded chunk",
+)
+@click.option(
+    "-fe/-nfe",
+    "--feature-cache/--no-feature-cache",
+    type=bool,
+    default=False,
+    help="cache HuBERT and f0 features in memory, so that inputs with the same audio are faster (implied by --feature-cache-dir)",
+)
+@click.option(
+    "-fc",
+    "--feature-cache-dir",
+    type=click.Path(),
+    default=None,
+    help="directory to cache HuBERT and f0 features in, so that re-rendering the same input is faster",
+)
+@click.option(
+    "-sw",
+    "--sweep",
+    type=str,
+    multiple=True,
+    help="render every combination of SPEAKERS:TRANSPOSES[:NOISE_SCALES] (comma separated lists, e.g. 'alice,bob:-12,0,12') to separate files, features are extracted only once",
+)
+@click.option(
+    "-fj",
+    "--f0-n-jobs",
+    type=int,
+    default=1,
+    help="number of processes to compute f0 of long audio in segments with (dio, harvest and parselmouth only, -1 to use all cores)",
+)
+@click.option(
+    "-cw",
+    "--content-window-seconds",
+    type=float,
+    default=None,
+    help="run HuBERT on overlapping windows of this length (e.g. 20) to bound memory on long audio (default: disabled)",
+)
+@click.option(
+    "-co",
+    "--content-overlap-seconds",
+    type=float,
+    default=3,
+    help="overlap between HuBERT windows",
+)
+@click.option(
+    "-ck",
+    "--cluster-top-k",
+    type=int,
+    default=1,
+    help="average the k nearest cluster centers weighted by inverse distance",
+)
+@click.option(
+    "-ri",
+    "--retrieval-index-path",
+    type=click.Path(exists=True),
+    default=None,
+    help="path to retrieval index (built by `svc train-index`)",
+)
+@click.option("-rr", "--retrieval-ratio", type=float, default=0, help="ratio of the content replaced by the nearest training frames")
+@click.option("-rk", "--retrieval-top-k", type=int, default=4, help="number of nearest training frames averaged")
+@click.option("-rp", "--retrieval-n-probe", type=int, default=8, help="number of inverted lists searched per frame")
 def infer(
     # paths
     input_path: Path,
@@ -245,6 +321,19 @@ def infer(
     chunk_seconds: float = 0.5,
     absolute_thresh: bool = False,
     max_chunk_seconds: float = 40,
+    batch_size: int | None = None,
+    whole_file_features: bool = False,
+    feature_cache: bool = False,
+    feature_cache_dir: Path | None = None,
+    sweep: Sequence[str] = (),
+    f0_n_jobs: int = 1,
+    content_window_seconds: float | None = None,
+    content_overlap_seconds: float = 3,
+    cluster_top_k: int = 1,
+    retrieval_index_path: Path | None = None,
+    retrieval_ratio: float = 0,
+    retrieval_top_k: int = 4,
+    retrieval_n_probe: int = 8,
     device: str | torch.device = get_optimal_device(),
 ):
     """Inference"""
@@ -269,6 +358,7 @@ def infer(
     config_path = Path(config_path)
     if cluster_model_path is not None:
         cluster_model_path = Path(cluster_model_path)
+    sweep_combinations = [combination for sweep_ in sweep for combination in _parse_sweep(sweep_, noise_scale)]
     infer(
         # paths
         input_path=input_path,
@@ -290,10 +380,33 @@ def infer(
         chunk_seconds=chunk_seconds,
         absolute_thresh=absolute_thresh,
         max_chunk_seconds=max_chunk_seconds,
+        batch_size=batch_size,
+        whole_file_features=whole_file_features,
+        feature_cache=feature_cache,
+        feature_cache_dir=feature_cache_dir,
+        sweep=sweep_combinations,
+        f0_n_jobs=f0_n_jobs,
+        content_window_seconds=content_window_seconds,
+        content_overlap_seconds=content_overlap_seconds,
+        cluster_top_k=cluster_top_k,
+        retrieval_index_path=retrieval_index_path,
+        retrieval_ratio=retrieval_ratio,
+        retrieval_top_k=retrieval_top_k,
+        retrieval_n_probe=retrieval_n_probe,
         device=device,
     )
 
 
+def _parse_sweep(sweep: str, default_noise_scale: float) -> list[tuple[str, int, float]]:
+    parts = sweep.split(":")
+    if len(parts) not in (2, 3):
+        raise click.BadParameter(f"Expected SPEAKERS:TRANSPOSES[:NOISE_SCALES], got {sweep}")
+    speakers = parts[0].split(",")
+    transposes = [int(t) for t in parts[1].split(",")]
+    noise_scales = [float(n) for n in parts[2].split(",")] if len(parts) == 3 else [default_noise_scale]
+    return list(product(speakers, transposes, noise_scales))
+
+
 @cli.command()
 @click.option(
     "-m",
@@ -366,7 +479,7 @@ def infer(
     help="device",
 )
 @click.option("-s", "--speaker", type=str, default=None, help="speaker name")
-@click.option("-v", "--version", type=int, default=2, help="version")
+@click.option("-v", "--version", type=int, default=2, help="version (3: streaming decoder, hifi-gan only)")
 @click.option("-i", "--input-device", type=int, default=None, help="input device")
 @click.option("-o", "--output-device", type=int, default=None, help="output device")
 @click.option(
@@ -377,6 +490,38 @@ def infer(
     is_flag=True,
     help="passthrough original (for latency check)",
 )
+@click.option(
+    "-mq",
+    "--max-queue-blocks",
+    type=int,
+    default=2,
+    help="blocks waiting for inference before the oldest ones are skipped",
+)
+@click.option(
+    "-fb",
+    "--fallback",
+    type=click.Choice(["silence", "passthrough"]),
+    default="silence",
+    help="output when the converted audio is not ready in time",
+)
+@click.option(
+    "-ri",
+    "--retrieval-index-path",
+    type=click.Path(exists=True),
+    default=None,
+    help="path to retrieval index (built by `svc train-index`)",
+)
+@click.option("-rr", "--retrieval-ratio", type=float, default=0, help="ratio of the content replaced by the nearest training frames")
+@click.option("-rk", "--retrieval-top-k", type=int, default=4, help="number of nearest training frames averaged")
+@click.option("-rp", "--retrieval-n-probe", type=int, default=8, help="number of inverted lists searched per frame")
+@click.option(
+    "-ic",
+    "--incremental",
+    type=bool,
+    default=False,
+    is_flag=True,
+    help="keep the content and f0 frames of the audio inferred again from the previous block (version 1 only)",
+)
 def vc(
     # paths
     model_path: Path,
@@ -403,6 +548,13 @@ def vc(
     output_device: int | str | None,
     device: torch.device,
     passthrough_original: bool = False,
+    retrieval_index_path: Path | None = None,
+    retrieval_ratio: float = 0,
+    retrieval_top_k: int = 4,
+    retrieval_n_probe: int = 8,
+    max_queue_blocks: int = 2,
+    fallback: Literal["silence", "passthrough"] = "silence",
+    incremental: bool = False,
 ) -> None:
     """Realtime inference from microphone"""
     from so_vits_svc_fork.inference.main import realtime
@@ -438,6 +590,11 @@ def vc(
         db_thresh=db_thresh,
         pad_seconds=pad_seconds,
         chunk_seconds=chunk_seconds,
+        # retrieval config
+        retrieval_index_path=retrieval_index_path,
+        retrieval_ratio=retrieval_ratio,
+        retrieval_top_k=retrieval_top_k,
+        retrieval_n_probe=retrieval_n_probe,
         # realtime config
         crossfade_seconds=crossfade_seconds,
         additional_infer_before_seconds=additional_infer_before_seconds,
@@ -448,6 +605,168 @@ def vc(
         output_device=output_device,
         device=device,
         passthrough_original=passthrough_original,
+        max_queue_blocks=max_queue_blocks,
+        fallback=fallback,
+        incremental=incremental,
+    )
+
+
+@cli.command()
+@click.argument(
+    "input-path",
+    type=click.Path(exists=True),
+)
+@click.option(
+    "-o",
+    "--output-path",
+    type=click.Path(),
+    default=None,
+    help="path to output file (default: {input}.sim{suffix})",
+)
+@click.option("-rj", "--report-path", type=click.Path(), default=None, help="path to write the json report to")
+@click.option(
+    "-m",
+    "--model-path",
+    type=click.Path(exists=True),
+    default=Path("./logs/44k/"),
+    help="path to model",
+)
+@click.option(
+    "-c",
+    "--config-path",
+    type=click.Path(exists=True),
+    default=Path("./configs/44k/config.json"),
+    help="path to config",
+)
+@click.option(
+    "-k",
+    "--cluster-model-path",
+    type=click.Path(exists=True),
+    default=None,
+    help="path to cluster model",
+)
+@click.option("-t", "--transpose", type=int, default=12, help="transpose")
+@click.option(
+    "-a/-na",
+    "--auto-predict-f0/--no-auto-predict-f0",
+    type=bool,
+    default=True,
+    help="auto predict f0",
+)
+@click.option("-r", "--cluster-infer-ratio", type=float, default=0, help="cluster infer ratio")
+@click.option("-n", "--noise-scale", type=float, default=0.4, help="noise scale")
+@click.option("-db", "--db-thresh", type=int, default=-30, help="threshold (DB) (ABSOLUTE)")
+@click.option(
+    "-fm",
+    "--f0-method",
+    type=click.Choice(["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"]),
+    default="dio",
+    help="f0 prediction method",
+)
+@click.option("-p", "--pad-seconds", type=float, default=0.02, help="pad seconds")
+@click.option("-ch", "--chunk-seconds", type=float, default=0.5, help="chunk seconds")
+@click.option("-cr", "--crossfade-seconds", type=float, default=0.01, help="crossfade seconds")
+@click.option("-ab", "--additional-infer-before-seconds", type=float, default=0.2, help="additional infer before seconds")
+@click.option("-aa", "--additional-infer-after-seconds", type=float, default=0.1, help="additional infer after seconds")
+@click.option("-b", "--block-seconds", type=float, default=0.5, help="block seconds")
+@click.option("-d", "--device", type=str, default=get_optimal_device(), help="device")
+@click.option("-s", "--speaker", type=str, default=None, help="speaker name")
+@click.option("-v", "--version", type=int, default=2, help="version (3: streaming decoder, hifi-gan only)")
+@click.option("-mq", "--max-queue-blocks", type=int, default=2, help="blocks waiting for inference before the oldest ones are skipped")
+@click.option(
+    "-fb",
+    "--fallback",
+    type=click.Choice(["silence", "passthrough"]),
+    default="silence",
+    help="output when the converted audio is not ready in time",
+)
+@click.option("-ri", "--retrieval-index-path", type=click.Path(exists=True), default=None, help="path to retrieval index")
+@click.option("-rr", "--retrieval-ratio", type=float, default=0, help="ratio of the content replaced by the nearest training frames")
+@click.option("-rk", "--retrieval-top-k", type=int, default=4, help="number of nearest training frames averaged")
+@click.option("-rp", "--retrieval-n-probe", type=int, default=8, help="number of inverted lists searched per frame")
+@click.option(
+    "-ic",
+    "--incremental",
+    type=bool,
+    default=False,
+    is_flag=True,
+    help="keep the content and f0 frames of the audio inferred again from the previous block (version 1 only)",
+)
+def vc_sim(
+    input_path: Path,
+    output_path: Path | None,
+    report_path: Path | None,
+    model_path: Path,
+    config_path: Path,
+    cluster_model_path: Path | None,
+    transpose: int,
+    auto_predict_f0: bool,
+    cluster_infer_ratio: float,
+    noise_scale: float,
+    db_thresh: int,
+    f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    pad_seconds: float,
+    chunk_seconds: float,
+    crossfade_seconds: float,
+    additional_infer_before_seconds: float,
+    additional_infer_after_seconds: float,
+    block_seconds: float,
+    device: str,
+    speaker: str,
+    version: int,
+    max_queue_blocks: int,
+    fallback: Literal["silence", "passthrough"],
+    retrieval_index_path: Path | None,
+    retrieval_ratio: float,
+    retrieval_top_k: int,
+    retrieval_n_probe: int,
+    incremental: bool,
+) -> None:
+    """Replay an audio file through realtime inference on a simulated clock and report block timings and latency"""
+    from so_vits_svc_fork.inference.main import simulate_realtime
+
+    input_path = Path(input_path)
+    if output_path is None:
+        output_path = input_path.parent / f"{input_path.stem}.sim{input_path.suffix}"
+    model_path = Path(model_path)
+    if model_path.is_dir():
+        model_path = sorted(model_path.glob("G_*.pth"), key=lambda x: x.stat().st_mtime)[-1]
+        LOG.info(f"Since model_path is a directory, use {model_path}")
+
+    simulate_realtime(
+        # paths
+        input_path=input_path,
+        output_path=output_path,
+        model_path=model_path,
+        config_path=config_path,
+        report_path=report_path,
+        # svc config
+        speaker=speaker,
+        cluster_model_path=cluster_model_path,
+        transpose=transpose,
+        auto_predict_f0=auto_predict_f0,
+        cluster_infer_ratio=cluster_infer_ratio,
+        noise_scale=noise_scale,
+        f0_method=f0_method,
+        # slice config
+        db_thresh=db_thresh,
+        pad_seconds=pad_seconds,
+        chunk_seconds=chunk_seconds,
+        # retrieval config
+        retrieval_index_path=retrieval_index_path,
+        retrieval_ratio=retrieval_ratio,
+        retrieval_top_k=retrieval_top_k,
+        retrieval_n_probe=retrieval_n_probe,
+        # realtime config
+        crossfade_seconds=crossfade_seconds,
+        additional_infer_before_seconds=additional_infer_before_seconds,
+        additional_infer_after_seconds=additional_infer_after_seconds,
+        block_seconds=block_seconds,
+        version=version,
+        device=device,
+        max_queue_blocks=max_queue_blocks,
+        fallback=fallback,
+        incremental=incremental,
     )
 
 
@@ -591,12 +910,20 @@ def pre_config(
     type=click.Choice(["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"]),
     default="dio",
 )
+@click.option(
+    "-fj",
+    "--f0-n-jobs",
+    type=int,
+    default=1,
+    help="number of processes to compute f0 of long audio in segments with (dio, harvest and parselmouth only, -1 to use all cores)",
+)
 def pre_hubert(
     input_dir: Path,
     config_path: Path,
     n_jobs: bool,
     force_rebuild: bool,
     f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    f0_n_jobs: int = 1,
 ) -> None:
     """
     Preprocessing part 3: hubert
@@ -612,6 +939,7 @@ def pre_hubert(
         n_jobs=n_jobs,
         force_rebuild=force_rebuild,
         f0_method=f0_method,
+        f0_n_jobs=f0_n_jobs,
     )
 
 
@@ -821,12 +1149,18 @@ def clean():
     default="cpu",
     help="device to use",
 )
-def onnx(input_path: Path, output_path: Path, config_path: Path, device: torch.device | str) -> None:
-    """Export model to onnx (currently not working)"""
-    raise NotImplementedError("ONNX export is not yet supported")
+@click.option(
+    "-a/-na",
+    "--auto-predict-f0/--no-auto-predict-f0",
+    type=bool,
+    default=True,
+    help="auto predict f0 (fixed at export, must match the option passed to infer)",
+)
+def onnx(input_path: Path, output_path: Path, config_path: Path, device: torch.device | str, auto_predict_f0: bool) -> None:
+    """Export model to onnx, which can be passed to infer as the model path"""
     input_path = Path(input_path)
     if input_path.is_dir():
-        input_path = list(input_path.glob("*.pth"))[0]
+        input_path = sorted(input_path.glob("G_*.pth"), key=lambda x: x.stat().st_mtime)[-1]
     if output_path is None:
         output_path = input_path.with_suffix(".onnx")
     output_path = Path(output_path)
@@ -841,6 +1175,7 @@ def onnx(input_path: Path, output_path: Path, config_path: Path, device: torch.d
         output_path=output_path,
         config_path=config_path,
         device=device_,
+        predict_f0=auto_predict_f0,
     )
 
 
@@ -856,13 +1191,36 @@ def onnx(input_path: Path, output_path: Path, config_path: Path, device: torch.d
     "-o",
     "--output-path",
     type=click.Path(),
-    help="model path to save",
+    help="model path to save (saved in the compact format if it ends with .clusters)",
     default=Path("./logs/44k/kmeans.pt"),
 )
 @click.option("-n", "--n-clusters", type=int, help="number of clusters", default=2000)
 @click.option("-m/-nm", "--minibatch/--no-minibatch", default=True, help="use minibatch k-means")
 @click.option("-b", "--batch-size", type=int, default=4096, help="batch size for minibatch kmeans")
-@click.option("-p/-np", "--partial-fit", default=False, help="use partial fit (only use with -m)")
+@click.option("-p/-np", "--partial-fit", default=False, help="deprecated, minibatch k-means always streams features from disk")
+@click.option(
+    "-sd",
+    "--store-dir",
+    type=click.Path(),
+    default=None,
+    help="directory for the temporary feature store (defaults to each speaker directory)",
+)
+@click.option(
+    "-mb",
+    "--memory-budget",
+    type=float,
+    default=None,
+    help="GB of RAM speakers are trained within at the same time (default: 80% of available memory)",
+)
+@click.option("-j", "--n-jobs", type=int, default=-1, help="maximum number of speakers trained at the same time")
+@click.option(
+    "-tr",
+    "--trainer",
+    type=click.Choice(["sklearn", "torch"]),
+    default="sklearn",
+    help="k-means implementation (torch: k-means++ and minibatch k-means with batched matmuls, requires -m)",
+)
+@click.option("-d", "--device", type=str, default="cpu", help="device for the torch trainer")
 def train_cluster(
     input_dir: Path,
     output_path: Path,
@@ -870,6 +1228,11 @@ def train_cluster(
     minibatch: bool,
     batch_size: int,
     partial_fit: bool,
+    store_dir: Path | None,
+    memory_budget: float | None,
+    n_jobs: int,
+    trainer: Literal["sklearn", "torch"],
+    device: str,
 ) -> None:
     """Train k-means clustering"""
     from .cluster.train_cluster import main
@@ -882,6 +1245,77 @@ def train_cluster(
         use_minibatch=minibatch,
         batch_size=batch_size,
         partial_fit=partial_fit,
+        store_dir=store_dir,
+        memory_budget=int(memory_budget * 1024**3) if memory_budget is not None else None,
+        n_jobs=n_jobs,
+        trainer=trainer,
+        device=device,
+    )
+
+
+@cli.command
+@click.option(
+    "-i",
+    "--input-path",
+    type=click.Path(exists=True),
+    help="pickled cluster model path",
+    default=Path("./logs/44k/kmeans.pt"),
+)
+@click.option(
+    "-o",
+    "--output-path",
+    type=click.Path(),
+    help="compact cluster model path to save",
+    default=None,
+)
+@click.option("-hf/-nhf", "--half/--no-half", default=False, help="store cluster centers in float16")
+def convert_cluster(input_path: Path, output_path: Path | None, half: bool) -> None:
+    """Convert k-means clustering to the compact format, which loads only the speakers used"""
+    from .cluster import CLUSTER_SUFFIX, convert_cluster_model
+
+    input_path = Path(input_path)
+    if output_path is None:
+        output_path = input_path.with_suffix(CLUSTER_SUFFIX)
+    convert_cluster_model(input_path, output_path, half=half)
+
+
+@cli.command
+@click.option(
+    "-i",
+    "--input-dir",
+    type=click.Path(exists=True),
+    help="dataset directory",
+    default=Path("./dataset/44k"),
+)
+@click.option(
+    "-o",
+    "--output-path",
+    type=click.Path(),
+    help="retrieval index path to save",
+    default=Path("./logs/44k/features.index"),
+)
+@click.option("-n", "--n-lists", type=int, default=None, help="number of inverted lists per speaker (default: 4 * sqrt(number of frames))")
+@click.option("-hf/-nhf", "--half/--no-half", default=True, help="store training frames in float16")
+@click.option(
+    "-sd",
+    "--store-dir",
+    type=click.Path(),
+    default=None,
+    help="directory for the temporary feature store (defaults to each speaker directory)",
+)
+@click.option("-d", "--device", type=str, default="cpu", help="device to train the coarse quantizer on")
+def train_index(input_dir: Path, output_path: Path, n_lists: int | None, half: bool, store_dir: Path | None, device: str) -> None:
+    """Build a retrieval index of the training content frames, used with infer -ri"""
+    from .cluster.retrieval import main
+
+    main(
+        input_dir=input_dir,
+        output_path=output_path,
+        n_lists=n_lists,
+        half=half,
+        store_dir=store_dir,
+        device=device,
+        verbose=True,
     )
 
 
@@ -1,23 +1,268 @@
 from __future__ import annotations
 
+import json
+from collections.abc import Iterator, Mapping, Sequence
+from logging import getLogger
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import torch
-from sklearn.cluster import KMeans
+from numpy import ndarray
 
+LOG = getLogger(__name__)
 
-def get_cluster_model(ckpt_path: Path | str):
-    with Path(ckpt_path).open("rb") as f:
-        checkpoint = torch.load(f, map_location="cpu")  # Danger of arbitrary code execution
-    kmeans_dict = {}
-    for spk, ckpt in checkpoint.items():
-        km = KMeans(ckpt["n_features_in_"])
-        km.__dict__["n_features_in_"] = ckpt["n_features_in_"]
-        km.__dict__["_n_threads"] = ckpt["_n_threads"]
-        km.__dict__["cluster_centers_"] = ckpt["cluster_centers_"]
-        kmeans_dict[spk] = km
-    return kmeans_dict
+# compact format (see write_array_file) with the centers of each speaker as an array named after the speaker
+CLUSTER_MAGIC = b"SVCCLUS1"
+CLUSTER_ALIGNMENT = 64
+CLUSTER_SUFFIX = ".clusters"
+
+
+class ClusterCenters:
+    """
+    Cluster centers of a speaker, kept on the device.
+    predict() searches the nearest centers with batched matmuls and gives the
+    same labels as sklearn's KMeans.predict.
+    """
+
+    def __init__(
+        self,
+        cluster_centers: Any,
+        device: torch.device | str | None = None,
+        dtype: torch.dtype = torch.float32,
+        chunk_size: int = 1024,
+    ) -> None:
+        centers = torch.as_tensor(cluster_centers, device=device)
+        # distances are always computed in float32 so that labels do not depend on dtype
+        self._search_centers = centers.float()
+        self._search_sq_norms = (self._search_centers**2).sum(dim=1)
+        self.cluster_centers_ = centers.to(dtype)
+        self.chunk_size = chunk_size
+
+    @property
+    def n_features_in_(self) -> int:
+        return self.cluster_centers_.shape[1]
+
+    @property
+    def n_clusters(self) -> int:
+        return self.cluster_centers_.shape[0]
+
+    def to(self, device: torch.device | str | None = None, dtype: torch.dtype | None = None) -> ClusterCenters:
+        return ClusterCenters(
+            self._search_centers,
+            device=device or self.cluster_centers_.device,
+            dtype=dtype or self.cluster_centers_.dtype,
+            chunk_size=self.chunk_size,
+        )
+
+    def kneighbors(self, x: torch.Tensor, k: int = 1) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        x: [t, n_features]
+        return squared distances: [t, k] (ascending), labels: [t, k]
+        """
+        x = x.to(self._search_centers.device, torch.float32)
+        distances, labels = [], []
+        for x_ in x.split(self.chunk_size):
+            # ||x||^2 does not change the order, add it only to the selected ones
+            scores = self._search_sq_norms - 2 * (x_ @ self._search_centers.T)
+            if k == 1:
+                scores, labels_ = scores.min(dim=1, keepdim=True)
+            else:
+                scores, labels_ = scores.topk(k, dim=1, largest=False)
+            distances.append(scores + (x_**2).sum(dim=1, keepdim=True))
+            labels.append(labels_)
+        if not labels:
+            return x.new_empty(0, k), torch.empty(0, k, dtype=torch.long, device=x.device)
+        return torch.cat(distances), torch.cat(labels)
+
+    def predict(self, x: torch.Tensor) -> torch.Tensor:
+        """x: [t, n_features], return labels: [t]"""
+        return self.kneighbors(x)[1][:, 0]
+
+    def get_center_result(self, x: torch.Tensor, k: int = 1) -> torch.Tensor:
+        """
+        x: [t, n_features]
+        return the nearest center of each frame: [t, n_features] (dtype of cluster_centers_)
+        if k > 1, the k nearest centers are averaged with inverse distance weights.
+        """
+        distances, labels = self.kneighbors(x, k)
+        if k == 1:
+            return self.cluster_centers_[labels[:, 0]]
+        weights = inverse_distance_weights(distances, self.cluster_centers_.dtype)
+        return (self.cluster_centers_[labels] * weights.unsqueeze(-1)).sum(dim=1)
+
+
+def inverse_distance_weights(distances: torch.Tensor, dtype: torch.dtype | None = None) -> torch.Tensor:
+    """distances: [t, k] squared distances, return weights: [t, k] summing to 1 over k"""
+    weights = 1 / (distances.clamp(min=0).sqrt() + 1e-6)
+    return (weights / weights.sum(dim=1, keepdim=True)).to(dtype or distances.dtype)
+
+
+def _align(n: int) -> int:
+    return -(-n // CLUSTER_ALIGNMENT) * CLUSTER_ALIGNMENT
+
+
+class ArrayFileWriter:
+    """
+    Write the arrays of write_array_file one at a time, in chunks of chunk_bytes
+    (e.g. memory-mapped arrays that do not fit in memory together).
+    The header is reserved for names of at most max_ndim dimensions and written on close.
+    """
+
+    def __init__(self, path: Path | str, magic: bytes, names: Sequence[str], header_key: str, max_ndim: int = 2, chunk_bytes: int = 2**26) -> None:
+        self.header_key = header_key
+        self.max_ndim = max_ndim
+        self.chunk_bytes = chunk_bytes
+        self._header: dict[str, Any] = {}
+        # the largest possible entries, the header is padded with spaces to this length
+        placeholder = {"offset": 2**64, "shape": [2**64] * max_ndim, "dtype": "<" + "x" * 8}
+        self._header_length = len(json.dumps({header_key: {name: placeholder for name in names}}).encode())
+        self._header_start = len(magic) + 8
+        self._data_start = _align(self._header_start + self._header_length)
+        self._offset = 0
+        self._file = Path(path).open("wb")
+        self._file.write(magic)
+        self._file.write(self._header_length.to_bytes(8, "little"))
+
+    def write(self, name: str, array: ndarray[Any, Any]) -> None:
+        array = np.ascontiguousarray(array)
+        if array.ndim > self.max_ndim:
+            raise ValueError(f"{name} has {array.ndim} dimensions, at most {self.max_ndim} were reserved")
+        self._header[name] = {"offset": self._offset, "shape": list(array.shape), "dtype": array.dtype.str}
+        self._file.seek(self._data_start + self._offset)
+        flat = array.reshape(-1)
+        chunk_size = max(self.chunk_bytes // max(array.itemsize, 1), 1)
+        for i in range(0, len(flat), chunk_size):
+            self._file.write(flat[i : i + chunk_size].tobytes())
+        self._offset += _align(array.nbytes)
+
+    def close(self) -> None:
+        header_bytes = json.dumps({self.header_key: self._header}).encode()
+        if len(header_bytes) > self._header_length:
+            raise ValueError(f"The header of {self._file.name} does not fit in the reserved space")
+        with self._file as f:
+            f.truncate(self._data_start + self._offset)
+            f.seek(self._header_start)
+            f.write(header_bytes.ljust(self._header_length))
+
+    def __enter__(self) -> ArrayFileWriter:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def write_array_file(path: Path | str, magic: bytes, arrays: Mapping[str, ndarray[Any, Any]], header_key: str) -> None:
+    """
+    Write arrays in the compact format: magic, header length (uint64 little endian),
+    json header {header_key: {name: {offset, shape, dtype}}}, then each array aligned to CLUSTER_ALIGNMENT bytes.
+    """
+    max_ndim = max((np.ndim(array) for array in arrays.values()), default=0)
+    with ArrayFileWriter(path, magic, list(arrays), header_key, max_ndim=max_ndim) as writer:
+        for name, array in arrays.items():
+            writer.write(name, array)
+
+
+def read_array_file_header(path: Path | str, magic: bytes, header_key: str) -> tuple[dict[str, dict[str, Any]], int]:
+    """return the header entries and the offset of the data written by write_array_file"""
+    with Path(path).open("rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} does not start with {magic!r}")
+        header_length = int.from_bytes(f.read(8), "little")
+        entries = json.loads(f.read(header_length))[header_key]
+    return entries, _align(len(magic) + 8 + header_length)
+
+
+def memmap_array(path: Path | str, entry: Mapping[str, Any], data_start: int) -> ndarray[Any, Any]:
+    """Memory-map (copy-on-write) an array of a file written by write_array_file."""
+    return np.memmap(
+        path,
+        dtype=np.dtype(entry["dtype"]),
+        mode="c",
+        offset=data_start + entry["offset"],
+        shape=tuple(entry["shape"]),
+    )
+
+
+def save_cluster_model(path: Path | str, cluster_centers: Mapping[str, Any], half: bool = False) -> None:
+    """Save the cluster centers of each speaker in the compact format (float16 if half)."""
+    dtype = np.float16 if half else np.float32
+    write_array_file(path, CLUSTER_MAGIC, {spk: np.asarray(centers, dtype=dtype) for spk, centers in cluster_centers.items()}, "speakers")
+
+
+def is_compact_cluster_model(path: Path | str) -> bool:
+    with Path(path).open("rb") as f:
+        return f.read(len(CLUSTER_MAGIC)) == CLUSTER_MAGIC
+
+
+class LazyClusterModel(Mapping[str, ClusterCenters]):
+    """
+    Cluster model in the compact format.
+    Only the header is read up front, the centers of a speaker are memory-mapped
+    and moved to the device when the speaker is first used.
+    """
+
+    def __init__(self, path: Path | str, device: torch.device | str | None = None, dtype: torch.dtype = torch.float32) -> None:
+        self.path = Path(path)
+        self.device = device
+        self.dtype = dtype
+        if not is_compact_cluster_model(self.path):
+            raise ValueError(f"{self.path} is not a compact cluster model")
+        self._header, self._data_start = read_array_file_header(self.path, CLUSTER_MAGIC, "speakers")
+        self._loaded: dict[str, ClusterCenters] = {}
+
+    def get_array(self, speaker: str) -> ndarray[Any, Any]:
+        """Memory-mapped (copy-on-write) centers of speaker."""
+        return memmap_array(self.path, self._header[speaker], self._data_start)
+
+    def __getitem__(self, speaker: str) -> ClusterCenters:
+        if speaker not in self._loaded:
+            if speaker not in self._header:
+                raise KeyError(speaker)
+            LOG.info(f"Loading cluster centers of {speaker} from {self.path}")
+            self._loaded[speaker] = ClusterCenters(torch.from_numpy(self.get_array(speaker)), device=self.device, dtype=self.dtype)
+        return self._loaded[speaker]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._header)
+
+    def __len__(self) -> int:
+        return len(self._header)
+
+    def __contains__(self, speaker: object) -> bool:
+        return speaker in self._header
+
+
+def _load_legacy_checkpoint(ckpt_path: Path | str) -> dict[str, Any]:
+    """Load a pickled kmeans.pt, allowing only the numpy types it contains."""
+    from numpy._core import multiarray
+
+    safe_globals: list[Any] = [np.ndarray, np.dtype, multiarray._reconstruct, multiarray.scalar]
+    safe_globals += [type(np.dtype(dtype)) for dtype in (np.float16, np.float32, np.float64, np.int32, np.int64)]
+    # checkpoints pickled with numpy<2
+    safe_globals += [(multiarray._reconstruct, "numpy.core.multiarray._reconstruct"), (multiarray.scalar, "numpy.core.multiarray.scalar")]
+    with Path(ckpt_path).open("rb") as f, torch.serialization.safe_globals(safe_globals):
+        return torch.load(f, map_location="cpu", weights_only=True)
+
+
+def get_cluster_model(
+    ckpt_path: Path | str,
+    device: torch.device | str | None = None,
+    dtype: torch.dtype = torch.float32,
+) -> Mapping[str, ClusterCenters]:
+    """Load a cluster model, lazily if it is in the compact format."""
+    if is_compact_cluster_model(ckpt_path):
+        return LazyClusterModel(ckpt_path, device=device, dtype=dtype)
+    checkpoint = _load_legacy_checkpoint(ckpt_path)
+    return {spk: ClusterCenters(ckpt["cluster_centers_"], device=device, dtype=dtype) for spk, ckpt in checkpoint.items()}
+
+
+def convert_cluster_model(input_path: Path | str, output_path: Path | str, half: bool = False) -> None:
+    """Convert a pickled kmeans.pt to the compact format."""
+    checkpoint = _load_legacy_checkpoint(input_path)
+    save_cluster_model(output_path, {spk: ckpt["cluster_centers_"] for spk, ckpt in checkpoint.items()}, half=half)
+    input_mb, output_mb = (Path(path).stat().st_size / 1024**2 for path in (input_path, output_path))
+    LOG.info(f"Converted {input_path} ({input_mb:.1f} MB) to {output_path} ({output_mb:.1f} MB)")
 
 
 def check_speaker(model: Any, speaker: Any):
@@ -27,18 +272,21 @@ def check_speaker(model: Any, speaker: Any):
 
 def get_cluster_result(model: Any, x: Any, speaker: Any):
     """
-    x: np.array [t, 256]
+    x: [t, 256] (np.array or torch.Tensor)
     return cluster class result
     """
     check_speaker(model, speaker)
-    return model[speaker].predict(x)
+    if isinstance(x, torch.Tensor):
+        return model[speaker].predict(x)
+    return model[speaker].predict(torch.from_numpy(np.asarray(x))).cpu().numpy()
 
 
-def get_cluster_center_result(model: Any, x: Any, speaker: Any):
-    """x: np.array [t, 256]"""
+def get_cluster_center_result(model: Any, x: Any, speaker: Any, k: int = 1):
+    """x: [t, 256] (np.array or torch.Tensor)"""
     check_speaker(model, speaker)
-    predict = model[speaker].predict(x)
-    return model[speaker].cluster_centers_[predict]
+    if isinstance(x, torch.Tensor):
+        return model[speaker].get_center_result(x, k=k)
+    return model[speaker].get_center_result(torch.from_numpy(np.asarray(x)), k=k).cpu().numpy()
 
 
 def get_center(model: Any, x: Any, speaker: Any):
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import math
+from collections.abc import Iterator, Mapping
+from logging import getLogger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Any
+
+import numpy as np
+import torch
+from cm_time import timer
+from numpy import ndarray
+
+from . import ArrayFileWriter, ClusterCenters, check_speaker, inverse_distance_weights, memmap_array, read_array_file_header, write_array_file
+
+LOG = getLogger(__name__)
+
+# same layout as the compact cluster format, with the arrays of each speaker named "{speaker}/{name}"
+RETRIEVAL_MAGIC = b"SVCRETR1"
+_ARRAY_NAMES = ("centroids", "offsets", "vectors", "sq_norms")
+
+
+class IVFIndex:
+    """
+    Inverted file index of the content frames of a speaker.
+    The frames are sorted by their nearest coarse centroid, so each inverted list is the
+    contiguous range offsets[i]:offsets[i + 1] of vectors. A query scans the frames of
+    its n_probe nearest lists only.
+    """
+
+    def __init__(
+        self,
+        centroids: Any,
+        offsets: Any,
+        vectors: Any,
+        sq_norms: Any,
+        device: torch.device | str | None = None,
+        dtype: torch.dtype = torch.float32,
+        n_probe: int = 8,
+    ) -> None:
+        self.quantizer = ClusterCenters(centroids, device=device)
+        self.offsets = torch.as_tensor(offsets, dtype=torch.long, device=device)
+        # vectors keep the stored dtype (float16 halves the memory), distances are computed in float32
+        self.vectors = torch.as_tensor(vectors, device=device)
+        self.sq_norms = torch.as_tensor(sq_norms, dtype=torch.float32, device=device)
+        self.dtype = dtype
+        self.n_probe = n_probe
+
+    @property
+    def n_lists(self) -> int:
+        return self.quantizer.n_clusters
+
+    @property
+    def n_features_in_(self) -> int:
+        return self.vectors.shape[1]
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def search(self, x: torch.Tensor, k: int = 4) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        x: [t, n_features]
+        return squared distances: [t, k] (ascending, inf if fewer than k frames were scanned),
+        indices into vectors: [t, k]
+        """
+        x = x.to(self.vectors.device, torch.float32)
+        n_probe = min(self.n_probe, self.n_lists)
+        _, probes = self.quantizer.kneighbors(x, n_probe)
+
+        # scan each probed list once for all the queries probing it (consecutive frames mostly share lists)
+        lists, pairs = probes.flatten().sort()
+        unique_lists, counts = torch.unique_consecutive(lists, return_counts=True)
+        offsets = self.offsets.tolist()
+        # the k nearest frames of each (query, probe) pair
+        pair_distances = x.new_full((len(pairs), k), math.inf)
+        pair_indices = torch.zeros(len(pairs), k, dtype=torch.long, device=x.device)
+        for list_, pairs_ in zip(unique_lists.tolist(), pairs.split(counts.tolist())):
+            start, end = offsets[list_], offsets[list_ + 1]
+            scores = self.sq_norms[start:end] - 2 * (x[pairs_ // n_probe] @ self.vectors[start:end].float().T)
+            k_ = min(k, end - start)
+            scores, indices = scores.topk(k_, dim=1, largest=False)
+            pair_distances[pairs_, :k_] = scores
+            pair_indices[pairs_, :k_] = indices + start
+
+        distances, order = pair_distances.view(len(x), n_probe * k).topk(k, dim=1, largest=False)
+        return distances + (x**2).sum(dim=1, keepdim=True), pair_indices.view(len(x), n_probe * k).gather(1, order)
+
+    def get_retrieval_result(self, x: torch.Tensor, k: int = 4) -> torch.Tensor:
+        """
+        x: [t, n_features]
+        return the k nearest training frames of each frame averaged with inverse distance weights: [t, n_features]
+        """
+        distances, indices = self.search(x, k)
+        weights = inverse_distance_weights(distances, torch.float32)
+        return (self.vectors[indices].float() * weights.unsqueeze(-1)).sum(dim=1).to(self.dtype)
+
+
+def build_ivf_index(
+    features: Any,
+    n_lists: int | None = None,
+    half: bool = False,
+    device: torch.device | str = "cpu",
+    chunk_size: int = 65536,
+    verbose: bool = False,
+    vectors_path: Path | str | None = None,
+) -> dict[str, ndarray[Any, Any]]:
+    """
+    Build the arrays of an IVFIndex from features: [n, n_features] (e.g. np.memmap).
+    The coarse centroids are trained with TorchMiniBatchKMeans,
+    n_lists defaults to 4 * sqrt(n) (at most n).
+    The sorted vectors are written to a np.memmap at vectors_path if given, instead of memory.
+    """
+    from .torch_kmeans import TorchMiniBatchKMeans
+
+    n_frames = features.shape[0]
+    if n_lists is None:
+        n_lists = int(4 * math.sqrt(n_frames))
+    n_lists = max(min(n_lists, n_frames), 1)
+    kmeans = TorchMiniBatchKMeans(n_clusters=n_lists, max_iter=20, device=device, verbose=verbose).fit(features)
+    quantizer = ClusterCenters(kmeans.cluster_centers_, device=device)
+    labels = np.concatenate(
+        [quantizer.predict(torch.tensor(features[i : i + chunk_size], dtype=torch.float32)).cpu().numpy() for i in range(0, n_frames, chunk_size)]
+    )
+    # empty lists are dropped so that every probed list has frames
+    counts = np.bincount(labels, minlength=n_lists)
+    nonempty = np.flatnonzero(counts)
+    remap = np.cumsum(counts > 0) - 1
+    order = np.argsort(remap[labels], kind="stable")
+    shape, dtype = (n_frames, features.shape[1]), np.float16 if half else np.float32
+    if vectors_path is None:
+        vectors = np.empty(shape, dtype=dtype)
+    else:
+        vectors = np.memmap(vectors_path, dtype=dtype, mode="w+", shape=shape)
+    sq_norms = np.empty(n_frames, dtype=np.float32)
+    for i in range(0, n_frames, chunk_size):
+        # read the frames of features in ascending order
+        chunk_order = order[i : i + chunk_size]
+        sort = np.argsort(chunk_order)
+        chunk = np.asarray(features[chunk_order[sort]]).astype(dtype)
+        vectors[i + sort] = chunk
+        # norms of the stored (possibly rounded) vectors
+        sq_norms[i + sort] = (chunk.astype(np.float32) ** 2).sum(axis=1)
+    return {
+        "centroids": kmeans.cluster_centers_[nonempty].astype(np.float32),
+        "offsets": np.concatenate([[0], np.cumsum(counts[nonempty])]).astype(np.int64),
+        "vectors": vectors,
+        "sq_norms": sq_norms,
+    }
+
+
+def save_retrieval_index(path: Path | str, indexes: Mapping[str, Mapping[str, ndarray[Any, Any]]]) -> None:
+    """Save the arrays of build_ivf_index of each speaker."""
+    write_array_file(
+        path,
+        RETRIEVAL_MAGIC,
+        {f"{spk}/{name}": arrays[name] for spk, arrays in indexes.items() for name in _ARRAY_NAMES},
+        "arrays",
+    )
+
+
+class LazyRetrievalIndex(Mapping[str, IVFIndex]):
+    """
+    Retrieval index saved by save_retrieval_index.
+    The arrays of a speaker are memory-mapped when the speaker is first used
+    (and copied to the device if it is not the CPU).
+    """
+
+    def __init__(
+        self,
+        path: Path | str,
+        device: torch.device | str | None = None,
+        dtype: torch.dtype = torch.float32,
+        n_probe: int = 8,
+    ) -> None:
+        self.path = Path(path)
+        self.device = device
+        self.dtype = dtype
+        self.n_probe = n_probe
+        self._header, self._data_start = read_array_file_header(self.path, RETRIEVAL_MAGIC, "arrays")
+        self._speakers = list(dict.fromkeys(name.rpartition("/")[0] for name in self._header))
+        self._loaded: dict[str, IVFIndex] = {}
+
+    def get_arrays(self, speaker: str) -> dict[str, ndarray[Any, Any]]:
+        return {name: memmap_array(self.path, self._header[f"{speaker}/{name}"], self._data_start) for name in _ARRAY_NAMES}
+
+    def __getitem__(self, speaker: str) -> IVFIndex:
+        if speaker not in self._loaded:
+            if speaker not in self._speakers:
+                raise KeyError(speaker)
+            LOG.info(f"Loading retrieval index of {speaker} from {self.path}")
+            arrays = {name: torch.from_numpy(array) for name, array in self.get_arrays(speaker).items()}
+            self._loaded[speaker] = IVFIndex(**arrays, device=self.device, dtype=self.dtype, n_probe=self.n_probe)
+        return self._loaded[speaker]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._speakers)
+
+    def __len__(self) -> int:
+        return len(self._speakers)
+
+    def __contains__(self, speaker: object) -> bool:
+        return speaker in self._speakers
+
+
+def get_retrieval_index(
+    path: Path | str,
+    device: torch.device | str | None = None,
+    dtype: torch.dtype = torch.float32,
+    n_probe: int = 8,
+) -> LazyRetrievalIndex:
+    return LazyRetrievalIndex(path, device=device, dtype=dtype, n_probe=n_probe)
+
+
+def get_retrieval_result(model: Any, x: Any, speaker: Any, k: int = 4):
+    """x: [t, 256] (np.array or torch.Tensor)"""
+    check_speaker(model, speaker)
+    if isinstance(x, torch.Tensor):
+        return model[speaker].get_retrieval_result(x, k=k)
+    return model[speaker].get_retrieval_result(torch.from_numpy(np.asarray(x)), k=k).cpu().numpy()
+
+
+def main(
+    input_dir: Path | str,
+    output_path: Path | str,
+    n_lists: int | None = None,
+    half: bool = False,
+    store_dir: Path | str | None = None,
+    device: torch.device | str = "cpu",
+    verbose: bool = False,
+) -> None:
+    """
+    Build a retrieval index of the content frames of each speaker directory of input_dir.
+    The features and the sorted vectors of a speaker are memory-mapped in store_dir
+    (defaults to the speaker directory) and written to output_path before the next speaker.
+    """
+    from .train_cluster import build_feature_store
+
+    input_dir = Path(input_dir)
+    output_path = Path(output_path)
+    speaker_dirs = [speaker_dir for speaker_dir in sorted(input_dir.iterdir()) if speaker_dir.is_dir()]
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    names = [f"{speaker_dir.stem}/{name}" for speaker_dir in speaker_dirs for name in _ARRAY_NAMES]
+    with ArrayFileWriter(output_path, RETRIEVAL_MAGIC, names, "arrays") as writer:
+        for speaker_dir in speaker_dirs:
+            paths = sorted(speaker_dir.rglob("*.data.pt"))
+            with TemporaryDirectory(dir=store_dir or speaker_dir) as tempdir, timer() as t:
+                features = build_feature_store(paths, Path(tempdir) / "content.f32")
+                arrays = build_ivf_index(features, n_lists=n_lists, half=half, device=device, verbose=verbose, vectors_path=Path(tempdir) / "vectors")
+                for name in _ARRAY_NAMES:
+                    writer.write(f"{speaker_dir.stem}/{name}", arrays[name])
+                n_frames, n_lists_ = len(arrays["vectors"]), len(arrays["centroids"])
+                # the memmaps are closed before the store is removed
+                del features, arrays
+            LOG.info(f"Indexed {len(paths)} files of {speaker_dir.stem} ({n_frames} frames, {n_lists_} lists) in {t.elapsed:.2f}s")
@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+from logging import getLogger
+from typing import Any
+
+import numpy as np
+import torch
+
+from . import ClusterCenters
+
+LOG = getLogger(__name__)
+
+
+def kmeans_plusplus(x: torch.Tensor, n_clusters: int, generator: torch.Generator) -> torch.Tensor:
+    """
+    k-means++ initialization: each center is drawn with probability
+    proportional to the squared distance to the nearest center chosen so far.
+    x: [n, n_features], return centers: [n_clusters, n_features]
+    """
+    centers = torch.empty(n_clusters, x.shape[1], dtype=x.dtype, device=x.device)
+    centers[0] = x[torch.randint(len(x), (1,), generator=generator, device=x.device)]
+    closest = ((x - centers[0]) ** 2).sum(dim=1)
+    for i in range(1, n_clusters):
+        if closest.sum() <= 0:
+            # fewer distinct points than clusters
+            index = torch.randint(len(x), (1,), generator=generator, device=x.device)
+        else:
+            index = torch.multinomial(closest, 1, generator=generator)
+        centers[i] = x[index]
+        closest = torch.minimum(closest, ((x - centers[i]) ** 2).sum(dim=1))
+    return centers
+
+
+class TorchMiniBatchKMeans:
+    """
+    Mini-batch k-means (Sculley, 2010) on torch, with the same stopping and
+    reassignment heuristics as sklearn's MiniBatchKMeans.
+    The distances of each minibatch to all centers are a single matmul
+    (ClusterCenters.kneighbors), which runs on all threads of torch or on the GPU.
+    """
+
+    def __init__(
+        self,
+        n_clusters: int,
+        *,
+        batch_size: int = 4096,
+        max_iter: int = 80,
+        init_size: int | None = None,
+        max_no_improvement: int = 10,
+        reassignment_ratio: float = 0.01,
+        random_state: int | None = None,
+        device: torch.device | str = "cpu",
+        verbose: bool = False,
+    ) -> None:
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.init_size = init_size
+        self.max_no_improvement = max_no_improvement
+        self.reassignment_ratio = reassignment_ratio
+        self.random_state = random_state
+        self.device = torch.device(device)
+        self.verbose = verbose
+
+    def _get_batch(self, x: Any, indices: np.ndarray) -> torch.Tensor:
+        # sorted indices read memory-mapped features sequentially
+        return torch.from_numpy(np.asarray(x[np.sort(indices)], dtype=np.float32)).to(self.device)
+
+    def fit(self, x: Any) -> TorchMiniBatchKMeans:
+        """x: [n, n_features] array-like (e.g. np.memmap), only minibatches are loaded"""
+        n_samples, n_features = x.shape
+        if n_samples < self.n_clusters:
+            raise ValueError(f"n_samples={n_samples} should be >= n_clusters={self.n_clusters}")
+        rng = np.random.default_rng(self.random_state)
+        generator = torch.Generator(device=self.device).manual_seed(int(rng.integers(2**31)))
+        batch_size = min(self.batch_size, n_samples)
+
+        init_size = min(self.init_size or max(3 * self.n_clusters, batch_size), n_samples)
+        init_x = self._get_batch(x, rng.choice(n_samples, init_size, replace=False))
+        centers = kmeans_plusplus(init_x, self.n_clusters, generator)
+        del init_x
+        counts = torch.zeros(self.n_clusters, dtype=torch.float32, device=self.device)
+
+        n_steps = max(self.max_iter * n_samples // batch_size, 1)
+        alpha = min(batch_size * 2.0 / (n_samples + 1), 1.0)
+        ewa_inertia, best_inertia, no_improvement = None, float("inf"), 0
+        n_since_last_reassign = 0
+        for step in range(n_steps):
+            batch = self._get_batch(x, rng.integers(0, n_samples, batch_size))
+            distances, labels = ClusterCenters(centers).kneighbors(batch)
+            labels = labels[:, 0]
+
+            # move each center towards the mean of its samples with a per-center learning rate
+            batch_counts = torch.bincount(labels, minlength=self.n_clusters).float()
+            sums = torch.zeros_like(centers).index_add_(0, labels, batch)
+            counts += batch_counts
+            updated = batch_counts > 0
+            centers[updated] += (sums[updated] - batch_counts[updated, None] * centers[updated]) / counts[updated, None]
+
+            # reassign centers which have received too few samples to random samples of the batch
+            n_since_last_reassign += batch_size
+            if self.reassignment_ratio > 0 and n_since_last_reassign >= 10 * self.n_clusters:
+                n_since_last_reassign = 0
+                to_reassign = counts < self.reassignment_ratio * counts.max()
+                n_reassign = int(to_reassign.sum())
+                if n_reassign > batch_size // 2:
+                    to_reassign[to_reassign.nonzero()[batch_size // 2 :, 0]] = False
+                    n_reassign = batch_size // 2
+                if n_reassign > 0:
+                    new_indices = torch.randperm(batch_size, generator=generator, device=self.device)[:n_reassign]
+                    centers[to_reassign] = batch[new_indices]
+                    counts[to_reassign] = counts[~to_reassign].min()
+                    if self.verbose:
+                        LOG.info(f"[TorchMiniBatchKMeans] Reassigning {n_reassign} cluster centers.")
+
+            # stop when the exponentially weighted average of the inertia stops improving
+            inertia = float(distances.sum()) / batch_size
+            ewa_inertia = inertia if ewa_inertia is None else ewa_inertia * (1 - alpha) + inertia * alpha
+            if self.verbose:
+                LOG.info(f"Minibatch step {step + 1}/{n_steps}: mean batch inertia: {inertia}, ewa inertia: {ewa_inertia}")
+            if ewa_inertia < best_inertia:
+                best_inertia, no_improvement = ewa_inertia, 0
+            else:
+                no_improvement += 1
+            if self.max_no_improvement and no_improvement >= self.max_no_improvement:
+                LOG.info(f"Converged (lack of improvement in inertia) at step {step + 1}/{n_steps}")
+                break
+
+        self.cluster_centers_ = centers.cpu().numpy()
+        self.n_features_in_ = n_features
+        self.n_steps_ = step + 1
+        self._n_threads = torch.get_num_threads()
+        return self
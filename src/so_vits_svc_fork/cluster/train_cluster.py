@@ -1,20 +1,56 @@
 from __future__ import annotations
 
-import math
+import os
+from collections.abc import Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from logging import getLogger
 from pathlib import Path
-from typing import Any
+from tempfile import TemporaryDirectory
+from typing import Any, Literal
 
+import attrs
 import numpy as np
+import psutil
 import torch
 from cm_time import timer
-from joblib import Parallel, delayed
+from joblib.externals.loky import get_reusable_executor
 from sklearn.cluster import KMeans, MiniBatchKMeans
-from tqdm_joblib import tqdm_joblib
+from threadpoolctl import threadpool_limits
+from tqdm import tqdm
+
+from . import CLUSTER_SUFFIX, save_cluster_model
+from .torch_kmeans import TorchMiniBatchKMeans
 
 LOG = getLogger(__name__)
 
 
+def _iter_contents(paths: Sequence[Path]) -> Iterator[np.ndarray]:
+    """Content frames [t, n_features] of each .data.pt."""
+    for path in paths:
+        # with mmap=True, only the storage of content is read (not spec, audio, ...)
+        data = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        yield data["content"].squeeze(0).numpy().T
+
+
+def build_feature_store(paths: Sequence[Path], store_path: Path | str) -> np.memmap:
+    """
+    Append the content frames of paths to store_path one file at a time
+    and memory-map it as [n_frames, n_features] float32.
+    """
+    n_frames, n_features = 0, None
+    with Path(store_path).open("wb") as f:
+        for content in _iter_contents(paths):
+            if n_features is None:
+                n_features = content.shape[1]
+            elif content.shape[1] != n_features:
+                raise ValueError(f"Feature dimension mismatch: {content.shape[1]} != {n_features}")
+            f.write(np.ascontiguousarray(content, dtype=np.float32).tobytes())
+            n_frames += content.shape[0]
+    if n_features is None or n_frames == 0:
+        raise ValueError("No features found")
+    return np.memmap(store_path, dtype=np.float32, mode="r", shape=(n_frames, n_features))
+
+
 def train_cluster(
     input_dir: Path | str,
     n_clusters: int,
@@ -22,71 +58,160 @@ def train_cluster(
     batch_size: int = 4096,
     partial_fit: bool = False,
     verbose: bool = False,
+    store_dir: Path | str | None = None,
+    trainer: Literal["sklearn", "torch"] = "sklearn",
+    device: torch.device | str = "cpu",
 ) -> dict:
+    """
+    Fit k-means to the content frames of the .data.pt files in input_dir.
+    The frames are first streamed into a memory-mapped feature store in store_dir
+    (defaults to input_dir), from which MiniBatchKMeans samples its minibatches,
+    so the features are never loaded into memory at once.
+    (KMeans without minibatch still copies all features into memory.)
+    trainer="torch" uses TorchMiniBatchKMeans on device instead of sklearn (minibatch only).
+    """
     input_dir = Path(input_dir)
-    if not partial_fit:
-        LOG.info(f"Loading features from {input_dir}")
-        features = []
-        for path in input_dir.rglob("*.data.pt"):
-            with path.open("rb") as f:
-                features.append(torch.load(f, weights_only=True)["content"].squeeze(0).numpy().T)
-        if not features:
-            raise ValueError(f"No features found in {input_dir}")
-        features = np.concatenate(features, axis=0).astype(np.float32)
+    if partial_fit:
+        LOG.warning("partial_fit is deprecated, minibatch k-means always streams features from the feature store")
+    paths = sorted(input_dir.rglob("*.data.pt"))
+    if not paths:
+        raise ValueError(f"No features found in {input_dir}")
+    LOG.info(f"Loading features of {len(paths)} files from {input_dir}")
+    with TemporaryDirectory(dir=store_dir or input_dir) as tempdir:
+        features = build_feature_store(paths, Path(tempdir) / "content.f32")
         if features.shape[0] < n_clusters:
             raise ValueError("Too few HuBERT features to cluster. Consider using a smaller number of clusters.")
         LOG.info(f"shape: {features.shape}, size: {features.nbytes / 1024**2:.2f} MB, dtype: {features.dtype}")
         with timer() as t:
-            if use_minibatch:
+            if trainer == "torch":
+                if not use_minibatch:
+                    raise ValueError("trainer='torch' requires use_minibatch")
+                kmeans = TorchMiniBatchKMeans(
+                    n_clusters=n_clusters,
+                    verbose=verbose,
+                    batch_size=batch_size,
+                    max_iter=80,
+                    device=device,
+                ).fit(features)
+            elif use_minibatch:
                 kmeans = MiniBatchKMeans(
                     n_clusters=n_clusters,
                     verbose=verbose,
                     batch_size=batch_size,
                     max_iter=80,
                     n_init="auto",
+                    # labels_ of all frames are not used
+                    compute_labels=False,
                 ).fit(features)
             else:
                 kmeans = KMeans(n_clusters=n_clusters, verbose=verbose, n_init="auto").fit(features)
         LOG.info(f"Clustering took {t.elapsed:.2f} seconds")
+        del features
+
+    x = {
+        "n_features_in_": kmeans.n_features_in_,
+        "_n_threads": kmeans._n_threads,
+        "cluster_centers_": kmeans.cluster_centers_,
+    }
+    return x
+
+
+# memory of a worker process apart from the features (python, torch, sklearn)
+WORKER_MEMORY_OVERHEAD = 512 * 1024**2
+
+
+def count_frames(paths: Sequence[Path]) -> tuple[int, int]:
+    """Number of content frames and features of paths, read from the tensor metadata only."""
+    n_frames, n_features = 0, 0
+    for path in paths:
+        content = torch.load(path, map_location="cpu", mmap=True, weights_only=True)["content"]
+        n_frames += content.shape[-1]
+        n_features = content.shape[-2]
+    return n_frames, n_features
+
+
+def estimate_memory(n_frames: int, n_features: int, n_clusters: int, use_minibatch: bool, batch_size: int) -> int:
+    """Rough peak memory (bytes) of train_cluster for a speaker."""
+    centers = 3 * n_clusters * n_features * 4
+    if use_minibatch:
+        # squared norms and sample weights of all frames, (init) minibatches and their distances
+        batch = max(batch_size, 3 * n_clusters)
+        return WORKER_MEMORY_OVERHEAD + centers + n_frames * 8 + 2 * batch * (n_features + n_clusters) * 4
+    # KMeans copies all features and computes distances in chunks
+    return WORKER_MEMORY_OVERHEAD + centers + n_frames * (n_features + 2) * 4
+
+
+@attrs.define
+class ClusterJob:
+    speaker: str
+    input_dir: Path
+    memory: int
+    n_frames: int
+
+
+def _train_cluster_job(input_dir: Path, n_threads: int, **kwargs: Any) -> dict:
+    torch.set_num_threads(n_threads)
+    with threadpool_limits(limits=n_threads):
+        return train_cluster(input_dir, **kwargs)
+
+
+def select_cluster_jobs(
+    pending: Sequence[ClusterJob],
+    running: Sequence[ClusterJob],
+    memory_budget: int,
+    n_workers: int,
+) -> list[ClusterJob]:
+    """
+    Jobs to start next, in the order of pending (largest first), as long as the running ones
+    fit in memory_budget and n_workers. A job exceeding memory_budget is started alone.
+    """
+    used_memory = sum(job.memory for job in running)
+    n_running = len(running)
+    selected: list[ClusterJob] = []
+    for job in pending:
+        if n_running + len(selected) >= n_workers:
+            break
+        if used_memory + job.memory <= memory_budget or n_running + len(selected) == 0:
+            if job.memory > memory_budget:
+                LOG.warning(f"{job.speaker} needs about {job.memory / 1024**3:.1f} GB, more than the memory budget")
+            selected.append(job)
+            used_memory += job.memory
+    return selected
 
-        x = {
-            "n_features_in_": kmeans.n_features_in_,
-            "_n_threads": kmeans._n_threads,
-            "cluster_centers_": kmeans.cluster_centers_,
-        }
-        return x
-    else:
-        # minibatch partial fit
-        paths = list(input_dir.rglob("*.data.pt"))
-        if len(paths) == 0:
-            raise ValueError(f"No features found in {input_dir}")
-        LOG.info(f"Found {len(paths)} features in {input_dir}")
-        n_batches = math.ceil(len(paths) / batch_size)
-        LOG.info(f"Splitting into {n_batches} batches")
-        with timer() as t:
-            kmeans = MiniBatchKMeans(
-                n_clusters=n_clusters,
-                verbose=verbose,
-                batch_size=batch_size,
-                max_iter=80,
-                n_init="auto",
-            )
-            for i in range(0, len(paths), batch_size):
-                LOG.info(f"Processing batch {i // batch_size + 1}/{n_batches} for speaker {input_dir.stem}")
-                features = []
-                for path in paths[i : i + batch_size]:
-                    with path.open("rb") as f:
-                        features.append(torch.load(f, weights_only=True)["content"].squeeze(0).numpy().T)
-                features = np.concatenate(features, axis=0).astype(np.float32)
-                kmeans.partial_fit(features)
-        LOG.info(f"Clustering took {t.elapsed:.2f} seconds")
 
-        x = {
-            "n_features_in_": kmeans.n_features_in_,
-            "_n_threads": kmeans._n_threads,
-            "cluster_centers_": kmeans.cluster_centers_,
-        }
-        return x
+def schedule_cluster_jobs(
+    jobs: Sequence[ClusterJob],
+    memory_budget: int,
+    n_jobs: int = -1,
+    **kwargs: Any,
+) -> dict[str, dict]:
+    """
+    Run train_cluster for jobs in worker processes, largest first,
+    starting a job only while the estimated memory of the running jobs fits in memory_budget.
+    The CPU threads are split among the jobs started together.
+    """
+    n_cpus = os.cpu_count() or 1
+    n_workers = max(min(n_cpus if n_jobs < 0 else n_jobs, len(jobs)), 1)
+    pending = sorted(jobs, key=lambda job: job.memory, reverse=True)
+    running: dict[Future, tuple[ClusterJob, int]] = {}
+    results: dict[str, dict] = {}
+    executor = get_reusable_executor(max_workers=n_workers)
+    with tqdm(total=len(jobs), desc="Training clusters") as pbar:
+        while pending or running:
+            to_start = select_cluster_jobs(pending, [job for job, _ in running.values()], memory_budget, n_workers)
+            free_threads = n_cpus - sum(n_threads for _, n_threads in running.values())
+            for job in to_start:
+                pending.remove(job)
+                n_threads = max(free_threads // len(to_start), 1)
+                LOG.info(f"Training {job.speaker} ({job.n_frames} frames, ~{job.memory / 1024**3:.1f} GB, {n_threads} threads)")
+                future = executor.submit(_train_cluster_job, job.input_dir, n_threads, **kwargs)
+                running[future] = (job, n_threads)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, _ = running.pop(future)
+                results[job.speaker] = future.result()
+                pbar.update()
+    return results
 
 
 def main(
@@ -97,30 +222,45 @@ def main(
     batch_size: int = 4096,
     partial_fit: bool = False,
     verbose: bool = False,
+    store_dir: Path | str | None = None,
+    memory_budget: int | None = None,
+    n_jobs: int = -1,
+    trainer: Literal["sklearn", "torch"] = "sklearn",
+    device: torch.device | str = "cpu",
 ) -> None:
+    """memory_budget (bytes) defaults to 80% of the available memory."""
     input_dir = Path(input_dir)
     output_path = Path(output_path)
 
     if not (use_minibatch or not partial_fit):
         raise ValueError("partial_fit requires use_minibatch")
+    if memory_budget is None:
+        memory_budget = int(psutil.virtual_memory().available * 0.8)
 
-    def train_cluster_(input_path: Path, **kwargs: Any) -> tuple[str, dict]:
-        return input_path.stem, train_cluster(input_path, **kwargs)
-
-    with tqdm_joblib(desc="Training clusters", total=len(list(input_dir.iterdir()))):
-        parallel_result = Parallel(n_jobs=-1)(
-            delayed(train_cluster_)(
-                speaker_name,
-                n_clusters=n_clusters,
-                use_minibatch=use_minibatch,
-                batch_size=batch_size,
-                partial_fit=partial_fit,
-                verbose=verbose,
-            )
-            for speaker_name in input_dir.iterdir()
-        )
-    assert parallel_result is not None
-    checkpoint = dict(parallel_result)
+    jobs = []
+    for speaker_dir in sorted(input_dir.iterdir()):
+        if not speaker_dir.is_dir():
+            continue
+        n_frames, n_features = count_frames(sorted(speaker_dir.rglob("*.data.pt")))
+        memory = estimate_memory(n_frames, n_features, n_clusters, use_minibatch, batch_size)
+        jobs.append(ClusterJob(speaker=speaker_dir.stem, input_dir=speaker_dir, memory=memory, n_frames=n_frames))
+    LOG.info(f"Memory budget: {memory_budget / 1024**3:.1f} GB, estimated total: {sum(job.memory for job in jobs) / 1024**3:.1f} GB")
+    checkpoint = schedule_cluster_jobs(
+        jobs,
+        memory_budget,
+        n_jobs=n_jobs,
+        n_clusters=n_clusters,
+        use_minibatch=use_minibatch,
+        batch_size=batch_size,
+        partial_fit=partial_fit,
+        verbose=verbose,
+        store_dir=store_dir,
+        trainer=trainer,
+        device=device,
+    )
     output_path.parent.mkdir(exist_ok=True, parents=True)
+    if output_path.suffix == CLUSTER_SUFFIX:
+        save_cluster_model(output_path, {spk: ckpt["cluster_centers_"] for spk, ckpt in checkpoint.items()})
+        return
     with output_path.open("wb") as f:
         torch.save(checkpoint, f)
@@ -1,12 +1,16 @@
 from __future__ import annotations
 
+from collections.abc import Sequence
 from logging import getLogger
+from math import gcd
 from typing import Any, Literal
 
 import numpy as np
+import psutil
 import torch
 import torchcrepe
 from cm_time import timer
+from joblib import Parallel, delayed
 from numpy import dtype, float32, ndarray
 from torch import FloatTensor, Tensor
 
@@ -14,6 +18,9 @@ from so_vits_svc_fork.utils import get_optimal_device
 
 LOG = getLogger(__name__)
 
+# length of the segments compute_f0 splits long audio into if n_jobs != 1
+F0_SEGMENT_SECONDS = 30
+
 
 def normalize_f0(f0: FloatTensor, x_mask: FloatTensor, uv: FloatTensor, random_scale=True) -> FloatTensor:
     # calculate means based on x_mask
@@ -35,38 +42,45 @@ def normalize_f0(f0: FloatTensor, x_mask: FloatTensor, uv: FloatTensor, random_s
 def interpolate_f0(
     f0: ndarray[Any, dtype[float32]],
 ) -> tuple[ndarray[Any, dtype[float32]], ndarray[Any, dtype[float32]]]:
-    data = np.reshape(f0, (f0.size, 1))
-
-    vuv_vector = np.zeros((data.size, 1), dtype=np.float32)
-    vuv_vector[data > 0.0] = 1.0
-    vuv_vector[data <= 0.0] = 0.0
-
-    ip_data = data
-
+    """
+    Fill unvoiced (<= 0) frames of f0.
+    Runs between voiced frames are linearly interpolated, leading runs take the
+    first voiced value and trailing runs (including a run followed only by the
+    last frame) take the last voiced value.
+    return f0, vuv (1 for voiced frames of the input, else 0)
+    """
+    data = np.reshape(f0, f0.size)
+    vuv_vector = (data > 0.0).astype(np.float32)
+    ip_data = data.copy()
     frame_number = data.size
-    last_value = 0.0
-    for i in range(frame_number):
-        if data[i] <= 0.0:
-            j = i + 1
-            for j in range(i + 1, frame_number):
-                if data[j] > 0.0:
-                    break
-            if j < frame_number - 1:
-                if last_value > 0.0:
-                    step = (data[j] - data[i - 1]) / float(j - i)
-                    for k in range(i, j):
-                        ip_data[k] = data[i - 1] + step * (k - i + 1)
-                else:
-                    for k in range(i, j):
-                        ip_data[k] = data[j]
-            else:
-                for k in range(i, frame_number):
-                    ip_data[k] = last_value
-        else:
-            ip_data[i] = data[i]
-            last_value = data[i]
 
-    return ip_data[:, 0], vuv_vector[:, 0]
+    unvoiced = data <= 0.0
+    if not unvoiced.any():
+        return ip_data, vuv_vector
+
+    # [start, end) of each unvoiced run, end is the next voiced frame or frame_number
+    edges = np.diff(np.concatenate([[0], unvoiced.view(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    lengths = ends - starts
+    prev_values = np.where(starts > 0, data[starts - 1], 0).astype(data.dtype)
+    next_values = data[np.minimum(ends, frame_number - 1)]
+    # a run followed only by the last frame is treated as trailing
+    interior = ends < frame_number - 1
+
+    run_index = np.repeat(np.arange(len(starts)), lengths)
+    index = np.flatnonzero(unvoiced)
+    offsets = (index - starts[run_index] + 1).astype(data.dtype)
+    steps = (next_values - prev_values) / lengths.astype(data.dtype)
+    ip_data[index] = np.where(
+        interior[run_index],
+        np.where(starts[run_index] > 0, prev_values[run_index] + steps[run_index] * offsets, next_values[run_index]),
+        prev_values[run_index],
+    )
+    if ends[-1] == frame_number - 1:
+        ip_data[-1] = prev_values[-1]
+
+    return ip_data, vuv_vector
 
 
 def compute_f0_parselmouth(
@@ -75,18 +89,23 @@ def compute_f0_parselmouth(
     sampling_rate: int = 44100,
     hop_length: int = 512,
 ):
-    import parselmouth
-
     x = wav_numpy
     if p_len is None:
         p_len = x.shape[0] // hop_length
     else:
         assert abs(p_len - x.shape[0] // hop_length) < 4, "pad length error"
+    return _pad_f0_parselmouth(_compute_f0_parselmouth_frames(x, sampling_rate, hop_length), p_len)
+
+
+def _compute_f0_parselmouth_frames(wav_numpy: ndarray[Any, dtype[float32]], sampling_rate: int, hop_length: int) -> ndarray[Any, dtype[float32]]:
+    """f0 of the frames of parselmouth, which are centered in the audio."""
+    import parselmouth
+
     time_step = hop_length / sampling_rate * 1000
     f0_min = 50
     f0_max = 1100
-    f0 = (
-        parselmouth.Sound(x, sampling_rate)
+    return (
+        parselmouth.Sound(wav_numpy, sampling_rate)
         .to_pitch_ac(
             time_step=time_step / 1000,
             voicing_threshold=0.6,
@@ -96,6 +115,8 @@ def compute_f0_parselmouth(
         .selected_array["frequency"]
     )
 
+
+def _pad_f0_parselmouth(f0: ndarray[Any, dtype[float32]], p_len: int) -> ndarray[Any, dtype[float32]]:
     pad_size = (p_len - len(f0) + 1) // 2
     if pad_size > 0 or p_len - len(f0) - pad_size > 0:
         f0 = np.pad(f0, [[pad_size, p_len - len(f0) - pad_size]], mode="constant")
@@ -121,10 +142,17 @@ def compute_f0_pyworld(
     hop_length: int = 512,
     type_: Literal["dio", "harvest"] = "dio",
 ):
-    import pyworld
-
     if p_len is None:
         p_len = wav_numpy.shape[0] // hop_length
+    return _resize_f0(_compute_f0_pyworld_frames(wav_numpy, sampling_rate, hop_length, type_), p_len)
+
+
+def _compute_f0_pyworld_frames(
+    wav_numpy: ndarray[Any, dtype[float32]], sampling_rate: int, hop_length: int, type_: Literal["dio", "harvest"]
+) -> ndarray[Any, dtype[float32]]:
+    """f0 of the frames of pyworld, frame t is at sample t * hop_length."""
+    import pyworld
+
     if type_ == "dio":
         f0, t = pyworld.dio(
             wav_numpy.astype(np.double),
@@ -144,7 +172,31 @@ def compute_f0_pyworld(
     f0 = pyworld.stonemask(wav_numpy.astype(np.double), f0, t, sampling_rate)
     for index, pitch in enumerate(f0):
         f0[index] = round(pitch, 1)
-    return _resize_f0(f0, p_len)
+    return f0
+
+
+# rough peak memory of torchcrepe.infer per frame (activations of the first layers)
+CREPE_MEMORY_PER_FRAME = {"full": 4 * 1024**2, "tiny": 512 * 1024}
+CREPE_MAX_BATCH_SIZE = 4096
+
+
+def get_crepe_batch_size(
+    model: Literal["full", "tiny"] = "full",
+    device: str | torch.device = get_optimal_device(),
+    memory_budget: int | None = None,
+) -> int:
+    """
+    Number of frames torchcrepe infers at once within memory_budget bytes.
+    memory_budget defaults to a quarter of the free memory of device.
+    """
+    if memory_budget is None:
+        device = torch.device(device)
+        if device.type == "cuda":
+            free, _ = torch.cuda.mem_get_info(device)
+        else:
+            free = psutil.virtual_memory().available
+        memory_budget = free // 4
+    return int(min(max(memory_budget // CREPE_MEMORY_PER_FRAME[model], 1), CREPE_MAX_BATCH_SIZE))
 
 
 def compute_f0_crepe(
@@ -154,31 +206,150 @@ def compute_f0_crepe(
     hop_length: int = 512,
     device: str | torch.device = get_optimal_device(),
     model: Literal["full", "tiny"] = "full",
+    batch_size: int | None = None,
+    memory_budget: int | None = None,
 ):
-    audio = torch.from_numpy(wav_numpy).to(device, copy=True)
-    audio = torch.unsqueeze(audio, dim=0)
-
-    if audio.ndim == 2 and audio.shape[0] > 1:
-        audio = torch.mean(audio, dim=0, keepdim=True).detach()
-    # (T) -> (1, T)
-    audio = audio.detach()
-
-    pitch: Tensor = torchcrepe.predict(
-        audio,
+    """batch_size (frames) defaults to get_crepe_batch_size(model, device, memory_budget)"""
+    return compute_f0_crepe_batch(
+        [wav_numpy],
+        [p_len],
         sampling_rate,
         hop_length,
-        f0_min,
-        f0_max,
-        model,
-        batch_size=hop_length * 2,
         device=device,
-        pad=True,
+        model=model,
+        batch_size=batch_size,
+        memory_budget=memory_budget,
+    )[0]
+
+
+def compute_f0_crepe_batch(
+    wav_numpys: Sequence[ndarray[Any, dtype[float32]]],
+    p_lens: Sequence[None | int] | None = None,
+    sampling_rate: int = 44100,
+    hop_length: int = 512,
+    device: str | torch.device = get_optimal_device(),
+    model: Literal["full", "tiny"] = "full",
+    batch_size: int | None = None,
+    memory_budget: int | None = None,
+) -> list[ndarray[Any, dtype[float32]]]:
+    """
+    Compute f0 of multiple audios with torchcrepe, packing the frames of
+    (possibly many short) audios into batches of batch_size frames.
+    batch_size defaults to get_crepe_batch_size(model, device, memory_budget)
+    """
+    if batch_size is None:
+        batch_size = get_crepe_batch_size(model, device, memory_budget)
+    if p_lens is None:
+        p_lens = [None] * len(wav_numpys)
+
+    probabilities: list[list[Tensor]] = [[] for _ in wav_numpys]
+    pending: list[tuple[int, Tensor]] = []
+
+    def infer_pending() -> None:
+        frames = torch.cat([frames_ for _, frames_ in pending])
+        probabilities_batch = torchcrepe.infer(frames, model, device=device)
+        for (i, _), probabilities_ in zip(pending, probabilities_batch.split([len(frames_) for _, frames_ in pending])):
+            probabilities[i].append(probabilities_)
+        pending.clear()
+
+    with torch.no_grad(), timer() as t:
+        for i, wav_numpy in enumerate(wav_numpys):
+            # (T) -> (1, T)
+            audio = torch.from_numpy(wav_numpy).to(device, copy=True).unsqueeze(0)
+            for frames in torchcrepe.preprocess(audio, sampling_rate, hop_length, batch_size, device, pad=True):
+                if pending and sum(len(frames_) for _, frames_ in pending) + len(frames) > batch_size:
+                    infer_pending()
+                pending.append((i, frames))
+        if pending:
+            infer_pending()
+
+        f0s = []
+        for probabilities_, wav_numpy, p_len in zip(probabilities, wav_numpys, p_lens):
+            # (T, PITCH_BINS) -> (1, PITCH_BINS, T)
+            probabilities_ = torch.cat(probabilities_).unsqueeze(0).transpose(1, 2)
+            pitch: Tensor = torchcrepe.postprocess(probabilities_, f0_min, f0_max)
+            f0 = pitch.squeeze(0).cpu().float().numpy()
+            f0s.append(_resize_f0(f0, p_len or wav_numpy.shape[0] // hop_length))
+    n_frames = sum(p.shape[0] for ps in probabilities for p in ps)
+    LOG.info(f"Crepe: {n_frames} frames of {len(wav_numpys)} audios, batch size: {batch_size}, {n_frames / t.elapsed:.1f} frames/s")
+    return f0s
+
+
+def _compute_f0_cpu_frames(
+    wav_numpy: ndarray[Any, dtype[float32]],
+    sampling_rate: int,
+    hop_length: int,
+    method: Literal["parselmouth", "dio", "harvest"],
+) -> ndarray[Any, dtype[float32]]:
+    """f0 of the frames of method before they are resized or padded to p_len"""
+    if method == "parselmouth":
+        return _compute_f0_parselmouth_frames(wav_numpy, sampling_rate, hop_length)
+    return _compute_f0_pyworld_frames(wav_numpy, sampling_rate, hop_length, method)
+
+
+def compute_f0_segmented(
+    wav_numpy: ndarray[Any, dtype[float32]],
+    p_len: None | int = None,
+    sampling_rate: int = 44100,
+    hop_length: int = 512,
+    method: Literal["parselmouth", "dio", "harvest"] = "dio",
+    n_jobs: int = -1,
+    segment_seconds: float = F0_SEGMENT_SECONDS,
+    overlap_seconds: float = 1,
+) -> ndarray[Any, dtype[float32]]:
+    """
+    Compute f0 of overlapping segments in parallel and stitch them.
+    The frames of each segment are those of the whole audio: segments start at
+    multiples of hop_length and their lengths equal that of the audio modulo hop_length
+    (parselmouth centers its frames in the audio). overlap_seconds of context on each side
+    is trimmed before the stitched frames are resized or padded to p_len like those of the whole audio.
+    """
+    n_samples = wav_numpy.shape[0]
+    if p_len is None:
+        p_len = n_samples // hop_length
+    n_frames = n_samples // hop_length
+    segment_frames = max(int(segment_seconds * sampling_rate) // hop_length, 1)
+    overlap_frames = int(overlap_seconds * sampling_rate) // hop_length
+    if method == "harvest":
+        # harvest estimates f0 every millisecond from the start of the audio, so windows start at whole milliseconds
+        # (multiples of whole_ms_samples, the fewest samples lasting whole milliseconds)
+        whole_ms_samples = sampling_rate // gcd(sampling_rate, 1000)
+        align_frames = whole_ms_samples // gcd(whole_ms_samples, hop_length)
+        segment_frames = -(-segment_frames // align_frames) * align_frames
+        overlap_frames = -(-overlap_frames // align_frames) * align_frames
+    # (start, end, window_start, window_end) in frames
+    segments = [
+        (
+            start,
+            min(start + segment_frames, n_frames),
+            max(start - overlap_frames, 0),
+            min(start + segment_frames + overlap_frames, n_frames),
+        )
+        for start in range(0, n_frames, segment_frames)
+    ]
+    f0s = Parallel(n_jobs=n_jobs)(
+        delayed(_compute_f0_cpu_frames)(
+            # the last window ends at the end of the audio
+            wav_numpy[window_start * hop_length : window_end * hop_length + n_samples % hop_length],
+            sampling_rate,
+            hop_length,
+            method,
+        )
+        for _, _, window_start, window_end in segments
+    )
+    # frame t of a window is frame window_start + t of the whole audio, the last window has the last frames
+    f0 = np.concatenate(
+        [f0[start - window_start : end - window_start if end < n_frames else None] for f0, (start, end, window_start, _) in zip(f0s, segments)]
     )
+    if method == "parselmouth":
+        return _pad_f0_parselmouth(f0, p_len)
+    return _resize_f0(f0, p_len)
 
-    f0 = pitch.squeeze(0).cpu().float().numpy()
-    p_len = p_len or wav_numpy.shape[0] // hop_length
-    f0 = _resize_f0(f0, p_len)
-    return f0
+
+def _normalize(wav_numpy: ndarray[Any, dtype[float32]]) -> ndarray[Any, dtype[float32]]:
+    wav_numpy = wav_numpy.astype(np.float32)
+    wav_numpy /= np.quantile(np.abs(wav_numpy), 0.999)
+    return wav_numpy
 
 
 def compute_f0(
@@ -187,12 +358,19 @@ def compute_f0(
     sampling_rate: int = 44100,
     hop_length: int = 512,
     method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+    n_jobs: int = 1,
+    segment_seconds: float = F0_SEGMENT_SECONDS,
     **kwargs,
 ):
+    """
+    n_jobs: if not 1, audio longer than segment_seconds is split into segments
+    which are processed in parallel (dio, harvest and parselmouth only)
+    """
     with timer() as t:
-        wav_numpy = wav_numpy.astype(np.float32)
-        wav_numpy /= np.quantile(np.abs(wav_numpy), 0.999)
-        if method in ["dio", "harvest"]:
+        wav_numpy = _normalize(wav_numpy)
+        if n_jobs != 1 and method in ["dio", "harvest", "parselmouth"] and len(wav_numpy) > segment_seconds * sampling_rate:
+            f0 = compute_f0_segmented(wav_numpy, p_len, sampling_rate, hop_length, method, n_jobs=n_jobs, segment_seconds=segment_seconds)
+        elif method in ["dio", "harvest"]:
             f0 = compute_f0_pyworld(wav_numpy, p_len, sampling_rate, hop_length, method)
         elif method == "crepe":
             f0 = compute_f0_crepe(wav_numpy, p_len, sampling_rate, hop_length, **kwargs)
@@ -207,6 +385,26 @@ def compute_f0(
     return f0
 
 
+def compute_f0_batch(
+    wav_numpys: Sequence[ndarray[Any, dtype[float32]]],
+    sampling_rate: int = 44100,
+    hop_length: int = 512,
+    method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+    **kwargs,
+) -> list[ndarray[Any, dtype[float32]]]:
+    """compute_f0 for multiple audios, crepe packs the frames of all audios into shared batches"""
+    if method in ["crepe", "crepe-tiny"]:
+        return compute_f0_crepe_batch(
+            [_normalize(wav_numpy) for wav_numpy in wav_numpys],
+            None,
+            sampling_rate,
+            hop_length,
+            model="tiny" if method == "crepe-tiny" else "full",
+            **kwargs,
+        )
+    return [compute_f0(wav_numpy, sampling_rate=sampling_rate, hop_length=hop_length, method=method, **kwargs) for wav_numpy in wav_numpys]
+
+
 def f0_to_coarse(f0: torch.Tensor | float):
     is_torch = isinstance(f0, torch.Tensor)
     f0_mel = 1127 * (1 + f0 / 700).log() if is_torch else 1127 * np.log(1 + f0 / 700)
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from numpy import ndarray
+
+LOG = getLogger(__name__)
+
+Features = tuple[ndarray[Any, Any], ndarray[Any, Any], ndarray[Any, Any]]
+
+
+def get_feature_key(
+    audio: ndarray[Any, Any],
+    *,
+    sampling_rate: int,
+    hop_length: int,
+    f0_method: str,
+    contentvec_final_proj: bool,
+    content_window: tuple[float | None, float] = (None, 0),
+    f0_segment_seconds: float | None = None,
+) -> str:
+    """
+    Key of the features of audio, which only depend on the audio content and these parameters.
+    f0_segment_seconds: length of the segments f0 is computed in, None if it is computed at once
+    """
+    hash_ = hashlib.sha1(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+    hash_.update(f"{sampling_rate}:{hop_length}:{f0_method}:{contentvec_final_proj}:{content_window}:{f0_segment_seconds}".encode())
+    return hash_.hexdigest()
+
+
+class FeatureCache:
+    """
+    Two-tier LRU cache of (c, f0, uv) features.
+    c: [C, T], f0: [T], uv: [T], all before transposition and cluster mixing.
+    The in-memory tier holds up to max_memory_bytes, the optional on-disk tier
+    stores one npz per key in cache_dir and evicts the least recently used files
+    once they exceed max_disk_bytes.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_memory_bytes: int = 512 * 1024**2,
+        cache_dir: Path | str | None = None,
+        max_disk_bytes: int = 4 * 1024**3,
+    ) -> None:
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict[str, Features] = OrderedDict()
+        self._memory_bytes = 0
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._memory or (self.cache_dir is not None and self._get_path(key).exists())
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    def _get_path(self, key: str) -> Path:
+        assert self.cache_dir is not None
+        return self.cache_dir / f"{key}.npz"
+
+    def get(self, key: str) -> Features | None:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.cache_dir is None:
+            return None
+        path = self._get_path(key)
+        try:
+            with np.load(path) as f:
+                features = (f["c"], f["f0"], f["uv"])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            LOG.warning(f"Failed to load cached features {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path)
+        self._put_memory(key, features)
+        return features
+
+    def put(self, key: str, c: ndarray[Any, Any], f0: ndarray[Any, Any], uv: ndarray[Any, Any]) -> None:
+        features = (c, f0, uv)
+        self._put_memory(key, features)
+        if self.cache_dir is not None:
+            path = self._get_path(key)
+            temppath = path.parent / f"{key}.tmp.npz"
+            np.savez(temppath, c=c, f0=f0, uv=uv)
+            temppath.replace(path)
+            self._evict_disk()
+
+    def clear(self) -> None:
+        self._memory.clear()
+        self._memory_bytes = 0
+        if self.cache_dir is not None:
+            for path in self.cache_dir.glob("*.npz"):
+                path.unlink(missing_ok=True)
+
+    def _put_memory(self, key: str, features: Features) -> None:
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = features
+        self._memory_bytes += sum(x.nbytes for x in features)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= sum(x.nbytes for x in evicted)
+
+    def _evict_disk(self) -> None:
+        assert self.cache_dir is not None
+        paths = sorted(
+            ((path, path.stat()) for path in self.cache_dir.glob("*.npz") if not path.name.endswith(".tmp.npz")),
+            key=lambda x: x[1].st_mtime,
+        )
+        total = sum(stat.st_size for _, stat in paths)
+        for path, stat in paths[:-1]:
+            if total <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from collections.abc import Iterable
-from copy import deepcopy
+from collections import deque
+from collections.abc import Iterable, Mapping, Sequence
+from functools import partial
 from logging import getLogger
 from pathlib import Path
 from typing import Any, Callable, Literal
@@ -16,8 +17,11 @@ from numpy import dtype, float32, ndarray
 import so_vits_svc_fork.f0
 from so_vits_svc_fork import cluster, utils
 
-from ..modules.synthesizers import SynthesizerTrn
+from ..cluster import retrieval
+from ..modules.decoders.hifigan import NSFHifiGANGenerator, NSFHifiGANStream
+from ..modules.synthesizers import SpeakerConditioning, SynthesizerTrn
 from ..utils import get_optimal_device
+from .cache import FeatureCache, get_feature_key
 
 LOG = getLogger(__name__)
 
@@ -98,8 +102,24 @@ class Svc:
         device: torch.device | str | None = None,
         cluster_model_path: Path | str | None = None,
         half: bool = False,
+        feature_cache: FeatureCache | None = None,
+        f0_n_jobs: int = 1,
+        backend: Literal["torch", "onnx"] = "torch",
+        content_window_seconds: float | None = None,
+        content_overlap_seconds: float = utils.CONTENT_OVERLAP_SECONDS,
+        cluster_top_k: int = 1,
+        retrieval_index_path: Path | str | None = None,
+        retrieval_top_k: int = 4,
+        retrieval_n_probe: int = 8,
     ):
         self.net_g_path = net_g_path
+        self.backend = backend
+        self.content_window_seconds = content_window_seconds
+        self.content_overlap_seconds = content_overlap_seconds
+        self.cluster_top_k = cluster_top_k
+        self.retrieval_top_k = retrieval_top_k
+        self.feature_cache = feature_cache
+        self.f0_n_jobs = f0_n_jobs
         if device is None:
             self.device = (get_optimal_device(),)
         else:
@@ -113,9 +133,18 @@ class Svc:
         self.contentvec_final_proj = self.hps.data.__dict__.get("contentvec_final_proj", True)
         self.load_model()
         if cluster_model_path is not None and Path(cluster_model_path).exists():
-            self.cluster_model = cluster.get_cluster_model(cluster_model_path)
+            self.cluster_model = cluster.get_cluster_model(cluster_model_path, device=self.device, dtype=self.dtype)
+        if retrieval_index_path is not None and Path(retrieval_index_path).exists():
+            self.retrieval_index = retrieval.get_retrieval_index(
+                retrieval_index_path, device=self.device, dtype=self.dtype, n_probe=retrieval_n_probe
+            )
 
     def load_model(self):
+        # the conditionings of the previous weights
+        self._speaker_conditionings: dict[tuple[int, torch.dtype, torch.device], SpeakerConditioning] = {}
+        if self.backend == "onnx":
+            self.load_onnx_model()
+            return
         self.net_g = SynthesizerTrn(
             self.hps.data.filter_length // 2 + 1,
             self.hps.train.segment_size // self.hps.data.hop_length,
@@ -128,40 +157,178 @@ class Svc:
         _ = self.net_g.to(self.device, dtype=self.dtype)
         self.net_g = self.net_g
 
-    def get_unit_f0(
+    def load_onnx_model(self):
+        """Load net_g_path exported by `svc onnx` into an onnxruntime session."""
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("onnxruntime is required for the onnx backend. Install it with `pip install onnxruntime`.") from e
+        providers = ["CPUExecutionProvider"]
+        if self.device.type == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        self.onnx_session = onnxruntime.InferenceSession(Path(self.net_g_path).as_posix(), providers=providers)
+        metadata = self.onnx_session.get_modelmeta().custom_metadata_map
+        self.onnx_predict_f0 = metadata.get("predict_f0", "False") == "True"
+        LOG.info(f"Loaded onnx model {self.net_g_path} (predict_f0: {self.onnx_predict_f0})")
+
+    def _infer_onnx(
+        self,
+        sid: torch.Tensor,
+        c: torch.Tensor,
+        f0: torch.Tensor,
+        uv: torch.Tensor,
+        lengths: torch.Tensor | None,
+        auto_predict_f0: bool,
+        noise_scale: float | torch.Tensor,
+    ) -> torch.Tensor:
+        if auto_predict_f0 != self.onnx_predict_f0:
+            raise ValueError(
+                f"auto_predict_f0={auto_predict_f0} is not supported by this onnx model, "
+                f"which was exported with predict_f0={self.onnx_predict_f0}. Export it again with the other setting."
+            )
+        batch_size = c.shape[0]
+        if lengths is None:
+            lengths = torch.full((batch_size,), c.shape[-1], dtype=torch.long)
+        noise_scale = torch.broadcast_to(torch.as_tensor(noise_scale, dtype=torch.float32).reshape(-1, 1, 1).cpu(), (batch_size, 1, 1))
+        (audio,) = self.onnx_session.run(
+            None,
+            {
+                "c": c.detach().cpu().float().numpy(),
+                "f0": f0.detach().cpu().float().numpy(),
+                "uv": uv.detach().cpu().float().numpy(),
+                "sid": sid.cpu().numpy(),
+                "noise_scale": noise_scale.contiguous().numpy(),
+                "c_lengths": lengths.cpu().long().numpy(),
+            },
+        )
+        return torch.from_numpy(audio)
+
+    def get_speaker(self, speaker: int | str) -> tuple[str, int]:
+        if isinstance(speaker, int):
+            if len(self.spk2id.__dict__) >= speaker:
+                speaker_id = speaker
+            else:
+                raise ValueError(f"Speaker id {speaker} >= number of speakers {len(self.spk2id.__dict__)}")
+        else:
+            if speaker in self.spk2id.__dict__:
+                speaker_id = self.spk2id.__dict__[speaker]
+            else:
+                LOG.warning(f"Speaker {speaker} is not found. Use speaker 0 instead.")
+                speaker_id = 0
+        speaker_candidates = list(filter(lambda x: x[1] == speaker_id, self.spk2id.__dict__.items()))
+        if len(speaker_candidates) > 1:
+            raise ValueError(f"Speaker_id {speaker_id} is not unique. Candidates: {speaker_candidates}")
+        elif len(speaker_candidates) == 0:
+            raise ValueError(f"Speaker_id {speaker_id} is not found.")
+        return speaker_candidates[0][0], speaker_id
+
+    def _get_feature_key(
         self,
         audio: ndarray[Any, dtype[float32]],
-        tran: int,
-        cluster_infer_ratio: float,
-        speaker: int | str,
-        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
-    ):
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    ) -> str:
+        return get_feature_key(
+            audio,
+            sampling_rate=self.target_sample,
+            hop_length=self.hop_size,
+            f0_method=f0_method,
+            contentvec_final_proj=self.contentvec_final_proj,
+            # None used to window long inputs, 0 keeps the features of that default out of the cache
+            content_window=(self.content_window_seconds or 0, self.content_overlap_seconds),
+            f0_segment_seconds=None if self.f0_n_jobs == 1 else so_vits_svc_fork.f0.F0_SEGMENT_SECONDS,
+        )
+
+    def _compute_f0(
+        self,
+        audio: ndarray[Any, dtype[float32]],
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    ) -> tuple[ndarray[Any, dtype[float32]], ndarray[Any, dtype[float32]]]:
         f0 = so_vits_svc_fork.f0.compute_f0(
             audio,
             sampling_rate=self.target_sample,
             hop_length=self.hop_size,
             method=f0_method,
+            n_jobs=self.f0_n_jobs,
         )
-        f0, uv = so_vits_svc_fork.f0.interpolate_f0(f0)
-        f0 = torch.as_tensor(f0, dtype=self.dtype, device=self.device)
-        uv = torch.as_tensor(uv, dtype=self.dtype, device=self.device)
-        f0 = f0 * 2 ** (tran / 12)
-        f0 = f0.unsqueeze(0)
-        uv = uv.unsqueeze(0)
+        return so_vits_svc_fork.f0.interpolate_f0(f0)
 
-        c = utils.get_content(
-            self.hubert_model,
-            audio,
-            self.device,
-            self.target_sample,
-            self.contentvec_final_proj,
-        ).to(self.dtype)
-        c = utils.repeat_expand_2d(c.squeeze(0), f0.shape[1])
+    def _get_f0(
+        self,
+        audio: ndarray[Any, dtype[float32]],
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    ) -> tuple[ndarray[Any, dtype[float32]], ndarray[Any, dtype[float32]]]:
+        """f0 and uv of get_features(audio), looked up in feature_cache if set."""
+        if self.feature_cache is not None:
+            cached = self.feature_cache.get(self._get_feature_key(audio, f0_method))
+            if cached is not None:
+                return cached[1], cached[2]
+        return self._compute_f0(audio, f0_method)
+
+    def get_features(
+        self,
+        audio: ndarray[Any, dtype[float32]],
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Speaker and transpose independent features, looked up in feature_cache if set.
+        return c: [C, T], f0: [T], uv: [T]
+        """
+        key, cached = None, None
+        if self.feature_cache is not None:
+            key = self._get_feature_key(audio, f0_method)
+            cached = self.feature_cache.get(key)
+        if cached is not None:
+            LOG.info("Using cached features")
+            c, f0, uv = cached
+        else:
+            f0, uv = self._compute_f0(audio, f0_method)
+            c = utils.get_content(
+                self.hubert_model,
+                audio,
+                self.device,
+                self.target_sample,
+                self.contentvec_final_proj,
+                window_seconds=self.content_window_seconds,
+                overlap_seconds=self.content_overlap_seconds,
+            )
+            c = utils.repeat_expand_2d(c.squeeze(0), len(f0))
+            if self.feature_cache is not None and key is not None:
+                c = c.float().cpu().numpy()
+                self.feature_cache.put(key, c, f0, uv)
+        return (
+            torch.as_tensor(c, device=self.device).to(self.dtype),
+            torch.as_tensor(f0, dtype=self.dtype, device=self.device),
+            torch.as_tensor(uv, dtype=self.dtype, device=self.device),
+        )
 
+    def _mix_content(self, c: torch.Tensor, speaker: int | str, cluster_infer_ratio: float, retrieval_ratio: float) -> torch.Tensor:
+        """
+        Blend c: [C, T] with the nearest cluster centers and then with the nearest training frames
+        of the retrieval index of speaker.
+        """
         if cluster_infer_ratio != 0:
-            cluster_c = cluster.get_cluster_center_result(self.cluster_model, c.cpu().numpy().T, speaker).T
-            cluster_c = torch.FloatTensor(cluster_c).to(self.device)
+            cluster_c = cluster.get_cluster_center_result(self.cluster_model, c.T, speaker, k=self.cluster_top_k).T
             c = cluster_infer_ratio * cluster_c + (1 - cluster_infer_ratio) * c
+        if retrieval_ratio != 0:
+            retrieval_c = retrieval.get_retrieval_result(self.retrieval_index, c.T, speaker, k=self.retrieval_top_k).T
+            c = retrieval_ratio * retrieval_c + (1 - retrieval_ratio) * c
+        return c
+
+    def get_unit_f0(
+        self,
+        audio: ndarray[Any, dtype[float32]],
+        tran: int,
+        cluster_infer_ratio: float,
+        speaker: int | str,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
+    ):
+        c, f0, uv = self.get_features(audio, f0_method)
+        f0 = f0 * 2 ** (tran / 12)
+        f0 = f0.unsqueeze(0)
+        uv = uv.unsqueeze(0)
+
+        c = self._mix_content(c, speaker, cluster_infer_ratio, retrieval_ratio)
 
         c = c.unsqueeze(0)
         return c, f0, uv
@@ -175,47 +342,152 @@ class Svc:
         auto_predict_f0: bool = False,
         noise_scale: float = 0.4,
         f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
     ) -> tuple[torch.Tensor, int]:
         audio = audio.astype(np.float32)
         # get speaker id
-        if isinstance(speaker, int):
-            if len(self.spk2id.__dict__) >= speaker:
-                speaker_id = speaker
-            else:
-                raise ValueError(f"Speaker id {speaker} >= number of speakers {len(self.spk2id.__dict__)}")
-        else:
-            if speaker in self.spk2id.__dict__:
-                speaker_id = self.spk2id.__dict__[speaker]
-            else:
-                LOG.warning(f"Speaker {speaker} is not found. Use speaker 0 instead.")
-                speaker_id = 0
-        speaker_candidates = list(filter(lambda x: x[1] == speaker_id, self.spk2id.__dict__.items()))
-        if len(speaker_candidates) > 1:
-            raise ValueError(f"Speaker_id {speaker_id} is not unique. Candidates: {speaker_candidates}")
-        elif len(speaker_candidates) == 0:
-            raise ValueError(f"Speaker_id {speaker_id} is not found.")
-        speaker = speaker_candidates[0][0]
-        sid = torch.LongTensor([int(speaker_id)]).to(self.device).unsqueeze(0)
+        speaker, speaker_id = self.get_speaker(speaker)
 
         # get unit f0
-        c, f0, uv = self.get_unit_f0(audio, transpose, cluster_infer_ratio, speaker, f0_method)
+        c, f0, uv = self.get_unit_f0(audio, transpose, cluster_infer_ratio, speaker, f0_method, retrieval_ratio)
 
         # inference
-        with torch.no_grad():
-            with timer() as t:
-                audio = self.net_g.infer(
-                    c,
-                    f0=f0,
-                    g=sid,
-                    uv=uv,
-                    predict_f0=auto_predict_f0,
-                    noice_scale=noise_scale,
-                )[0, 0].data.float()
-            audio_duration = audio.shape[-1] / self.target_sample
-            LOG.info(f"Inference time: {t.elapsed:.2f}s, RTF: {t.elapsed / audio_duration:.2f}")
+        audio = self.infer_features(speaker_id, c, f0, uv, auto_predict_f0=auto_predict_f0, noise_scale=noise_scale)[0]
         torch.cuda.empty_cache()
         return audio, audio.shape[-1]
 
+    def get_speaker_conditioning(self, speaker_ids: Sequence[int]) -> SpeakerConditioning:
+        """
+        The tensors of net_g derived from the embedding of each speaker of a batch,
+        computed once per speaker (and dtype and device) and cached until the model is reloaded.
+        """
+        param = next(self.net_g.parameters())
+        conds = []
+        for speaker_id in speaker_ids:
+            key = (int(speaker_id), param.dtype, param.device)
+            if key not in self._speaker_conditionings:
+                with torch.no_grad():
+                    sid = torch.LongTensor([[int(speaker_id)]]).to(param.device)
+                    self._speaker_conditionings[key] = self.net_g.get_speaker_conditioning(sid)
+            conds.append(self._speaker_conditionings[key])
+        return SpeakerConditioning.cat(conds)
+
+    def infer_features(
+        self,
+        speaker_id: int | Sequence[int],
+        c: torch.Tensor,
+        f0: torch.Tensor,
+        uv: torch.Tensor,
+        lengths: torch.Tensor | None = None,
+        auto_predict_f0: bool = False,
+        noise_scale: float | Sequence[float] = 0.4,
+        phase: torch.Tensor | Callable[[torch.Tensor], torch.Tensor] | None = None,
+    ) -> torch.Tensor:
+        """
+        Run only the decoder on precomputed features.
+        c: [B, C, T], f0: [B, T], uv: [B, T], lengths: [B] (defaults to T)
+        speaker_id and noise_scale are either shared by or given for each item of the batch.
+        phase: [B, harmonic_num + 1] initial phase of the sines of the decoder, or a function of
+        the f0 of the decoder (predicted if auto_predict_f0) returning it (torch backend only)
+        return audio: [B, T * hop_size]
+        """
+        if isinstance(speaker_id, int):
+            speaker_id = [speaker_id] * c.shape[0]
+        sid = torch.LongTensor([int(id_) for id_ in speaker_id]).to(self.device).unsqueeze(1)
+        if not isinstance(noise_scale, (int, float)):
+            noise_scale = torch.as_tensor(noise_scale, dtype=c.dtype, device=self.device)[:, None, None]
+        with torch.no_grad():
+            with timer() as t:
+                if self.backend == "onnx":
+                    if phase is not None:
+                        raise ValueError("phase is not supported by the onnx backend")
+                    audio = self._infer_onnx(sid, c, f0, uv, lengths, auto_predict_f0, noise_scale)
+                else:
+                    audio = self.net_g.infer(
+                        c,
+                        f0=f0,
+                        g=sid,
+                        uv=uv,
+                        c_lengths=lengths,
+                        predict_f0=auto_predict_f0,
+                        noice_scale=noise_scale,
+                        phase=phase,
+                        cond=self.get_speaker_conditioning(speaker_id),
+                    )[:, 0].data.float()
+            n_frames = c.shape[0] * c.shape[-1] if lengths is None else int(lengths.sum())
+            audio_duration = n_frames * self.hop_size / self.target_sample
+            batch_info = f", batch size: {c.shape[0]}" if c.shape[0] > 1 else ""
+            LOG.info(f"Inference time: {t.elapsed:.2f}s, RTF: {t.elapsed / audio_duration:.2f}{batch_info}")
+        return audio
+
+    def get_unit_f0_batch(
+        self,
+        audios: Sequence[ndarray[Any, dtype[float32]]],
+        tran: int,
+        cluster_infer_ratio: float,
+        speaker: int | str,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
+        f0_uvs: Sequence[tuple[ndarray[Any, dtype[float32]], ndarray[Any, dtype[float32]]]] | None = None,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Batched version of get_unit_f0.
+        audios are zero-padded and fed to HuBERT at once, masked so that the content of each audio
+        does not depend on the batch (see utils.get_content), or if content windows are enabled,
+        those of the same length are.
+        f0_uvs: the f0 and uv of each audio if they are already computed (see _get_f0)
+        return c: [B, C, T], f0: [B, T], uv: [B, T], lengths: [B]
+        """
+        keys: list[str | None] = [None] * len(audios)
+        features: list[tuple[Any, Any, Any] | None] = [None] * len(audios)
+        if self.feature_cache is not None:
+            keys = [self._get_feature_key(audio, f0_method) for audio in audios]
+            features = [self.feature_cache.get(key) for key in keys]
+        misses = [i for i, feature in enumerate(features) if feature is None]
+        if len(misses) < len(audios):
+            LOG.info(f"Using cached features for {len(audios) - len(misses)}/{len(audios)} chunks")
+
+        groups: list[list[int]] = [misses] if misses else []
+        if self.content_window_seconds:
+            # the windows are not masked, so only the audios of the same length are batched
+            misses_by_length: dict[int, list[int]] = {}
+            for i in misses:
+                misses_by_length.setdefault(len(audios[i]), []).append(i)
+            groups = list(misses_by_length.values())
+        for group in groups:
+            # HuBERT pass on the audios of the group
+            lengths = [len(audios[i]) for i in group]
+            audio_batch = np.zeros((len(group), max(lengths)), dtype=np.float32)
+            for j, i in enumerate(group):
+                audio_batch[j, : lengths[j]] = audios[i]
+            c_batch = utils.get_content(
+                self.hubert_model,
+                audio_batch,
+                self.device,
+                self.target_sample,
+                self.contentvec_final_proj,
+                window_seconds=self.content_window_seconds,
+                overlap_seconds=self.content_overlap_seconds,
+                lengths=None if self.content_window_seconds else lengths,
+            )
+            content_lengths = utils.get_content_lengths(self.hubert_model, lengths, self.target_sample)
+            for j, i in enumerate(group):
+                f0, uv = self._compute_f0(audios[i], f0_method) if f0_uvs is None else f0_uvs[i]
+                c = utils.repeat_expand_2d(c_batch[j, :, : content_lengths[j]], len(f0))
+                key = keys[i]
+                if self.feature_cache is not None and key is not None:
+                    c = c.float().cpu().numpy()
+                    self.feature_cache.put(key, c, f0, uv)
+                features[i] = (c, f0, uv)
+
+        cs, f0s, uvs = [], [], []
+        for c, f0, uv in features:
+            c = torch.as_tensor(c, device=self.device).to(self.dtype)
+            cs.append(self._mix_content(c, speaker, cluster_infer_ratio, retrieval_ratio))
+            f0s.append(torch.as_tensor(f0, dtype=self.dtype, device=self.device) * 2 ** (tran / 12))
+            uvs.append(torch.as_tensor(uv, dtype=self.dtype, device=self.device))
+        return _stack_features(cs, f0s, uvs)
+
     def infer_silence(
         self,
         audio: np.ndarray[Any, np.dtype[np.float32]],
@@ -227,6 +499,7 @@ class Svc:
         cluster_infer_ratio: float = 0,
         noise_scale: float = 0.4,
         f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
         # slice config
         db_thresh: int = -40,
         pad_seconds: float = 0.5,
@@ -234,10 +507,180 @@ class Svc:
         absolute_thresh: bool = False,
         max_chunk_seconds: float = 40,
         # fade_seconds: float = 0.0,
+        # batch config
+        batch_size: int = 1,
+        # feature config
+        whole_file_features: bool = False,
     ) -> np.ndarray[Any, np.dtype[np.float32]]:
+        """
+        Infer speech chunks separated by silence.
+        If whole_file_features is True, HuBERT and f0 are computed once over the whole audio
+        and each chunk is decoded from a slice of them, using up to pad_seconds of the
+        neighbouring audio as context instead of zero padding.
+        """
+        sr = self.target_sample
+        chunks = self._split_silence(audio, db_thresh, chunk_seconds, absolute_thresh, max_chunk_seconds)
+
+        pad_len = int(sr * pad_seconds)
+        kwargs = dict(
+            cluster_infer_ratio=cluster_infer_ratio,
+            auto_predict_f0=auto_predict_f0,
+            noise_scale=noise_scale,
+            f0_method=f0_method,
+            retrieval_ratio=retrieval_ratio,
+        )
+        if whole_file_features:
+            audio_chunk_infers = self._infer_chunks_whole_file(speaker, transpose, audio, chunks, pad_len, batch_size, **kwargs)
+        else:
+            audio_chunk_infers = self._infer_chunks_padded(speaker, transpose, chunks, pad_len, batch_size, **kwargs)
+
+        # silence chunks are left as zeros
+        result_audio = np.zeros(audio.shape[0], dtype=np.float32)
+        for i, chunk in enumerate(chunks):
+            if chunk.is_speech:
+                audio_chunk_infer = audio_chunk_infers[i]
+
+                # add fade
+                # fade_len = int(self.target_sample * fade_seconds)
+                # _audio[:fade_len] = _audio[:fade_len] * np.linspace(0, 1, fade_len)
+                # _audio[-fade_len:] = _audio[-fade_len:] * np.linspace(1, 0, fade_len)
+                result_audio[chunk.start : chunk.end] = audio_chunk_infer
+        return result_audio
+
+    def infer_sweep(
+        self,
+        audio: np.ndarray[Any, np.dtype[np.float32]],
+        *,
+        # svc config
+        combinations: Sequence[tuple[int | str, int, float]],
+        auto_predict_f0: bool = False,
+        cluster_infer_ratio: float = 0,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
+        # slice config
+        db_thresh: int = -40,
+        pad_seconds: float = 0.5,
+        chunk_seconds: float = 0.5,
+        absolute_thresh: bool = False,
+        max_chunk_seconds: float = 40,
+        # batch config
+        batch_size: int | None = None,
+    ) -> list[np.ndarray[Any, np.dtype[np.float32]]]:
+        """
+        Render audio once for each (speaker, transpose, noise_scale) of combinations.
+        HuBERT and f0 are computed once over the whole audio, and each speech chunk
+        is decoded for up to batch_size (default: all) combinations at once.
+        Each audio is that of infer_silence with whole_file_features=True, up to the random noise.
+        """
+        if batch_size is None:
+            batch_size = len(combinations)
+        audio = audio.astype(np.float32)
+        chunks = self._split_silence(audio, db_thresh, chunk_seconds, absolute_thresh, max_chunk_seconds)
+        c, f0, uv = self.get_features(audio, f0_method)
+        frame_ranges = self._get_frame_ranges(chunks, int(self.target_sample * pad_seconds), f0.shape[0])
+
+        # content only depends on the speaker through the cluster model and the retrieval index
+        speakers = [self.get_speaker(speaker) for speaker, _, _ in combinations]
+        cs: dict[str, torch.Tensor] = {}
+        for speaker, _ in speakers:
+            if speaker not in cs:
+                cs[speaker] = self._mix_content(c, speaker, cluster_infer_ratio, retrieval_ratio)
+
+        # f0 of each combination, whose sines are continued from chunk to chunk as in infer_silence
+        transposed_f0s = {
+            i: torch.stack([f0[start:end] * 2 ** (transpose / 12) for _, transpose, _ in combinations]) for i, (start, end) in frame_ranges.items()
+        }
+        phase_chains = {batch_start: PhaseChain(self) for batch_start in range(0, len(combinations), batch_size)} if self.continues_phase() else {}
+
+        result_audios = [np.zeros_like(audio) for _ in combinations]
+        for i, (start, end) in frame_ranges.items():
+            chunk = chunks[i]
+            LOG.info(f"Chunk: {chunk}")
+            for batch_start in range(0, len(combinations), batch_size):
+                batch = range(batch_start, min(batch_start + batch_size, len(combinations)))
+                phase = None
+                if phase_chains:
+                    phase = partial(phase_chains[batch_start].next, decode_start=start * self.hop_size, start=chunk.start)
+                audio_batch = (
+                    self.infer_features(
+                        [speakers[k][1] for k in batch],
+                        torch.stack([cs[speakers[k][0]][:, start:end] for k in batch]),
+                        transposed_f0s[i][batch_start : batch_start + len(batch)],
+                        uv[None, start:end].expand(len(batch), -1),
+                        auto_predict_f0=auto_predict_f0,
+                        noise_scale=[combinations[k][2] for k in batch],
+                        phase=phase,
+                    )
+                    .cpu()
+                    .numpy()
+                )
+                for k, audio_infer in zip(batch, audio_batch):
+                    result_audios[k][chunk.start : chunk.end] = self._cut_chunk(audio_infer, chunk, start)
+            torch.cuda.empty_cache()
+        return result_audios
+
+    def continues_phase(self) -> bool:
+        """
+        Whether the sines of the decoder can be continued from one inference to the next,
+        which needs a sine source (NSF-HiFiGAN), see PhaseChain.
+        """
+        return self.backend == "torch" and not self.net_g.mb
+
+    def advance_phase(self, f0: torch.Tensor, phase: torch.Tensor | None, n_samples: int) -> torch.Tensor:
+        """
+        Phase of the sines of the decoder after n_samples of f0: [B, T] (frames) decoded from phase,
+        or from a random phase if it is None. return [B, harmonic_num + 1]
+        """
+        dec = self.net_g.dec
+        if phase is None:
+            phase = dec.m_source.l_sin_gen.initial_phase(f0.shape[0], f0.device)
+        return dec.advance_phase(f0, phase, n_samples)
+
+    def _get_chunk_phases(
+        self,
+        chunks: Sequence[Chunk],
+        f0s: Mapping[int, torch.Tensor],
+        decode_starts: Mapping[int, int],
+    ) -> dict[int, torch.Tensor]:
+        """
+        Initial phases of the sines of the decoder for the speech chunks decoded from
+        f0s[i]: [B, T] starting at sample decode_starts[i] of the audio, such that each chunk
+        continues the sines of the previous one at the sample where it starts,
+        so that the chunks can then be decoded in any order.
+        """
+        phase_chain = PhaseChain(self)
+        return {i: phase_chain.next(f0s[i], decode_starts[i], chunk.start) for i, chunk in enumerate(chunks) if i in f0s}
+
+    def _decode_chunks(
+        self,
+        speaker_id: int,
+        features: Sequence[tuple[torch.Tensor, torch.Tensor, torch.Tensor]],
+        phases: Sequence[torch.Tensor] | Callable[[torch.Tensor], torch.Tensor] | None,
+        auto_predict_f0: bool,
+        noise_scale: float,
+    ) -> list[torch.Tensor]:
+        """
+        Decode the features (c: [1, C, T], f0: [1, T], uv: [1, T]) of chunks at once, return the audio of each chunk.
+        phases: the initial phase of each chunk, or a function of the f0 of the decoder returning them (see PhaseChain.batch)
+        """
+        phase = phases if phases is None or callable(phases) else torch.cat(list(phases))
+        if len(features) == 1:
+            c, f0, uv = features[0]
+            return [self.infer_features(speaker_id, c, f0, uv, auto_predict_f0=auto_predict_f0, noise_scale=noise_scale, phase=phase)[0]]
+        c, f0, uv, lengths = _stack_features([c[0] for c, _, _ in features], [f0[0] for _, f0, _ in features], [uv[0] for _, _, uv in features])
+        audio_batch = self.infer_features(speaker_id, c, f0, uv, lengths, auto_predict_f0=auto_predict_f0, noise_scale=noise_scale, phase=phase)
+        return [audio_batch[j, : int(length) * self.hop_size] for j, length in enumerate(lengths)]
+
+    def _split_silence(
+        self,
+        audio: ndarray[Any, dtype[float32]],
+        db_thresh: int,
+        chunk_seconds: float,
+        absolute_thresh: bool,
+        max_chunk_seconds: float,
+    ) -> list[Chunk]:
         sr = self.target_sample
-        result_audio = np.array([], dtype=np.float32)
-        chunk_length_min = chunk_length_min = (
+        chunk_length_min = (
             int(
                 min(
                     sr / so_vits_svc_fork.f0.f0_min * 20 + 1,
@@ -246,51 +689,311 @@ class Svc:
             )
             // 2
         )
-        for chunk in split_silence(
-            audio,
-            top_db=-db_thresh,
-            frame_length=chunk_length_min * 2,
-            hop_length=chunk_length_min,
-            ref=1 if absolute_thresh else np.max,
-            max_chunk_length=int(max_chunk_seconds * sr),
-        ):
-            LOG.info(f"Chunk: {chunk}")
-            if not chunk.is_speech:
-                audio_chunk_infer = np.zeros_like(chunk.audio)
-            else:
-                # pad
-                pad_len = int(sr * pad_seconds)
-                audio_chunk_pad = np.concatenate(
-                    [
-                        np.zeros([pad_len], dtype=np.float32),
-                        chunk.audio,
-                        np.zeros([pad_len], dtype=np.float32),
-                    ]
-                )
-                audio_chunk_pad_infer_tensor, _ = self.infer(
-                    speaker,
-                    transpose,
-                    audio_chunk_pad,
-                    cluster_infer_ratio=cluster_infer_ratio,
-                    auto_predict_f0=auto_predict_f0,
-                    noise_scale=noise_scale,
-                    f0_method=f0_method,
-                )
+        return list(
+            split_silence(
+                audio,
+                top_db=-db_thresh,
+                frame_length=chunk_length_min * 2,
+                hop_length=chunk_length_min,
+                ref=1 if absolute_thresh else np.max,
+                max_chunk_length=int(max_chunk_seconds * sr),
+            )
+        )
+
+    def _get_frame_ranges(self, chunks: Sequence[Chunk], pad_len: int, n_frames: int) -> dict[int, tuple[int, int]]:
+        """Frame range of each speech chunk including up to pad_len samples of context."""
+        return {
+            i: (
+                max(0, (chunk.start - pad_len) // self.hop_size),
+                min(n_frames, -(-(chunk.end + pad_len) // self.hop_size)),
+            )
+            for i, chunk in enumerate(chunks)
+            if chunk.is_speech
+        }
+
+    def _cut_chunk(self, audio_infer: ndarray[Any, dtype[float32]], chunk: Chunk, start_frame: int) -> ndarray[Any, dtype[float32]]:
+        """Cut the audio of chunk out of audio inferred from start_frame."""
+        offset = chunk.start - start_frame * self.hop_size
+        audio_chunk_infer = audio_infer[offset : offset + len(chunk.audio)]
+        # the last frame may end before the end of the audio
+        return np.pad(audio_chunk_infer, (0, len(chunk.audio) - len(audio_chunk_infer)))
+
+    def _infer_chunks_padded(
+        self,
+        speaker: int | str,
+        transpose: int,
+        chunks: Sequence[Chunk],
+        pad_len: int,
+        batch_size: int,
+        *,
+        cluster_infer_ratio: float = 0,
+        auto_predict_f0: bool = False,
+        noise_scale: float = 0.4,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
+    ) -> dict[int, ndarray[Any, dtype[float32]]]:
+        speaker, speaker_id = self.get_speaker(speaker)
+        speech = [i for i, chunk in enumerate(chunks) if chunk.is_speech]
+
+        def pad(i: int) -> ndarray[Any, dtype[float32]]:
+            return np.concatenate(
+                [
+                    np.zeros([pad_len], dtype=np.float32),
+                    chunks[i].audio,
+                    np.zeros([pad_len], dtype=np.float32),
+                ]
+            ).astype(np.float32)
+
+        # the output of frame t starts at sample t * hop_size of the padded chunk, as in the whole file
+        decode_starts = {i: chunks[i].start - pad_len for i in speech}
+        phase_chain, phases, f0_uvs = None, None, None
+        if self.continues_phase() and auto_predict_f0:
+            # the sines are continued through the predicted f0 as the chunks are decoded, so in time order
+            phase_chain = PhaseChain(self)
+        elif self.continues_phase():
+            # the f0 of every chunk is computed first, so that the sines are continued in time order
+            # while the chunks are decoded in order of length
+            f0_uvs = {i: self._get_f0(pad(i), f0_method) for i in speech}
+            phases = self._get_chunk_phases(
+                chunks,
+                {i: torch.as_tensor(f0, dtype=self.dtype, device=self.device)[None] * 2 ** (transpose / 12) for i, (f0, _) in f0_uvs.items()},
+                decode_starts,
+            )
+        buckets = _bucket_by_length({i: len(chunks[i].audio) + 2 * pad_len for i in speech}, batch_size, sort=phase_chain is None)
+
+        # the content of a bucket is computed when it is decoded
+        audio_chunk_infers: dict[int, ndarray[Any, dtype[float32]]] = {}
+        for bucket in buckets:
+            for i in bucket:
+                LOG.info(f"Chunk: {chunks[i]}")
+            c, f0, uv, lengths = self.get_unit_f0_batch(
+                [pad(i) for i in bucket],
+                transpose,
+                cluster_infer_ratio,
+                speaker,
+                f0_method,
+                retrieval_ratio,
+                f0_uvs=None if f0_uvs is None else [f0_uvs[i] for i in bucket],
+            )
+            features = [(c[j : j + 1, :, :length], f0[j : j + 1, :length], uv[j : j + 1, :length]) for j, length in enumerate(lengths.tolist())]
+            bucket_phases: Sequence[torch.Tensor] | Callable[[torch.Tensor], torch.Tensor] | None = None
+            if phase_chain is not None:
+                bucket_phases = phase_chain.batch([decode_starts[i] for i in bucket], [chunks[i].start for i in bucket], lengths.tolist())
+            elif phases is not None:
+                bucket_phases = [phases[i] for i in bucket]
+
+            audio_chunk_pad_infer_tensors = self._decode_chunks(speaker_id, features, bucket_phases, auto_predict_f0, noise_scale)
+            for i, audio_chunk_pad_infer_tensor in zip(bucket, audio_chunk_pad_infer_tensors):
                 audio_chunk_pad_infer = audio_chunk_pad_infer_tensor.cpu().numpy()
-                pad_len = int(self.target_sample * pad_seconds)
-                cut_len_2 = (len(audio_chunk_pad_infer) - len(chunk.audio)) // 2
-                audio_chunk_infer = audio_chunk_pad_infer[cut_len_2 : cut_len_2 + len(chunk.audio)]
+                audio_chunk_infer = audio_chunk_pad_infer[pad_len : pad_len + len(chunks[i].audio)]
+                # the last frame may end before the end of the chunk if pad_len < hop_size
+                audio_chunk_infers[i] = np.pad(audio_chunk_infer, (0, len(chunks[i].audio) - len(audio_chunk_infer)))
 
-                # add fade
-                # fade_len = int(self.target_sample * fade_seconds)
-                # _audio[:fade_len] = _audio[:fade_len] * np.linspace(0, 1, fade_len)
-                # _audio[-fade_len:] = _audio[-fade_len:] * np.linspace(1, 0, fade_len)
+            # empty cache
+            torch.cuda.empty_cache()
+        return audio_chunk_infers
 
-                # empty cache
-                torch.cuda.empty_cache()
-            result_audio = np.concatenate([result_audio, audio_chunk_infer])
-        result_audio = result_audio[: audio.shape[0]]
-        return result_audio
+    def _infer_chunks_whole_file(
+        self,
+        speaker: int | str,
+        transpose: int,
+        audio: ndarray[Any, dtype[float32]],
+        chunks: Sequence[Chunk],
+        pad_len: int,
+        batch_size: int,
+        *,
+        cluster_infer_ratio: float = 0,
+        auto_predict_f0: bool = False,
+        noise_scale: float = 0.4,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
+    ) -> dict[int, ndarray[Any, dtype[float32]]]:
+        speaker, speaker_id = self.get_speaker(speaker)
+        c, f0, uv = self.get_unit_f0(audio.astype(np.float32), transpose, cluster_infer_ratio, speaker, f0_method, retrieval_ratio)
+        frame_ranges = self._get_frame_ranges(chunks, pad_len, f0.shape[1])
+        decode_starts = {i: start * self.hop_size for i, (start, _) in frame_ranges.items()}
+
+        phase_chain, phases = None, None
+        if self.continues_phase() and auto_predict_f0:
+            # the sines are continued through the predicted f0 as the chunks are decoded, so in time order
+            phase_chain = PhaseChain(self)
+        elif self.continues_phase():
+            phases = self._get_chunk_phases(chunks, {i: f0[:, start:end] for i, (start, end) in frame_ranges.items()}, decode_starts)
+
+        audio_chunk_infers: dict[int, ndarray[Any, dtype[float32]]] = {}
+        for bucket in _bucket_by_length({i: end - start for i, (start, end) in frame_ranges.items()}, batch_size, sort=phase_chain is None):
+            for i in bucket:
+                LOG.info(f"Chunk: {chunks[i]}")
+            bucket_phases: Sequence[torch.Tensor] | Callable[[torch.Tensor], torch.Tensor] | None = None
+            if phase_chain is not None:
+                bucket_phases = phase_chain.batch(
+                    [decode_starts[i] for i in bucket],
+                    [chunks[i].start for i in bucket],
+                    [end - start for start, end in map(frame_ranges.get, bucket)],
+                )
+            elif phases is not None:
+                bucket_phases = [phases[i] for i in bucket]
+            audio_batch = self._decode_chunks(
+                speaker_id,
+                [(c[:, :, slice(*frame_ranges[i])], f0[:, slice(*frame_ranges[i])], uv[:, slice(*frame_ranges[i])]) for i in bucket],
+                bucket_phases,
+                auto_predict_f0,
+                noise_scale,
+            )
+            for i, audio_infer in zip(bucket, audio_batch):
+                audio_chunk_infers[i] = self._cut_chunk(audio_infer.cpu().numpy(), chunks[i], frame_ranges[i][0])
+
+            # empty cache
+            torch.cuda.empty_cache()
+        return audio_chunk_infers
+
+
+@attrs.define
+class PhaseChain:
+    """
+    Continues the sines of the decoder of svc_model from one decoded chunk to the next,
+    in the order the chunks are decoded.
+    """
+
+    svc_model: Svc
+    # the f0: [B, T] of the last chunk, the initial phase of its sines and the sample it was decoded from
+    last: tuple[torch.Tensor, torch.Tensor, int] | None = None
+
+    def next(self, f0: torch.Tensor, decode_start: int, start: int) -> torch.Tensor:
+        """
+        Initial phase [B, harmonic_num + 1] of the sines for f0: [B, T] decoded from sample decode_start,
+        continuing the sines of the last chunk at sample start, or random for the first chunk.
+        """
+        svc = self.svc_model
+        if self.last is None:
+            phase = svc.net_g.dec.m_source.l_sin_gen.initial_phase(f0.shape[0], f0.device)
+        else:
+            last_f0, last_phase, last_decode_start = self.last
+            # the phase of the last chunk at start, less the phase this chunk accumulates before it
+            phase = svc.advance_phase(last_f0, last_phase, start - last_decode_start)
+            phase = (phase - svc.advance_phase(f0, torch.zeros_like(phase), start - decode_start)) % 1
+        self.last = (f0, phase, decode_start)
+        return phase
+
+    def batch(self, decode_starts: Sequence[int], starts: Sequence[int], lengths: Sequence[int]) -> Callable[[torch.Tensor], torch.Tensor]:
+        """
+        next() for each chunk of a batch in time order, as a function of their f0: [B, T] (lengths[j] frames each),
+        to be passed as phase to Svc.infer_features when the f0 is predicted.
+        """
+
+        def get_phase(f0: torch.Tensor) -> torch.Tensor:
+            return torch.cat([self.next(f0[j : j + 1, :length], decode_starts[j], starts[j]) for j, length in enumerate(lengths)])
+
+        return get_phase
+
+
+def _stack_features(
+    cs: Sequence[torch.Tensor], f0s: Sequence[torch.Tensor], uvs: Sequence[torch.Tensor]
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Zero-pad features of different lengths into a batch.
+    cs: [C, T_i], f0s: [T_i], uvs: [T_i]
+    return c: [B, C, T], f0: [B, T], uv: [B, T], lengths: [B]
+    """
+    lengths = [f0.shape[-1] for f0 in f0s]
+    max_length = max(lengths)
+    c = cs[0].new_zeros(len(cs), cs[0].shape[0], max_length)
+    f0 = f0s[0].new_zeros(len(f0s), max_length)
+    uv = uvs[0].new_zeros(len(uvs), max_length)
+    for i, length in enumerate(lengths):
+        c[i, :, :length] = cs[i]
+        f0[i, :length] = f0s[i]
+        uv[i, :length] = uvs[i]
+    return c, f0, uv, torch.as_tensor(lengths, device=c.device)
+
+
+def _bucket_by_length(lengths: dict[int, int], batch_size: int, max_length_ratio: float = 1.5, sort: bool = True) -> list[list[int]]:
+    """
+    Group keys of lengths into buckets of at most batch_size keys with similar lengths
+    so that little time is wasted on padding. Buckets are sorted by length,
+    or if sort is False, hold consecutive keys in the order of lengths.
+    """
+    if batch_size <= 1:
+        return [[key] for key in lengths]
+    buckets: list[list[int]] = []
+    for key in sorted(lengths, key=lambda k: lengths[k]) if sort else lengths:
+        if buckets and len(buckets[-1]) < batch_size:
+            bucket_lengths = [lengths[k] for k in buckets[-1]] + [lengths[key]]
+            if max(bucket_lengths) <= min(bucket_lengths) * max_length_ratio:
+                buckets[-1].append(key)
+                continue
+        buckets.append([key])
+    return buckets
+
+
+def _sola_scores_direct(first_tail: ndarray[Any, dtype[float32]], second_window: ndarray[Any, dtype[float32]]) -> ndarray[Any, dtype[np.float64]]:
+    """Normalized cross-correlation at each shift by direct convolution, O(sola_search_len * crossfade_len)."""
+    cor_nom = np.convolve(second_window, np.flip(first_tail), "valid")
+    cor_den = np.sqrt(np.convolve(second_window**2, np.ones(len(first_tail)), "valid") + 1e-8)
+    return cor_nom / cor_den
+
+
+def _sola_correlation_fft(first_tail: Any, second_window: Any) -> tuple[Any, Any]:
+    """
+    Correlation of second_window with first_tail at each shift by FFT (O(n log n)),
+    and the energy of each window of second_window by a cumulative sum.
+    Works on np.ndarray or, on its device, torch.Tensor.
+    """
+    import scipy.fft
+
+    crossfade_len, n_shifts = len(first_tail), len(second_window) - len(first_tail) + 1
+    # no circular wrap-around for the shifts used since n >= len(second_window)
+    n = scipy.fft.next_fast_len(len(second_window), real=True)
+    if isinstance(second_window, torch.Tensor):
+        # MPS has no float64, the candidates are compared again exactly anyway
+        dtype = torch.float32 if second_window.device.type == "mps" else torch.float64
+        second_window, first_tail = second_window.to(dtype), first_tail.to(dtype)
+        spectrum = torch.fft.rfft(second_window, n) * torch.fft.rfft(first_tail, n).conj()
+        cor_nom = torch.fft.irfft(spectrum, n)[:n_shifts]
+        energy = torch.nn.functional.pad(torch.cumsum(second_window**2, 0), (1, 0))
+    else:
+        second_window, first_tail = second_window.astype(np.float64), first_tail.astype(np.float64)
+        spectrum = scipy.fft.rfft(second_window, n) * scipy.fft.rfft(first_tail, n).conj()
+        cor_nom = scipy.fft.irfft(spectrum, n)[:n_shifts]
+        energy = np.concatenate([[0.0], np.cumsum(second_window**2)])
+    cor_den = energy[crossfade_len:] - energy[:n_shifts]
+    return cor_nom, cor_den
+
+
+# below this many multiply-adds the direct convolution is faster than the FFT
+_SOLA_DIRECT_MAX_SIZE = 2**19
+
+
+def get_sola_shift(first_tail: Any, second_window: Any, rtol: float = 1e-4) -> int:
+    """
+    Shift of second_window ([sola_search_len + crossfade_len]) which best continues
+    first_tail ([crossfade_len]), maximizing the normalized cross-correlation.
+    The correlation is computed by FFT and the window energy by a cumulative sum
+    (O(n log n) instead of O(sola_search_len * crossfade_len)). The shifts whose score
+    is close to the maximum are compared again by direct convolution,
+    so that the result is the same as that of _sola_scores_direct.
+    first_tail and second_window are np.ndarray or torch.Tensor (on the inference device).
+    """
+    is_tensor = isinstance(second_window, torch.Tensor)
+    if not (first_tail.any() and second_window.any()):
+        # every correlation is 0, argmax is the first shift
+        return 0
+    if not is_tensor and len(first_tail) * (len(second_window) - len(first_tail) + 1) <= _SOLA_DIRECT_MAX_SIZE:
+        return int(np.argmax(_sola_scores_direct(first_tail, second_window)))
+    cor_nom, cor_den = _sola_correlation_fft(first_tail, second_window)
+    if is_tensor:
+        scores = (cor_nom / torch.sqrt(cor_den.clamp(min=0) + 1e-8)).cpu().numpy()
+    else:
+        scores = cor_nom / np.sqrt(np.maximum(cor_den, 0) + 1e-8)
+    candidates = np.flatnonzero(scores >= scores.max() - rtol * np.abs(scores).max())
+    if len(candidates) == 1:
+        return int(candidates[0])
+    # the scores of the direct method may differ in the last bits, compare the candidates with it
+    if is_tensor:
+        first_tail, second_window = first_tail.cpu().numpy(), second_window.cpu().numpy()
+    crossfade_len = len(first_tail)
+    exact_scores = [_sola_scores_direct(first_tail, second_window[shift : shift + crossfade_len])[0] for shift in candidates]
+    return int(candidates[np.argmax(exact_scores)])
 
 
 def sola_crossfade(
@@ -298,21 +1001,18 @@ def sola_crossfade(
     second: ndarray[Any, dtype[float32]],
     crossfade_len: int,
     sola_search_len: int,
+    device: torch.device | str | None = None,
 ) -> ndarray[Any, dtype[float32]]:
-    cor_nom = np.convolve(
-        second[: sola_search_len + crossfade_len],
-        np.flip(first[-crossfade_len:]),
-        "valid",
-    )
-    cor_den = np.sqrt(
-        np.convolve(
-            second[: sola_search_len + crossfade_len] ** 2,
-            np.ones(crossfade_len),
-            "valid",
-        )
-        + 1e-8
-    )
-    sola_shift = np.argmax(cor_nom / cor_den)
+    """
+    Crossfade the end of first into second shifted by up to sola_search_len samples (SOLA).
+    If device is given, the shift is searched with torch on it.
+    """
+    second_window = second[: sola_search_len + crossfade_len]
+    first_tail = first[-crossfade_len:]
+    if device is not None:
+        sola_shift = get_sola_shift(torch.from_numpy(first_tail).to(device), torch.from_numpy(second_window).to(device))
+    else:
+        sola_shift = get_sola_shift(first_tail, second_window)
     LOG.info(f"SOLA shift: {sola_shift}")
     second = second[sola_shift : sola_shift + len(second) - sola_search_len]
     return np.concatenate(
@@ -332,6 +1032,7 @@ class Crossfader:
         additional_infer_after_len: int,
         crossfade_len: int,
         sola_search_len: int = 384,
+        sola_device: torch.device | str | None = None,
     ) -> None:
         if additional_infer_before_len < 0:
             raise ValueError("additional_infer_len must be >= 0")
@@ -345,12 +1046,19 @@ class Crossfader:
         self.additional_infer_after_len = additional_infer_after_len
         self.crossfade_len = crossfade_len
         self.sola_search_len = sola_search_len
+        # device of the SOLA shift search, None for numpy
+        self.sola_device = sola_device
         self.last_input_left = np.zeros(
             sola_search_len + crossfade_len + additional_infer_before_len + additional_infer_after_len,
             dtype=np.float32,
         )
         self.last_infered_left = np.zeros(crossfade_len, dtype=np.float32)
 
+    @property
+    def latency(self) -> int:
+        """Delay (samples) of the output behind the input, before the SOLA shift."""
+        return self.additional_infer_after_len + self.sola_search_len + self.crossfade_len
+
     def process(self, input_audio: ndarray[Any, dtype[float32]], *args, **kwargs: Any) -> ndarray[Any, dtype[float32]]:
         """
         Chunks        : ■■■■■■□□□□□□
@@ -404,6 +1112,7 @@ class Crossfader:
             infer_audio_to_use,
             self.crossfade_len,
             self.sola_search_len,
+            device=self.sola_device,
         )
         result_audio = _audio[: -self.crossfade_len]
         assert len(result_audio) == input_audio_len, f"{len(result_audio)} != {input_audio_len}"
@@ -419,6 +1128,108 @@ class Crossfader:
         return input_audio
 
 
+class IncrementalFeatures:
+    """
+    Content and f0 frames of a stream for realtime inference, computed incrementally.
+    Frame k is at sample k * hop_size of the stream. The frames of the previous calls are kept
+    and only the frames from margin_seconds before the end of the kept ones are (re)computed,
+    from their audio and context_seconds of audio before them, so the cost of a call
+    grows with the number of new samples instead of the length of the window.
+    The frames are close to, but not the same as, those computed over the whole window
+    (HuBERT attends to all of its input).
+    """
+
+    def __init__(self, svc_model: Svc, *, context_seconds: float = 0.1, margin_seconds: float = 0.05) -> None:
+        self.svc_model = svc_model
+        frames_per_second = svc_model.target_sample / svc_model.hop_size
+        self.context_frames = int(np.ceil(context_seconds * frames_per_second))
+        self.margin_frames = int(np.ceil(margin_seconds * frames_per_second))
+        self.reset()
+
+    def reset(self) -> None:
+        # frame index of the first kept frame
+        self.start_frame = 0
+        self._c: torch.Tensor | None = None
+        # f0 before interpolation (0 for unvoiced frames)
+        self._f0 = np.zeros(0, dtype=np.float32)
+        self._f0_method: str | None = None
+        self.n_computed_frames = 0
+
+    @property
+    def end_frame(self) -> int:
+        return self.start_frame + len(self._f0)
+
+    def _compute(self, audio: ndarray[Any, dtype[float32]], f0_method: str) -> tuple[torch.Tensor, ndarray[Any, dtype[float32]]]:
+        """audio: [n_frames * hop_size], return c: [C, n_frames], raw f0: [n_frames]"""
+        svc = self.svc_model
+        f0 = so_vits_svc_fork.f0.compute_f0(
+            audio, len(audio) // svc.hop_size, sampling_rate=svc.target_sample, hop_length=svc.hop_size, method=f0_method
+        )
+        c = utils.get_content(
+            svc.hubert_model,
+            audio,
+            svc.device,
+            svc.target_sample,
+            svc.contentvec_final_proj,
+            window_seconds=svc.content_window_seconds,
+            overlap_seconds=svc.content_overlap_seconds,
+        )
+        return utils.repeat_expand_2d(c.squeeze(0), len(f0)), np.asarray(f0, dtype=np.float32)
+
+    def update(
+        self,
+        audio: ndarray[Any, dtype[float32]],
+        end: int,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, int]:
+        """
+        audio: the samples of the stream before sample end (start = end - len(audio) may be < 0)
+        return c: [C, T], f0: [T], uv: [T] of the frames start // hop_size to ceil(end / hop_size),
+        and the position of audio[0] in the audio decoded from them
+        """
+        hop = self.svc_model.hop_size
+        start = end - len(audio)
+        # frames whose audio is all in the window
+        first_frame, last_frame = -(-start // hop), end // hop
+        if f0_method != self._f0_method or not start <= self.end_frame * hop <= end or self._c is None:
+            self.reset()
+            self.start_frame = first_frame
+            self._f0_method = f0_method
+
+        # recompute the last frames, which were computed without their right context
+        recompute_frame = max(self.end_frame - self.margin_frames, self.start_frame, first_frame)
+        self.n_computed_frames = 0
+        if last_frame > recompute_frame:
+            audio_frame = max(recompute_frame - self.context_frames, first_frame)
+            c, f0 = self._compute(audio[audio_frame * hop - start : last_frame * hop - start], f0_method)
+            keep = recompute_frame - self.start_frame
+            n_new = last_frame - recompute_frame
+            c, f0 = c[:, -n_new:], f0[-n_new:]
+            self._c = c if self._c is None else torch.cat([self._c[:, :keep], c], dim=1)
+            self._f0 = np.concatenate([self._f0[:keep], f0])
+            self.n_computed_frames = last_frame - audio_frame
+        if self._c is None:
+            raise ValueError(f"audio ({len(audio)} samples) must contain at least one frame ({hop} samples)")
+
+        # drop the frames before the window
+        window_start_frame, window_end_frame = start // hop, -(-end // hop)
+        n_drop = max(window_start_frame - self.start_frame, 0)
+        self._c, self._f0 = self._c[:, n_drop:], self._f0[n_drop:]  # type: ignore
+        self.start_frame += n_drop
+
+        # frames not (yet) computable are copied from the nearest ones
+        pad = (self.start_frame - window_start_frame, window_end_frame - self.end_frame)
+        c = torch.nn.functional.pad(self._c[None], pad, mode="replicate")[0] if any(pad) else self._c  # type: ignore
+        f0, uv = so_vits_svc_fork.f0.interpolate_f0(np.pad(self._f0, pad, mode="edge"))
+        svc = self.svc_model
+        return (
+            c.to(svc.device, svc.dtype),
+            torch.as_tensor(f0, dtype=svc.dtype, device=svc.device),
+            torch.as_tensor(uv, dtype=svc.dtype, device=svc.device),
+            start - window_start_frame * hop,
+        )
+
+
 class RealtimeVC(Crossfader):
     def __init__(
         self,
@@ -428,13 +1239,27 @@ class RealtimeVC(Crossfader):
         additional_infer_before_len: int = 7680,
         additional_infer_after_len: int = 7680,
         split: bool = True,
+        sola_device: torch.device | str | None = None,
+        incremental: bool = False,
     ) -> None:
+        """
+        If incremental is True, the content and f0 frames of the audio prepended to each block
+        are kept from the previous blocks (IncrementalFeatures) and split is ignored.
+        Unless split, the sines of the decoder continue their phase from block to block,
+        so the blocks need less crossfade.
+        """
         self.svc_model = svc_model
         self.split = split
+        self.incremental_features = IncrementalFeatures(svc_model) if incremental else None
+        # number of samples of the stream so far
+        self.input_end = 0
+        # continues the sines of the decoder from one window to the next
+        self.phase_chain = PhaseChain(svc_model)
         super().__init__(
             crossfade_len=crossfade_len,
             additional_infer_before_len=additional_infer_before_len,
             additional_infer_after_len=additional_infer_after_len,
+            sola_device=sola_device,
         )
 
     def process(
@@ -443,8 +1268,41 @@ class RealtimeVC(Crossfader):
         *args: Any,
         **kwargs: Any,
     ) -> ndarray[Any, dtype[float32]]:
+        self.input_end += len(input_audio)
         return super().process(input_audio, *args, **kwargs)
 
+    def _get_phase(self, decode_start: int) -> Callable[[torch.Tensor], torch.Tensor] | None:
+        """
+        Initial phase of the sines of the decoder for a window decoded from sample decode_start of the stream,
+        continuing the sines of the last decoded window, as a function of the f0 of the decoder.
+        """
+        if not self.svc_model.continues_phase():
+            return None
+        return partial(self.phase_chain.next, decode_start=decode_start, start=decode_start)
+
+    def _infer_incremental(
+        self,
+        input_audio: ndarray[Any, dtype[float32]],
+        speaker: int | str,
+        transpose: int,
+        cluster_infer_ratio: float,
+        auto_predict_f0: bool,
+        noise_scale: float,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+        retrieval_ratio: float,
+    ) -> ndarray[Any, dtype[float32]]:
+        assert self.incremental_features is not None
+        c, f0, uv, offset = self.incremental_features.update(input_audio, self.input_end, f0_method)
+        LOG.info(f"Computed {self.incremental_features.n_computed_frames}/{len(f0)} frames")
+        speaker, speaker_id = self.svc_model.get_speaker(speaker)
+        c = self.svc_model._mix_content(c, speaker, cluster_infer_ratio, retrieval_ratio)
+        f0 = (f0 * 2 ** (transpose / 12)).unsqueeze(0)
+        phase = self._get_phase(self.input_end - len(input_audio) - offset)
+        audio = self.svc_model.infer_features(
+            speaker_id, c.unsqueeze(0), f0, uv.unsqueeze(0), auto_predict_f0=auto_predict_f0, noise_scale=noise_scale, phase=phase
+        )[0]
+        return audio[offset : offset + len(input_audio)].cpu().numpy()
+
     def infer(
         self,
         input_audio: np.ndarray[Any, np.dtype[np.float32]],
@@ -455,12 +1313,22 @@ class RealtimeVC(Crossfader):
         auto_predict_f0: bool = False,
         noise_scale: float = 0.4,
         f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
         # slice config
         db_thresh: int = -40,
         pad_seconds: float = 0.5,
         chunk_seconds: float = 0.5,
     ) -> ndarray[Any, dtype[float32]]:
         # infer
+        if self.incremental_features is not None:
+            rms = np.sqrt(np.mean(input_audio**2))
+            min_rms = 10 ** (db_thresh / 20)
+            if rms < min_rms:
+                LOG.info(f"Skip silence: RMS={rms:.2f} < {min_rms:.2f}")
+                return np.zeros_like(input_audio)
+            return self._infer_incremental(
+                input_audio, speaker, transpose, cluster_infer_ratio, auto_predict_f0, noise_scale, f0_method, retrieval_ratio
+            )
         if self.split:
             return self.svc_model.infer_silence(
                 audio=input_audio,
@@ -470,6 +1338,7 @@ class RealtimeVC(Crossfader):
                 auto_predict_f0=auto_predict_f0,
                 noise_scale=noise_scale,
                 f0_method=f0_method,
+                retrieval_ratio=retrieval_ratio,
                 db_thresh=db_thresh,
                 pad_seconds=pad_seconds,
                 chunk_seconds=chunk_seconds,
@@ -483,26 +1352,44 @@ class RealtimeVC(Crossfader):
                 return np.zeros_like(input_audio)
             else:
                 LOG.info(f"Start inference: RMS={rms:.2f} >= {min_rms:.2f}")
-                infered_audio_c, _ = self.svc_model.infer(
-                    speaker=speaker,
-                    transpose=transpose,
-                    audio=input_audio,
-                    cluster_infer_ratio=cluster_infer_ratio,
-                    auto_predict_f0=auto_predict_f0,
-                    noise_scale=noise_scale,
-                    f0_method=f0_method,
-                )
+                speaker, speaker_id = self.svc_model.get_speaker(speaker)
+                c, f0, uv = self.svc_model.get_unit_f0(input_audio, transpose, cluster_infer_ratio, speaker, f0_method, retrieval_ratio)
+                phase = self._get_phase(self.input_end - len(input_audio))
+                infered_audio_c = self.svc_model.infer_features(
+                    speaker_id, c, f0, uv, auto_predict_f0=auto_predict_f0, noise_scale=noise_scale, phase=phase
+                )[0]
+                torch.cuda.empty_cache()
                 return infered_audio_c.cpu().numpy()
 
 
 class RealtimeVC2:
-    chunk_store: list[Chunk]
+    chunk_store: deque[Chunk]
 
     def __init__(self, svc_model: Svc) -> None:
-        self.input_audio_store = np.array([], dtype=np.float32)
-        self.chunk_store = []
+        # grows geometrically so that appending input is amortized O(len(input))
+        self._input_audio_buffer = np.zeros(0, dtype=np.float32)
+        self._input_audio_len = 0
+        self.chunk_store = deque()
         self.svc_model = svc_model
 
+    @property
+    def input_audio_store(self) -> ndarray[Any, dtype[float32]]:
+        return self._input_audio_buffer[: self._input_audio_len]
+
+    def _append_input_audio(self, audio: ndarray[Any, dtype[float32]]) -> None:
+        new_len = self._input_audio_len + len(audio)
+        if new_len > len(self._input_audio_buffer):
+            buffer = np.zeros(max(new_len, 2 * len(self._input_audio_buffer)), dtype=np.float32)
+            buffer[: self._input_audio_len] = self.input_audio_store
+            self._input_audio_buffer = buffer
+        self._input_audio_buffer[self._input_audio_len : new_len] = audio
+        self._input_audio_len = new_len
+
+    def _keep_input_audio(self, audio: ndarray[Any, dtype[float32]]) -> None:
+        # audio may be a view of the buffer, numpy handles the overlapping copy
+        self._input_audio_buffer[: len(audio)] = audio
+        self._input_audio_len = len(audio)
+
     def process(
         self,
         input_audio: np.ndarray[Any, np.dtype[np.float32]],
@@ -513,6 +1400,7 @@ class RealtimeVC2:
         auto_predict_f0: bool = False,
         noise_scale: float = 0.4,
         f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
         # slice config
         db_thresh: int = -40,
         chunk_seconds: float = 0.5,
@@ -526,10 +1414,11 @@ class RealtimeVC2:
                 auto_predict_f0=auto_predict_f0,
                 noise_scale=noise_scale,
                 f0_method=f0_method,
+                retrieval_ratio=retrieval_ratio,
             )
             return infered_audio_c.cpu().numpy()
 
-        self.input_audio_store = np.concatenate([self.input_audio_store, input_audio])
+        self._append_input_audio(input_audio)
         LOG.info(f"input_audio_store: {self.input_audio_store.shape}")
         sr = self.svc_model.target_sample
         chunk_length_min = int(min(sr / so_vits_svc_fork.f0.f0_min * 20 + 1, chunk_seconds * sr)) // 2
@@ -546,13 +1435,12 @@ class RealtimeVC2:
         assert len(chunk_list) > 0
         LOG.info(f"Chunk list: {chunk_list}")
         # do not infer LAST incomplete is_speech chunk and save to store
-        if chunk_list[-1].is_speech:
-            self.input_audio_store = chunk_list.pop().audio
-        else:
-            self.input_audio_store = np.array([], dtype=np.float32)
+        left_audio = chunk_list.pop().audio if chunk_list[-1].is_speech else self.input_audio_store[:0]
 
         # infer complete is_speech chunk and save to store
-        self.chunk_store.extend([attrs.evolve(c, audio=infer(c.audio) if c.is_speech else c.audio) for c in chunk_list])
+        # (chunk audio is a view of the input buffer, so copy it before the buffer is reused)
+        self.chunk_store.extend([attrs.evolve(c, audio=infer(c.audio) if c.is_speech else c.audio.copy()) for c in chunk_list])
+        self._keep_input_audio(left_audio)
 
         # calculate lengths and determine compress rate
         total_speech_len = sum([c.duration if c.is_speech else 0 for c in self.chunk_store])
@@ -562,50 +1450,132 @@ class RealtimeVC2:
         LOG.info(f"Total speech len: {total_speech_len}, silence len: {total_silence_len}, silence compress rate: {silence_compress_rate}")
 
         # generate output audio
-        output_audio = np.array([], dtype=np.float32)
+        output_audio = np.zeros(input_audio_len, dtype=np.float32)
+        output_len = 0
         break_flag = False
         LOG.info(f"Chunk store: {self.chunk_store}")
-        for chunk in deepcopy(self.chunk_store):
+        while self.chunk_store:
+            chunk = self.chunk_store.popleft()
             compress_rate = 1 if chunk.is_speech else silence_compress_rate
-            left_len = input_audio_len - output_audio.shape[0]
+            left_len = input_audio_len - output_len
             # calculate chunk duration
             chunk_duration_output = int(min(chunk.duration / compress_rate, left_len))
             chunk_duration_input = int(min(chunk.duration, left_len * compress_rate))
             LOG.info(f"Chunk duration output: {chunk_duration_output}, input: {chunk_duration_input}, left len: {left_len}")
 
-            # remove chunk from store
-            self.chunk_store.pop(0)
             if chunk.duration > chunk_duration_input:
                 left_chunk = attrs.evolve(chunk, audio=chunk.audio[chunk_duration_input:])
                 chunk = attrs.evolve(chunk, audio=chunk.audio[:chunk_duration_input])
 
-                self.chunk_store.insert(0, left_chunk)
+                self.chunk_store.appendleft(left_chunk)
                 break_flag = True
 
             if chunk.is_speech:
-                # if is_speech, just concat
-                output_audio = np.concatenate([output_audio, chunk.audio])
+                # if is_speech, just copy
+                chunk_len = min(len(chunk.audio), left_len)
+                output_audio[output_len : output_len + chunk_len] = chunk.audio[:chunk_len]
             else:
-                # if is_silence, concat with zeros and compress with silence_compress_rate
-                output_audio = np.concatenate(
-                    [
-                        output_audio,
-                        np.zeros(
-                            chunk_duration_output,
-                            dtype=np.float32,
-                        ),
-                    ]
-                )
+                # if is_silence, leave zeros compressed with silence_compress_rate
+                chunk_len = max(0, min(chunk_duration_output, left_len))
+            output_len += chunk_len
 
             if break_flag:
                 break
-        LOG.info(f"Chunk store: {self.chunk_store}, output_audio: {output_audio.shape}")
-        # make same length (errors)
-        output_audio = output_audio[:input_audio_len]
-        output_audio = np.concatenate(
-            [
-                output_audio,
-                np.zeros(input_audio_len - output_audio.shape[0], dtype=np.float32),
-            ]
-        )
+        LOG.info(f"Chunk store: {self.chunk_store}, output_audio: {output_len}")
+        # the rest (errors) is left as zeros
         return output_audio
+
+
+class RealtimeVC3:
+    """
+    Streaming realtime inference.
+    The content and f0 frames are computed incrementally (IncrementalFeatures), the encoder and
+    the flow run on the new frames with context_seconds of frames before them and lookahead_seconds
+    after them, and the decoder continues from the previous block (NSFHifiGANStream),
+    so no audio is decoded twice. The output is delayed by latency samples.
+    Only the torch backend with the hifi-gan decoder is supported.
+    """
+
+    def __init__(self, svc_model: Svc, *, context_seconds: float = 0.5, lookahead_seconds: float = 0.05) -> None:
+        if svc_model.backend != "torch" or not isinstance(svc_model.net_g.dec, NSFHifiGANGenerator):
+            raise ValueError("RealtimeVC3 requires the torch backend and the hifi-gan decoder")
+        self.svc_model = svc_model
+        hop = svc_model.hop_size
+        self.context_frames = int(np.ceil(context_seconds * svc_model.target_sample / hop))
+        self.lookahead_frames = int(np.ceil(lookahead_seconds * svc_model.target_sample / hop))
+        self.features = IncrementalFeatures(svc_model)
+        self.decoder = NSFHifiGANStream(svc_model.net_g.dec)
+        # a block ending anywhere within a frame is output once the frame and the lookahead are decoded
+        self.latency = self.lookahead_frames * hop + self.decoder.latency + hop - 1
+        self.reset()
+
+    def reset(self) -> None:
+        self.features.reset()
+        self.decoder.reset()
+        self.input_end = 0
+        # input audio from sample audio_start of the stream
+        self._audio = np.zeros(0, dtype=np.float32)
+        self._audio_start = 0
+        self._output = np.zeros(self.latency, dtype=np.float32)
+        # next frame to decode
+        self.next_frame = 0
+        self._speaker: int | str | None = None
+
+    def _window_start(self) -> int:
+        """First sample needed by the next call."""
+        features = self.features
+        feature_start = self.input_end - (features.context_frames + features.margin_frames + 1) * self.svc_model.hop_size
+        return min((self.next_frame - self.context_frames) * self.svc_model.hop_size, feature_start)
+
+    def process(
+        self,
+        input_audio: ndarray[Any, dtype[float32]],
+        # svc config
+        speaker: int | str,
+        transpose: int,
+        cluster_infer_ratio: float = 0,
+        auto_predict_f0: bool = False,
+        noise_scale: float = 0.4,
+        f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+        retrieval_ratio: float = 0,
+    ) -> ndarray[Any, dtype[float32]]:
+        svc = self.svc_model
+        hop = svc.hop_size
+        if speaker != self._speaker:
+            # the decoder state depends on the speaker
+            self.reset()
+            self._speaker = speaker
+        start = self._window_start()
+        self._audio = np.concatenate([self._audio, input_audio.astype(np.float32)])
+        self.input_end += len(input_audio)
+
+        # frames [next_frame, ready_frame) have their lookahead
+        end_frame = self.input_end // hop
+        ready_frame = end_frame - self.lookahead_frames
+        if ready_frame > self.next_frame:
+            window = np.concatenate([np.zeros(max(self._audio_start - start, 0), dtype=np.float32), self._audio[max(start - self._audio_start, 0) :]])
+            c, f0, uv, _ = self.features.update(window, self.input_end, f0_method)
+            first_frame = self.next_frame - self.context_frames
+            frames = slice(first_frame - start // hop, end_frame - start // hop)
+            c, f0, uv = c[:, frames], f0[frames], uv[frames]
+
+            speaker_name, speaker_id = svc.get_speaker(speaker)
+            c = svc._mix_content(c, speaker_name, cluster_infer_ratio, retrieval_ratio)
+            f0 = f0 * 2 ** (transpose / 12)
+            cond = svc.get_speaker_conditioning([speaker_id])
+            with torch.no_grad():
+                z, f0, g = svc.net_g.infer_latent(
+                    c.unsqueeze(0), f0.unsqueeze(0), uv.unsqueeze(0), noice_scale=noise_scale, predict_f0=auto_predict_f0, cond=cond
+                )
+                new_frames = slice(self.context_frames, ready_frame - first_frame)
+                audio = self.decoder(z[:, :, new_frames], f0[:, new_frames], g, cond.dec)[0, 0].float().cpu().numpy()
+            self._output = np.concatenate([self._output, audio])
+            self.next_frame = ready_frame
+
+        # keep the audio needed by the next call
+        keep_start = max(self._window_start(), self._audio_start)
+        self._audio = self._audio[keep_start - self._audio_start :]
+        self._audio_start = keep_start
+
+        result, self._output = self._output[: len(input_audio)], self._output[len(input_audio) :]
+        return result
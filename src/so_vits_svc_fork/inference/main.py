@@ -1,18 +1,20 @@
 from __future__ import annotations
 
+import json
 from collections.abc import Sequence
 from logging import getLogger
 from pathlib import Path
-from typing import Literal
+from typing import Any, Callable, Literal
 
 import librosa
 import numpy as np
 import soundfile
 import torch
-from cm_time import timer
 from tqdm import tqdm
 
-from so_vits_svc_fork.inference.core import RealtimeVC, RealtimeVC2, Svc
+from so_vits_svc_fork.inference import stream
+from so_vits_svc_fork.inference.cache import FeatureCache
+from so_vits_svc_fork.inference.core import RealtimeVC, RealtimeVC2, RealtimeVC3, Svc
 from so_vits_svc_fork.utils import get_optimal_device
 
 LOG = getLogger(__name__)
@@ -40,6 +42,24 @@ def infer(
     chunk_seconds: float = 0.5,
     absolute_thresh: bool = False,
     max_chunk_seconds: float = 40,
+    # batch config
+    batch_size: int | None = None,
+    # feature config
+    whole_file_features: bool = False,
+    feature_cache: bool = False,
+    feature_cache_dir: Path | str | None = None,
+    # sweep config
+    sweep: Sequence[tuple[int | str, int, float]] | None = None,
+    f0_n_jobs: int = 1,
+    # content config
+    content_window_seconds: float | None = None,
+    content_overlap_seconds: float = 3,
+    cluster_top_k: int = 1,
+    # retrieval config
+    retrieval_index_path: Path | str | None = None,
+    retrieval_ratio: float = 0,
+    retrieval_top_k: int = 4,
+    retrieval_n_probe: int = 8,
     device: str | torch.device = get_optimal_device(),
 ):
     if isinstance(input_path, (str, Path)):
@@ -72,6 +92,16 @@ def infer(
         config_path=config_path.as_posix(),
         cluster_model_path=(cluster_model_path.as_posix() if cluster_model_path else None),
         device=device,
+        # in memory, and on disk if feature_cache_dir is given
+        feature_cache=(FeatureCache(cache_dir=feature_cache_dir or None) if feature_cache or feature_cache_dir else None),
+        f0_n_jobs=f0_n_jobs,
+        backend="onnx" if model_path.suffix == ".onnx" else "torch",
+        content_window_seconds=content_window_seconds,
+        content_overlap_seconds=content_overlap_seconds,
+        cluster_top_k=cluster_top_k,
+        retrieval_index_path=retrieval_index_path,
+        retrieval_top_k=retrieval_top_k,
+        retrieval_n_probe=retrieval_n_probe,
     )
 
     try:
@@ -85,6 +115,29 @@ def infer(
                 LOG.exception(e)
                 continue
             output_path.parent.mkdir(parents=True, exist_ok=True)
+            if sweep:
+                audios = svc_model.infer_sweep(
+                    audio.astype(np.float32),
+                    combinations=sweep,
+                    auto_predict_f0=auto_predict_f0,
+                    cluster_infer_ratio=cluster_infer_ratio,
+                    f0_method=f0_method,
+                    retrieval_ratio=retrieval_ratio,
+                    db_thresh=db_thresh,
+                    pad_seconds=pad_seconds,
+                    chunk_seconds=chunk_seconds,
+                    absolute_thresh=absolute_thresh,
+                    max_chunk_seconds=max_chunk_seconds,
+                    # all combinations at once by default
+                    batch_size=batch_size,
+                )
+                for (speaker_, transpose_, noise_scale_), audio in zip(sweep, audios):
+                    soundfile.write(
+                        str(output_path.with_name(f"{output_path.stem}.{speaker_}.t{transpose_}.n{noise_scale_}{output_path.suffix}")),
+                        audio,
+                        svc_model.target_sample,
+                    )
+                continue
             audio = svc_model.infer_silence(
                 audio.astype(np.float32),
                 speaker=speaker,
@@ -93,11 +146,14 @@ def infer(
                 cluster_infer_ratio=cluster_infer_ratio,
                 noise_scale=noise_scale,
                 f0_method=f0_method,
+                retrieval_ratio=retrieval_ratio,
                 db_thresh=db_thresh,
                 pad_seconds=pad_seconds,
                 chunk_seconds=chunk_seconds,
                 absolute_thresh=absolute_thresh,
                 max_chunk_seconds=max_chunk_seconds,
+                batch_size=batch_size or 1,
+                whole_file_features=whole_file_features,
             )
             soundfile.write(str(output_path), audio, svc_model.target_sample)
     finally:
@@ -105,6 +161,85 @@ def infer(
         torch.cuda.empty_cache()
 
 
+def _create_realtime_process(
+    svc_model: Svc,
+    *,
+    # realtime config
+    version: int,
+    crossfade_seconds: float,
+    additional_infer_before_seconds: float,
+    additional_infer_after_seconds: float,
+    pad_seconds: float,
+    incremental: bool = False,
+    # svc config
+    speaker: str,
+    transpose: int,
+    auto_predict_f0: bool,
+    cluster_infer_ratio: float,
+    noise_scale: float,
+    f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"],
+    retrieval_ratio: float,
+    # slice config
+    db_thresh: int,
+    chunk_seconds: float,
+) -> tuple[Callable[[np.ndarray], np.ndarray], int | None]:
+    """
+    Create the realtime model of version and warm it up.
+    return process(block) -> converted block, and the delay (samples) the model adds if it is fixed
+    """
+    LOG.info("Creating realtime model...")
+    model: RealtimeVC | RealtimeVC2 | RealtimeVC3
+    if version == 1:
+        model = RealtimeVC(
+            svc_model=svc_model,
+            crossfade_len=int(crossfade_seconds * svc_model.target_sample),
+            additional_infer_before_len=int(additional_infer_before_seconds * svc_model.target_sample),
+            additional_infer_after_len=int(additional_infer_after_seconds * svc_model.target_sample),
+            incremental=incremental,
+        )
+        model_latency: int | None = model.latency
+    elif version == 3:
+        # streaming, always incremental
+        model = RealtimeVC3(svc_model)
+        model_latency = model.latency
+    else:
+        if incremental:
+            LOG.warning("incremental is only supported by version 1")
+        model = RealtimeVC2(
+            svc_model=svc_model,
+        )
+        # speech chunks are converted once they are followed by silence
+        model_latency = None
+
+    svc_kwargs = dict(
+        speaker=speaker,
+        transpose=transpose,
+        auto_predict_f0=auto_predict_f0,
+        cluster_infer_ratio=cluster_infer_ratio,
+        noise_scale=noise_scale,
+        f0_method=f0_method,
+        retrieval_ratio=retrieval_ratio,
+    )
+    # the model RTL is somewhat significantly high only in the first inference
+    # there could be no better way to warm up the model than to do a dummy inference
+    # (there are not differences in the behavior of the model between the first and the later inferences)
+    # so we do a dummy inference to warm up the model (1 second of audio)
+    LOG.info("Warming up the model...")
+    svc_model.infer(audio=np.zeros(svc_model.target_sample, dtype=np.float32), **svc_kwargs)
+
+    kwargs: dict[str, Any] = dict(**svc_kwargs)
+    if version != 3:
+        # slice config
+        kwargs.update(db_thresh=db_thresh, chunk_seconds=chunk_seconds)
+    if version == 1:
+        kwargs["pad_seconds"] = pad_seconds
+
+    def process(block: np.ndarray) -> np.ndarray:
+        return model.process(block, **kwargs)
+
+    return process, model_latency
+
+
 def realtime(
     *,
     # paths
@@ -122,6 +257,11 @@ def realtime(
     db_thresh: int = -40,
     pad_seconds: float = 0.5,
     chunk_seconds: float = 0.5,
+    # retrieval config
+    retrieval_index_path: Path | str | None = None,
+    retrieval_ratio: float = 0,
+    retrieval_top_k: int = 4,
+    retrieval_n_probe: int = 8,
     # realtime config
     crossfade_seconds: float = 0.05,
     additional_infer_before_seconds: float = 0.2,
@@ -132,6 +272,9 @@ def realtime(
     output_device: int | str | None = None,
     device: str | torch.device = get_optimal_device(),
     passthrough_original: bool = False,
+    max_queue_blocks: int = 2,
+    fallback: Literal["silence", "passthrough"] = "silence",
+    incremental: bool = False,
 ):
     import sounddevice as sd
 
@@ -143,21 +286,11 @@ def realtime(
         config_path=config_path.as_posix(),
         cluster_model_path=(cluster_model_path.as_posix() if cluster_model_path else None),
         device=device,
+        retrieval_index_path=retrieval_index_path,
+        retrieval_top_k=retrieval_top_k,
+        retrieval_n_probe=retrieval_n_probe,
     )
 
-    LOG.info("Creating realtime model...")
-    if version == 1:
-        model = RealtimeVC(
-            svc_model=svc_model,
-            crossfade_len=int(crossfade_seconds * svc_model.target_sample),
-            additional_infer_before_len=int(additional_infer_before_seconds * svc_model.target_sample),
-            additional_infer_after_len=int(additional_infer_after_seconds * svc_model.target_sample),
-        )
-    else:
-        model = RealtimeVC2(
-            svc_model=svc_model,
-        )
-
     # LOG all device info
     devices = sd.query_devices()
     LOG.info(f"Device: {devices}")
@@ -181,21 +314,29 @@ def realtime(
         output_device = sd.default.device[1]
     LOG.info(f"Input Device: {devices[input_device]['name']}, Output Device: {devices[output_device]['name']}")
 
-    # the model RTL is somewhat significantly high only in the first inference
-    # there could be no better way to warm up the model than to do a dummy inference
-    # (there are not differences in the behavior of the model between the first and the later inferences)
-    # so we do a dummy inference to warm up the model (1 second of audio)
-    LOG.info("Warming up the model...")
-    svc_model.infer(
+    process, model_latency = _create_realtime_process(
+        svc_model,
+        version=version,
+        crossfade_seconds=crossfade_seconds,
+        additional_infer_before_seconds=additional_infer_before_seconds,
+        additional_infer_after_seconds=additional_infer_after_seconds,
+        pad_seconds=pad_seconds,
+        incremental=incremental,
         speaker=speaker,
         transpose=transpose,
         auto_predict_f0=auto_predict_f0,
         cluster_infer_ratio=cluster_infer_ratio,
         noise_scale=noise_scale,
         f0_method=f0_method,
-        audio=np.zeros(svc_model.target_sample, dtype=np.float32),
+        retrieval_ratio=retrieval_ratio,
+        db_thresh=db_thresh,
+        chunk_seconds=chunk_seconds,
     )
 
+    # inference runs on the worker thread of the engine, the callback only copies audio
+    block_size = int(block_seconds * svc_model.target_sample)
+    engine = stream.RealtimeEngine(process, block_size, max_queue_blocks=max_queue_blocks, fallback=fallback)
+
     def callback(
         indata: np.ndarray,
         outdata: np.ndarray,
@@ -203,49 +344,121 @@ def realtime(
         time: int,
         status: sd.CallbackFlags,
     ) -> None:
-        LOG.debug(f"Frames: {frames}, Status: {status}, Shape: {indata.shape}, Time: {time}")
+        engine.callback(indata.mean(axis=1).astype(np.float32), outdata[:, 0])
+        if passthrough_original:
+            outdata[:] = (indata + outdata) / 2
+
+    try:
+        with (
+            engine,
+            sd.Stream(
+                device=(input_device, output_device),
+                channels=1,
+                callback=callback,
+                samplerate=svc_model.target_sample,
+                blocksize=block_size,
+                latency="low",
+            ) as audio_stream,
+        ):
+            model_latency_info = "variable" if model_latency is None else f"{model_latency / svc_model.target_sample:.3f}s"
+            LOG.info(f"Latency: {audio_stream.latency}, buffering: {engine.latency / svc_model.target_sample:.3f}s, model: {model_latency_info}")
+            while True:
+                sd.sleep(1000)
+                stats = engine.stats
+                rtf = stats.max_process_time / block_seconds
+                LOG.info(
+                    f"Queue depth: {engine.queue_depth}, underruns: {stats.underruns}, overruns: {stats.overruns}, "
+                    f"late blocks: {stats.late_blocks}, max RTF: {rtf:.3f}"
+                )
+                if rtf > 1:
+                    LOG.warning("RTF is too high, consider increasing block_seconds")
+    finally:
+        # del model, svc_model
+        torch.cuda.empty_cache()
+
 
-        kwargs = dict(
-            input_audio=indata.mean(axis=1).astype(np.float32),
-            # svc config
+def simulate_realtime(
+    *,
+    # paths
+    input_path: Path | str,
+    output_path: Path | str,
+    model_path: Path | str,
+    config_path: Path | str,
+    report_path: Path | str | None = None,
+    # svc config
+    speaker: str,
+    cluster_model_path: Path | str | None = None,
+    transpose: int = 0,
+    auto_predict_f0: bool = False,
+    cluster_infer_ratio: float = 0,
+    noise_scale: float = 0.4,
+    f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+    # slice config
+    db_thresh: int = -40,
+    pad_seconds: float = 0.5,
+    chunk_seconds: float = 0.5,
+    # retrieval config
+    retrieval_index_path: Path | str | None = None,
+    retrieval_ratio: float = 0,
+    retrieval_top_k: int = 4,
+    retrieval_n_probe: int = 8,
+    # realtime config
+    crossfade_seconds: float = 0.05,
+    additional_infer_before_seconds: float = 0.2,
+    additional_infer_after_seconds: float = 0.1,
+    block_seconds: float = 0.5,
+    version: int = 2,
+    device: str | torch.device = get_optimal_device(),
+    max_queue_blocks: int = 2,
+    fallback: Literal["silence", "passthrough"] = "silence",
+    incremental: bool = False,
+) -> stream.RealtimeSimulation:
+    """
+    Replay input_path through the same path as realtime() on a simulated clock
+    and write the output (aligned with the input) and a json report of the block timings.
+    """
+    cluster_model_path = Path(cluster_model_path) if cluster_model_path else None
+    svc_model = Svc(
+        net_g_path=Path(model_path).as_posix(),
+        config_path=Path(config_path).as_posix(),
+        cluster_model_path=(cluster_model_path.as_posix() if cluster_model_path else None),
+        device=device,
+        retrieval_index_path=retrieval_index_path,
+        retrieval_top_k=retrieval_top_k,
+        retrieval_n_probe=retrieval_n_probe,
+    )
+    sampling_rate = svc_model.target_sample
+    try:
+        process, model_latency = _create_realtime_process(
+            svc_model,
+            version=version,
+            crossfade_seconds=crossfade_seconds,
+            additional_infer_before_seconds=additional_infer_before_seconds,
+            additional_infer_after_seconds=additional_infer_after_seconds,
+            pad_seconds=pad_seconds,
+            incremental=incremental,
             speaker=speaker,
             transpose=transpose,
             auto_predict_f0=auto_predict_f0,
             cluster_infer_ratio=cluster_infer_ratio,
             noise_scale=noise_scale,
             f0_method=f0_method,
-            # slice config
+            retrieval_ratio=retrieval_ratio,
             db_thresh=db_thresh,
-            # pad_seconds=pad_seconds,
             chunk_seconds=chunk_seconds,
         )
-        if version == 1:
-            kwargs["pad_seconds"] = pad_seconds
-        with timer() as t:
-            inference = model.process(
-                **kwargs,
-            ).reshape(-1, 1)
-        if passthrough_original:
-            outdata[:] = (indata + inference) / 2
-        else:
-            outdata[:] = inference
-        rtf = t.elapsed / block_seconds
-        LOG.info(f"Realtime inference time: {t.elapsed:.3f}s, RTF: {rtf:.3f}")
-        if rtf > 1:
-            LOG.warning("RTF is too high, consider increasing block_seconds")
-
-    try:
-        with sd.Stream(
-            device=(input_device, output_device),
-            channels=1,
-            callback=callback,
-            samplerate=svc_model.target_sample,
-            blocksize=int(block_seconds * svc_model.target_sample),
-            latency="low",
-        ) as stream:
-            LOG.info(f"Latency: {stream.latency}")
-            while True:
-                sd.sleep(1000)
+        engine = stream.RealtimeEngine(process, int(block_seconds * sampling_rate), max_queue_blocks=max_queue_blocks, fallback=fallback)
+        audio, _ = librosa.load(str(input_path), sr=sampling_rate)
+        simulation = stream.simulate_realtime(engine, audio.astype(np.float32), sampling_rate, model_latency)
     finally:
-        # del model, svc_model
+        del svc_model
         torch.cuda.empty_cache()
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    soundfile.write(str(output_path), simulation.output, sampling_rate)
+    report = simulation.report()
+    LOG.info(", ".join(f"{key}: {value:.4g}" if isinstance(value, float) else f"{key}: {value}" for key, value in report.items()))
+    if report_path is not None:
+        Path(report_path).write_text(json.dumps(report, indent=2))
+    return simulation
@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import threading
+from collections import deque
+from logging import getLogger
+from typing import Any, Callable, Literal
+
+import attrs
+import numpy as np
+from cm_time import timer
+from numpy import dtype, float32, ndarray
+
+LOG = getLogger(__name__)
+
+
+class RingBuffer:
+    """
+    Single-producer single-consumer ring buffer of float32 samples.
+    The positions only grow and each is written by one side only (write_pos by the producer
+    after the samples are copied, read_pos by the consumer), so no lock is needed.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._buffer = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.write_pos = 0
+        self.read_pos = 0
+
+    def __len__(self) -> int:
+        """Number of samples which can be read."""
+        return self.write_pos - self.read_pos
+
+    @property
+    def space(self) -> int:
+        """Number of samples which can be written."""
+        return self.capacity - len(self)
+
+    def _copy(self, pos: int, data: ndarray[Any, dtype[float32]] | None, out: ndarray[Any, dtype[float32]] | None) -> None:
+        # copy data to / out from [pos, pos + n) in at most two slices
+        n = len(data if data is not None else out)  # type: ignore
+        start = pos % self.capacity
+        first = min(n, self.capacity - start)
+        if data is not None:
+            self._buffer[start : start + first] = data[:first]
+            self._buffer[: n - first] = data[first:]
+        else:
+            out[:first] = self._buffer[start : start + first]  # type: ignore
+            out[first:] = self._buffer[: n - first]  # type: ignore
+
+    def write(self, data: ndarray[Any, dtype[float32]]) -> bool:
+        """Append data if it fits entirely, return whether it was written."""
+        if len(data) > self.space:
+            return False
+        self._copy(self.write_pos, data, None)
+        self.write_pos += len(data)
+        return True
+
+    def read_into(self, out: ndarray[Any, dtype[float32]], pos: int | None = None) -> None:
+        """Copy len(out) samples from pos (defaults to read_pos) and consume everything before them."""
+        pos = self.read_pos if pos is None else pos
+        if not self.read_pos <= pos <= self.write_pos - len(out):
+            raise ValueError(f"[{pos}, {pos + len(out)}) is not in [{self.read_pos}, {self.write_pos})")
+        self._copy(pos, None, out)
+        self.read_pos = pos + len(out)
+
+    def skip(self, n: int) -> None:
+        """Consume n samples without reading them."""
+        self.read_pos += min(n, len(self))
+
+
+@attrs.define
+class RealtimeStats:
+    """Counters of RealtimeEngine. Samples are counted at the sampling rate of the stream."""
+
+    n_callbacks: int = 0
+    n_blocks: int = 0
+    # callbacks whose output was (partly) not ready and filled by the fallback
+    underruns: int = 0
+    # input blocks dropped because the input buffer was full or the worker fell behind
+    overruns: int = 0
+    # blocks processed too late to be played
+    late_blocks: int = 0
+    process_times: deque[float] = attrs.field(factory=lambda: deque(maxlen=100))
+
+    @property
+    def max_process_time(self) -> float:
+        return max(self.process_times, default=0.0)
+
+
+class RealtimeEngine:
+    """
+    Run process(block) -> converted block (of the same length) on a worker thread
+    while the audio callback only copies samples in and out of ring buffers.
+
+    The output of input sample i is played latency samples after it was captured
+    (at least block_size, since a block is processed once it is complete).
+    If the converted samples are not ready when they are due, the callback plays
+    the fallback ("silence" or "passthrough" of the input) and the late samples are dropped.
+    If more than max_queue_blocks blocks are waiting, the worker skips to the newest one.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[ndarray[Any, dtype[float32]]], ndarray[Any, dtype[float32]]],
+        block_size: int,
+        *,
+        latency: int | None = None,
+        max_queue_blocks: int = 2,
+        fallback: Literal["silence", "passthrough"] = "silence",
+    ) -> None:
+        if latency is not None and latency < block_size:
+            raise ValueError(f"latency ({latency}) must be >= block_size ({block_size})")
+        self.process = process
+        self.block_size = block_size
+        self.latency = block_size if latency is None else latency
+        self.max_queue_blocks = max_queue_blocks
+        self.fallback = fallback
+        capacity = (max_queue_blocks + 2) * block_size + self.latency
+        self.input_buffer = RingBuffer(capacity)
+        self.output_buffer = RingBuffer(capacity)
+        self.stats = RealtimeStats()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of complete input blocks waiting to be processed."""
+        return len(self.input_buffer) // self.block_size
+
+    def callback(self, indata: ndarray[Any, dtype[float32]], outdata: ndarray[Any, dtype[float32]]) -> None:
+        """Queue indata and fill outdata (both [frames]) with the output due now. O(frames), never waits."""
+        frames = len(indata)
+        self.stats.n_callbacks += 1
+        if not self.input_buffer.write(indata):
+            self.stats.overruns += 1
+        self._wake.set()
+
+        # the output of the input written `latency` samples ago
+        end = self.input_buffer.write_pos - self.latency
+        start = end - frames
+        if self.fallback == "passthrough":
+            outdata[:] = indata
+        else:
+            outdata[:] = 0
+        output = self.output_buffer
+        if output.read_pos < start:
+            n_late = min(start, output.write_pos) - output.read_pos
+            self.stats.late_blocks += -(-n_late // self.block_size)
+            output.skip(n_late)
+        low, high = max(start, output.read_pos), min(end, output.write_pos)
+        if high > low:
+            output.read_into(outdata[low - start : high - start], low)
+        if high - low < end - max(start, 0):
+            self.stats.underruns += 1
+
+    def skip_stale(self) -> int:
+        """
+        Skip the oldest input blocks if more than max_queue_blocks are waiting.
+        return the number of samples skipped, for which as many (late) output samples must be written
+        to keep the timelines of input and output aligned.
+        """
+        n_stale = max(self.queue_depth - self.max_queue_blocks, 0)
+        if n_stale > 0:
+            LOG.warning(f"Realtime inference is {n_stale} blocks behind, skipping them")
+            self.stats.overruns += n_stale
+            self.input_buffer.skip(n_stale * self.block_size)
+        return n_stale * self.block_size
+
+    def process_block(self) -> tuple[ndarray[Any, dtype[float32]], float] | None:
+        """Process the oldest complete block, return the result (not written yet) and the processing time."""
+        if len(self.input_buffer) < self.block_size:
+            return None
+        block = np.empty(self.block_size, dtype=np.float32)
+        self.input_buffer.read_into(block)
+        with timer() as t:
+            result = np.asarray(self.process(block), dtype=np.float32).reshape(-1)
+        if len(result) != self.block_size:
+            raise ValueError(f"process returned {len(result)} samples for a block of {self.block_size}")
+        self.stats.n_blocks += 1
+        self.stats.process_times.append(t.elapsed)
+        return result, t.elapsed
+
+    def process_pending(self) -> int:
+        """Process the complete blocks in the input buffer (called by the worker), return the number processed."""
+        self.output_buffer.write(np.zeros(self.skip_stale(), dtype=np.float32))
+        n_blocks = 0
+        while self.output_buffer.space >= self.block_size:
+            processed = self.process_block()
+            if processed is None:
+                break
+            self.output_buffer.write(processed[0])
+            n_blocks += 1
+        return n_blocks
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(timeout=0.1)
+            self._wake.clear()
+            try:
+                self.process_pending()
+            except Exception as e:
+                LOG.exception(e)
+
+    def start(self) -> RealtimeEngine:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="RealtimeEngine", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> RealtimeEngine:
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+
+@attrs.frozen(kw_only=True)
+class RealtimeSimulation:
+    """Result of simulate_realtime. Times are in seconds."""
+
+    # converted audio aligned with the input (delayed by latency_seconds when played)
+    output: ndarray[Any, dtype[float32]]
+    process_times: ndarray[Any, dtype[np.float64]]
+    stats: RealtimeStats
+    block_seconds: float
+    # buffering of the engine plus the model latency (if known)
+    latency_seconds: float
+    model_latency_seconds: float | None
+
+    @property
+    def rtf(self) -> float:
+        """Processing time per second of processed audio."""
+        return float(self.process_times.sum()) / max(len(self.process_times) * self.block_seconds, 1e-9)
+
+    @property
+    def missed_deadlines(self) -> int:
+        return self.stats.underruns
+
+    def report(self) -> dict[str, Any]:
+        percentiles = np.percentile(self.process_times, [50, 90, 99]) if len(self.process_times) else [0.0] * 3
+        return {
+            "n_blocks": self.stats.n_blocks,
+            "block_seconds": self.block_seconds,
+            "process_time_p50": float(percentiles[0]),
+            "process_time_p90": float(percentiles[1]),
+            "process_time_p99": float(percentiles[2]),
+            "process_time_max": float(self.process_times.max(initial=0.0)),
+            "rtf": self.rtf,
+            "missed_deadlines": self.missed_deadlines,
+            "late_blocks": self.stats.late_blocks,
+            "overruns": self.stats.overruns,
+            "latency_seconds": self.latency_seconds,
+            "model_latency_seconds": self.model_latency_seconds,
+        }
+
+
+def simulate_realtime(
+    engine: RealtimeEngine,
+    audio: ndarray[Any, dtype[float32]],
+    sampling_rate: int,
+    model_latency: int | None = None,
+) -> RealtimeSimulation:
+    """
+    Replay audio through engine on a simulated clock instead of an audio device.
+    The callback of block i runs at i * block_seconds. The worker processes one block at a time
+    (for the measured processing time) as soon as it is free and a block is queued,
+    and each output becomes visible to the callbacks once its processing has finished.
+    model_latency (samples) is the delay the process function adds itself, if it is known.
+    """
+    block_size = engine.block_size
+    block_seconds = block_size / sampling_rate
+    latency = engine.latency + (model_latency or 0)
+    n_callbacks = -(-(len(audio) + latency) // block_size)
+    input_audio = np.zeros(n_callbacks * block_size, dtype=np.float32)
+    input_audio[: len(audio)] = audio
+    output = np.zeros_like(input_audio)
+
+    process_times: list[float] = []
+    worker_time = 0.0
+    # outputs being processed: (time processing finishes, result)
+    pending: deque[tuple[float, ndarray[Any, dtype[float32]]]] = deque()
+    for i in range(n_callbacks):
+        now = i * block_seconds
+        while pending and pending[0][0] <= now:
+            engine.output_buffer.write(pending.popleft()[1])
+        engine.callback(input_audio[i * block_size : (i + 1) * block_size], output[i * block_size : (i + 1) * block_size])
+
+        # the worker starts the next block once it is free, until the next callback
+        worker_time = max(worker_time, now)
+        while worker_time < now + block_seconds:
+            n_skipped = engine.skip_stale()
+            if n_skipped:
+                pending.append((worker_time, np.zeros(n_skipped, dtype=np.float32)))
+            processed = engine.process_block()
+            if processed is None:
+                break
+            result, elapsed = processed
+            process_times.append(elapsed)
+            worker_time += elapsed
+            pending.append((worker_time, result))
+    return RealtimeSimulation(
+        output=output[latency : latency + len(audio)],
+        process_times=np.array(process_times),
+        stats=engine.stats,
+        block_seconds=block_seconds,
+        latency_seconds=latency / sampling_rate,
+        model_latency_seconds=None if model_latency is None else model_latency / sampling_rate,
+    )
@@ -32,13 +32,17 @@ class F0Decoder(nn.Module):
         self.f0_prenet = nn.Conv1d(1, hidden_channels, 3, padding=1)
         self.cond = nn.Conv1d(spk_channels, hidden_channels, 1)
 
-    def forward(self, x, norm_f0, x_mask, spk_emb=None):
+    def forward(self, x, norm_f0, x_mask, spk_emb=None, spk_cond=None):
+        """spk_cond: cond(spk_emb) if it is precomputed"""
         x = torch.detach(x)
-        if spk_emb is not None:
+        if spk_cond is not None:
+            x = x + spk_cond
+        elif spk_emb is not None:
             spk_emb = torch.detach(spk_emb)
             x = x + self.cond(spk_emb)
         x += self.f0_prenet(norm_f0)
-        x = self.prenet(x) * x_mask
+        # padded frames would leak into the last frames through the kernel of prenet
+        x = self.prenet(x * x_mask) * x_mask
         x = self.decoder(x * x_mask, x_mask)
         x = self.proj(x) * x_mask
         return x
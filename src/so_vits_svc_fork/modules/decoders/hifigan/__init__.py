@@ -1,3 +1,4 @@
 from ._models import NSFHifiGANGenerator
+from ._streaming import NSFHifiGANStream
 
-__all__ = ["NSFHifiGANGenerator"]
+__all__ = ["NSFHifiGANGenerator", "NSFHifiGANStream"]
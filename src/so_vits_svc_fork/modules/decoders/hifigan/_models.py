@@ -59,19 +59,40 @@ class SineGen(torch.nn.Module):
         uv = (f0 > self.voiced_threshold).type(torch.float32)
         return uv
 
-    def _f02sine(self, f0_values):
+    def initial_phase(self, batch_size, device=None):
+        """random initial phase (in cycles) of each harmonic, 0 for the fundamental: (batchsize, dim)"""
+        phase = torch.rand(batch_size, self.dim, device=device)
+        phase[:, 0] = 0
+        return phase
+
+    def advance_phase(self, f0, phase):
+        """
+        phase after f0 (batchsize, length, 1) from phase (batchsize, dim),
+        the phase forward(f0, phase) returns without generating the sines
+        (accumulated in float64 on the CPU)
+        """
+        fn = torch.multiply(f0, torch.arange(1, self.harmonic_num + 2).to(f0.device).to(f0.dtype))
+        rad_values = ((fn / self.sampling_rate) % 1).to("cpu", torch.float64)
+        phase = (phase.to("cpu", torch.float64) + rad_values.sum(dim=1)) % 1
+        return phase.to(f0.device, torch.float32)
+
+    def _f02sine(self, f0_values, phase=None):
         """
         f0_values: (batchsize, length, dim)
         where dim indicates fundamental tone and overtones
+        phase: (batchsize, dim) initial phase in cycles, random (0 for the fundamental) if None
+        return sines: (batchsize, length, dim), phase after the last step: (batchsize, dim)
         """
         # convert to F0 in rad. The integer part n can be ignored
         # because 2 * np.pi * n doesn't affect phase
         rad_values = (f0_values / self.sampling_rate) % 1
 
         # initial phase noise (no noise for fundamental component)
-        rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
-        rand_ini[:, 0] = 0
-        rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
+        if phase is None:
+            phase = self.initial_phase(f0_values.shape[0], f0_values.device)
+        elif self.flag_for_pulse:
+            raise ValueError("phase is not supported with flag_for_pulse")
+        rad_values[:, 0, :] = rad_values[:, 0, :] + phase
 
         # instantanouse phase sine[t] = sin(2*pi \sum_i=1 ^{t} rad)
         if not self.flag_for_pulse:
@@ -86,7 +107,8 @@ class SineGen(torch.nn.Module):
             cumsum_shift = torch.zeros_like(rad_values)
             cumsum_shift[:, 1:, :] = tmp_over_one_idx * -1.0
 
-            sines = torch.sin(torch.cumsum(rad_values + cumsum_shift, dim=1) * 2 * np.pi)
+            i_phase = torch.cumsum(rad_values + cumsum_shift, dim=1)
+            sines = torch.sin(i_phase * 2 * np.pi)
         else:
             # If necessary, make sure that the first time step of every
             # voiced segments is sin(pi) or cos(0)
@@ -115,15 +137,18 @@ class SineGen(torch.nn.Module):
 
             # get the sines
             sines = torch.cos(i_phase * 2 * np.pi)
-        return sines
+        return sines, i_phase[:, -1, :] % 1
 
-    def forward(self, f0):
+    def forward(self, f0, phase=None):
         """
-        sine_tensor, uv = forward(f0)
+        sine_tensor, uv, noise, phase = forward(f0, phase)
         input F0: tensor(batchsize=1, length, dim=1)
                   f0 for unvoiced steps should be 0
+        input phase: tensor(batchsize=1, dim) initial phase (in cycles) of each harmonic,
+                     pass the returned phase to continue the sines in the next call
         output sine_tensor: tensor(batchsize=1, length, dim)
         output uv: tensor(batchsize=1, length, 1)
+        output phase: tensor(batchsize=1, dim)
         """
         with torch.no_grad():
             # f0_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim, device=f0.device)
@@ -134,7 +159,8 @@ class SineGen(torch.nn.Module):
             fn = torch.multiply(f0, torch.arange(1, self.harmonic_num + 2).to(f0.device).to(f0.dtype))
 
             # generate sine waveforms
-            sine_waves = self._f02sine(fn) * self.sine_amp
+            sine_waves, phase = self._f02sine(fn, phase)
+            sine_waves = sine_waves * self.sine_amp
 
             # generate uv signal
             # uv = torch.ones(f0.shape)
@@ -150,7 +176,7 @@ class SineGen(torch.nn.Module):
             # first: set the unvoiced part to 0 by uv
             # then: additive noise
             sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+        return sine_waves, uv, noise, phase
 
 
 class SourceModuleHnNSF(torch.nn.Module):
@@ -165,11 +191,13 @@ class SourceModuleHnNSF(torch.nn.Module):
         note that amplitude of noise in unvoiced is decided
         by sine_amp
     voiced_threshold: threshold to set U/V given F0 (default: 0)
-    Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
+    Sine_source, noise_source, uv, phase = SourceModuleHnNSF(F0_sampled, phase)
     F0_sampled (batchsize, length, 1)
+    phase (batchsize, harmonic_num + 1) initial phase of the sines (random if None)
     Sine_source (batchsize, length, 1)
     noise_source (batchsize, length 1)
     uv (batchsize, length, 1)
+    phase (batchsize, harmonic_num + 1) phase after the last step, to continue the sines
     """
 
     def __init__(
@@ -192,20 +220,20 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, phase=None):
         """
-        Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
+        Sine_source, noise_source, uv, phase = SourceModuleHnNSF(F0_sampled, phase)
         F0_sampled (batchsize, length, 1)
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
         """
         # source for harmonic branch
-        sine_wavs, uv, _ = self.l_sin_gen(x)
+        sine_wavs, uv, _, phase = self.l_sin_gen(x, phase)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
 
         # source for noise branch, in the same shape as uv
         noise = torch.randn_like(uv) * self.sine_amp / 3
-        return sine_merge, noise, uv
+        return sine_merge, noise, uv, phase
 
 
 class NSFHifiGANGenerator(torch.nn.Module):
@@ -258,14 +286,26 @@ class NSFHifiGANGenerator(torch.nn.Module):
         self.conv_post.apply(init_weights)
         self.cond = nn.Conv1d(h["gin_channels"], h["upsample_initial_channel"], 1)
 
-    def forward(self, x, f0, g=None):
+    def advance_phase(self, f0, phase, n_samples):
+        """
+        phase: [B, harmonic_num + 1] of the source after the first n_samples samples
+        of f0: [B, T] (frames) decoded from phase, see SineGen.advance_phase
+        """
+        f0 = self.f0_upsamp(f0[:, None]).transpose(1, 2)[:, : max(n_samples, 0)]
+        return self.m_source.l_sin_gen.advance_phase(f0, phase)
+
+    def forward(self, x, f0, g=None, phase=None, g_cond=None):
+        """
+        phase: [B, harmonic_num + 1] initial phase of the sines of the source (random if None)
+        g_cond: cond(g) if it is precomputed
+        """
         # LOG.info(1,x.shape,f0.shape,f0[:, None].shape)
         f0 = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
         # LOG.info(2,f0.shape)
-        har_source, noi_source, uv = self.m_source(f0)
+        har_source, noi_source, uv, _ = self.m_source(f0, phase)
         har_source = har_source.transpose(1, 2)
         x = self.conv_pre(x)
-        x = x + self.cond(g)
+        x = x + (self.cond(g) if g_cond is None else g_cond)
         # LOG.info(124,x.shape,har_source.shape)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
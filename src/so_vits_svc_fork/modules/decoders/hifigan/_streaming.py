@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from ...modules import LRELU_SLOPE, ResBlock1, ResBlock2
+from ._models import NSFHifiGANGenerator
+
+# The decoder is applied to a stream of frames block by block. Every layer keeps the
+# input it has not consumed yet (its left context), so that the output of all blocks
+# is the output of NSFHifiGANGenerator.forward on the whole stream, each sample
+# delayed until its right context has arrived. Output sample 0 of every layer is
+# output sample 0 of the whole stream, so branches are aligned by counting samples.
+# Each layer tracks its lag: how many output samples it is behind its input after
+# lag_in input samples of lag (for input lengths which are multiples of the strides).
+
+
+def _check_weight_norm(module: nn.Module) -> None:
+    if hasattr(module, "weight_g") or hasattr(module, "parametrizations"):
+        raise ValueError("remove weight norm before streaming (remove_weight_norm)")
+
+
+class _StreamingConv1d:
+    """Conv1d which keeps the last input samples needed by the next outputs."""
+
+    def __init__(self, conv: nn.Conv1d, lag_in: int = 0) -> None:
+        _check_weight_norm(conv)
+        self.conv = conv
+        self.padding = conv.padding[0]
+        self.stride = conv.stride[0]
+        self.receptive_field = conv.dilation[0] * (conv.kernel_size[0] - 1) + 1
+        self.lag = -((self.padding - self.receptive_field - lag_in) // self.stride) - 1
+        self.buffer: torch.Tensor | None = None
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.buffer is None:
+            # the left padding of the whole stream
+            self.buffer = x.new_zeros(x.shape[0], x.shape[1], self.padding)
+        buffer = torch.cat([self.buffer, x], dim=-1)
+        n_out = (buffer.shape[-1] - self.receptive_field) // self.stride + 1
+        conv = self.conv
+        if n_out <= 0:
+            self.buffer = buffer
+            return x.new_zeros(x.shape[0], conv.out_channels, 0)
+        y = F.conv1d(
+            buffer[..., : (n_out - 1) * self.stride + self.receptive_field],
+            conv.weight,
+            conv.bias,
+            conv.stride,
+            0,
+            conv.dilation,
+            conv.groups,
+        )
+        self.buffer = buffer[..., n_out * self.stride :]
+        return y
+
+
+class _StreamingConvTranspose1d:
+    """ConvTranspose1d by overlap-add, which keeps the contributions to the next outputs."""
+
+    def __init__(self, conv: nn.ConvTranspose1d, lag_in: int = 0) -> None:
+        _check_weight_norm(conv)
+        self.conv = conv
+        self.stride = conv.stride[0]
+        self.padding = conv.padding[0]
+        self.lag = lag_in * self.stride + self.padding
+        self.carry: torch.Tensor | None = None
+        self.n_skip = self.padding
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        conv = self.conv
+        if x.shape[-1] == 0:
+            return x.new_zeros(x.shape[0], conv.out_channels, 0)
+        y = F.conv_transpose1d(x, conv.weight, None, conv.stride, 0, 0, conv.groups, conv.dilation)
+        if self.carry is not None:
+            y[..., : self.carry.shape[-1]] += self.carry
+        # samples after n_in * stride still receive contributions from the next inputs
+        n_done = x.shape[-1] * self.stride
+        self.carry = y[..., n_done:]
+        y = y[..., self.n_skip : n_done]
+        self.n_skip = max(self.n_skip - n_done, 0)
+        if conv.bias is not None:
+            y = y + conv.bias[:, None]
+        return y
+
+
+class _StreamingSum:
+    """Sum of streams which are aligned at their first sample but produced with different lags."""
+
+    def __init__(self, lags: Sequence[int]) -> None:
+        self.lag = max(lags)
+        self.pending: list[torch.Tensor | None] = [None] * len(lags)
+
+    def __call__(self, *xs: torch.Tensor) -> torch.Tensor:
+        pending = [x if p is None else torch.cat([p, x], dim=-1) for p, x in zip(self.pending, xs)]
+        n = min(p.shape[-1] for p in pending)
+        self.pending = [p[..., n:] for p in pending]
+        y = pending[0][..., :n]
+        for p in pending[1:]:
+            y = y + p[..., :n]
+        return y
+
+
+class _StreamingResBlock:
+    """ResBlock1 or ResBlock2 (without x_mask)."""
+
+    def __init__(self, block: ResBlock1 | ResBlock2, lag_in: int) -> None:
+        self.block = block
+        convs = list(zip(block.convs1, block.convs2)) if isinstance(block, ResBlock1) else [(c,) for c in block.convs]
+        self.layers: list[tuple[list[_StreamingConv1d], _StreamingSum]] = []
+        lag = lag_in
+        for convs_ in convs:
+            streaming_convs = []
+            conv_lag = lag
+            for conv in convs_:
+                streaming_convs.append(_StreamingConv1d(conv, conv_lag))
+                conv_lag = streaming_convs[-1].lag
+            residual = _StreamingSum([conv_lag, lag])
+            self.layers.append((streaming_convs, residual))
+            lag = residual.lag
+        self.lag = lag
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        for convs, residual in self.layers:
+            xt = x
+            for conv in convs:
+                xt = conv(F.leaky_relu(xt, LRELU_SLOPE))
+            x = residual(xt, x)
+        return x
+
+
+class NSFHifiGANStream:
+    """
+    Decode a stream of latent frames with NSFHifiGANGenerator block by block,
+    without recomputing any overlap between the blocks.
+    The sines of the source continue their phase across the blocks.
+    After n frames, n * hop_size - latency samples have been returned in total,
+    equal to the first samples of generator(x, f0, g) on all the frames at once
+    (up to the random noise of the source and floating point errors).
+    The weight norm of the generator must have been removed.
+    """
+
+    def __init__(self, generator: NSFHifiGANGenerator) -> None:
+        self.generator = generator
+        self.hop_size = int(generator.f0_upsamp.scale_factor)
+        self.reset()
+
+    def reset(self) -> None:
+        generator = self.generator
+        self.conv_pre = _StreamingConv1d(generator.conv_pre)
+        lag = self.conv_pre.lag
+        self.ups: list[_StreamingConvTranspose1d] = []
+        self.noise_convs: list[_StreamingConv1d] = []
+        self.sources: list[_StreamingSum] = []
+        self.resblocks: list[list[_StreamingResBlock]] = []
+        self.resblock_sums: list[_StreamingSum] = []
+        for i in range(generator.num_upsamples):
+            self.ups.append(_StreamingConvTranspose1d(generator.ups[i], lag))
+            # the source is not delayed before the noise convs
+            self.noise_convs.append(_StreamingConv1d(generator.noise_convs[i], 0))
+            self.sources.append(_StreamingSum([self.ups[i].lag, self.noise_convs[i].lag]))
+            lag = self.sources[i].lag
+            resblocks = [_StreamingResBlock(generator.resblocks[i * generator.num_kernels + j], lag) for j in range(generator.num_kernels)]
+            self.resblocks.append(resblocks)
+            self.resblock_sums.append(_StreamingSum([resblock.lag for resblock in resblocks]))
+            lag = self.resblock_sums[i].lag
+        self.conv_post = _StreamingConv1d(generator.conv_post, lag)
+        self.phase: torch.Tensor | None = None
+
+    @property
+    def latency(self) -> int:
+        """Number of samples the output is behind the input frames."""
+        return self.conv_post.lag
+
+    @torch.no_grad()
+    def __call__(self, x: torch.Tensor, f0: torch.Tensor, g: torch.Tensor, g_cond: torch.Tensor | None = None) -> torch.Tensor:
+        """
+        x: [B, inter_channels, T], f0: [B, T], g: [B, gin_channels, 1] (the same in all calls),
+        g_cond: generator.cond(g) if it is precomputed
+        return the next samples of the stream: [B, 1, t]
+        """
+        generator = self.generator
+        f0 = generator.f0_upsamp(f0[:, None]).transpose(1, 2)
+        har_source, _, _, self.phase = generator.m_source(f0, self.phase)
+        har_source = har_source.transpose(1, 2)
+        x = self.conv_pre(x)
+        x = x + (generator.cond(g) if g_cond is None else g_cond)
+        for i in range(generator.num_upsamples):
+            x = F.leaky_relu(x, LRELU_SLOPE)
+            x = self.ups[i](x)
+            x = self.sources[i](x, self.noise_convs[i](har_source))
+            x = self.resblock_sums[i](*(resblock(x) for resblock in self.resblocks[i])) / generator.num_kernels
+        x = F.leaky_relu(x)
+        x = self.conv_post(x)
+        return torch.tanh(x)
@@ -3,11 +3,12 @@ from ._generators import (
     Multistream_iSTFT_Generator,
     iSTFT_Generator,
 )
-from ._loss import subband_stft_loss
+from ._loss import get_subband_stft_loss, subband_stft_loss
 from ._pqmf import PQMF
 
 __all__ = [
     "PQMF",
+    "get_subband_stft_loss",
     "Multiband_iSTFT_Generator",
     "Multistream_iSTFT_Generator",
     "iSTFT_Generator",
@@ -151,15 +151,14 @@ class Multiband_iSTFT_Generator(torch.nn.Module):
 
         self.gen_istft_n_fft = gen_istft_n_fft
         self.gen_istft_hop_size = gen_istft_hop_size
-
-    def forward(self, x, g=None):
-        stft = TorchSTFT(
+        self.stft = TorchSTFT(
             filter_length=self.gen_istft_n_fft,
             hop_length=self.gen_istft_hop_size,
             win_length=self.gen_istft_n_fft,
-        ).to(x.device)
-        pqmf = PQMF(x.device, subbands=self.subbands).to(x.device, dtype=x.dtype)
+        )
+        self.pqmf = PQMF(subbands=self.subbands)
 
+    def forward(self, x, g=None):
         x = self.conv_pre(x)  # [B, ch, length]
 
         for i in range(self.num_upsamples):
@@ -182,7 +181,7 @@ class Multiband_iSTFT_Generator(torch.nn.Module):
         spec = torch.exp(x[:, :, : self.post_n_fft // 2 + 1, :])
         phase = math.pi * torch.sin(x[:, :, self.post_n_fft // 2 + 1 :, :])
 
-        y_mb_hat = stft.inverse(
+        y_mb_hat = self.stft.inverse(
             torch.reshape(
                 spec,
                 (
@@ -203,7 +202,7 @@ class Multiband_iSTFT_Generator(torch.nn.Module):
         y_mb_hat = torch.reshape(y_mb_hat, (x.shape[0], self.subbands, 1, y_mb_hat.shape[-1]))
         y_mb_hat = y_mb_hat.squeeze(-2)
 
-        y_g_hat = pqmf.synthesis(y_mb_hat)
+        y_g_hat = self.pqmf.synthesis(y_mb_hat)
 
         return y_g_hat, y_mb_hat
 
@@ -276,15 +275,13 @@ class Multistream_iSTFT_Generator(torch.nn.Module):
         self.register_buffer("updown_filter", updown_filter)
         self.multistream_conv_post = weight_norm(Conv1d(self.subbands, 1, kernel_size=63, bias=False, padding=get_padding(63, 1)))
         self.multistream_conv_post.apply(init_weights)
-
-    def forward(self, x, g=None):
-        stft = TorchSTFT(
+        self.stft = TorchSTFT(
             filter_length=self.gen_istft_n_fft,
             hop_length=self.gen_istft_hop_size,
             win_length=self.gen_istft_n_fft,
-        ).to(x.device)
-        # pqmf = PQMF(x.device)
+        )
 
+    def forward(self, x, g=None):
         x = self.conv_pre(x)  # [B, ch, length]
 
         for i in range(self.num_upsamples):
@@ -307,7 +304,7 @@ class Multistream_iSTFT_Generator(torch.nn.Module):
         spec = torch.exp(x[:, :, : self.post_n_fft // 2 + 1, :])
         phase = math.pi * torch.sin(x[:, :, self.post_n_fft // 2 + 1 :, :])
 
-        y_mb_hat = stft.inverse(
+        y_mb_hat = self.stft.inverse(
             torch.reshape(
                 spec,
                 (
@@ -1,8 +1,14 @@
 from ._stft_loss import MultiResolutionSTFTLoss
 
 
-def subband_stft_loss(h, y_mb, y_hat_mb):
-    sub_stft_loss = MultiResolutionSTFTLoss(h.train.fft_sizes, h.train.hop_sizes, h.train.win_lengths)
+def get_subband_stft_loss(h):
+    return MultiResolutionSTFTLoss(h.train.fft_sizes, h.train.hop_sizes, h.train.win_lengths)
+
+
+def subband_stft_loss(h, y_mb, y_hat_mb, sub_stft_loss=None):
+    """sub_stft_loss: get_subband_stft_loss(h), built again if None"""
+    if sub_stft_loss is None:
+        sub_stft_loss = get_subband_stft_loss(h)
     y_mb = y_mb.view(-1, y_mb.size(2))
     y_hat_mb = y_hat_mb.view(-1, y_hat_mb.size(2))
     sub_sc_loss, sub_mag_loss = sub_stft_loss(y_hat_mb[:, : y_mb.size(-1)], y_mb)
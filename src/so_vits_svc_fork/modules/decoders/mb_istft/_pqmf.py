@@ -51,11 +51,13 @@ class PQMF(torch.nn.Module):
         https://ieeexplore.ieee.org/document/258122
     """
 
-    def __init__(self, device, subbands=8, taps=62, cutoff_ratio=0.15, beta=9.0):
+    def __init__(self, device=None, subbands=8, taps=62, cutoff_ratio=0.15, beta=9.0):
         """
         Initialize PQMF module.
+        The filters are buffers which are not saved (they only depend on the arguments).
 
         Args:
+            device (torch.device): Device of the filters (they move with the module).
             subbands (int): The number of subbands.
             taps (int): The number of filter taps.
             cutoff_ratio (float): Cut-off frequency ratio.
@@ -81,14 +83,14 @@ class PQMF(torch.nn.Module):
         synthesis_filter = torch.from_numpy(h_synthesis).float().unsqueeze(0).to(device)
 
         # register coefficients as buffer
-        self.register_buffer("analysis_filter", analysis_filter)
-        self.register_buffer("synthesis_filter", synthesis_filter)
+        self.register_buffer("analysis_filter", analysis_filter, persistent=False)
+        self.register_buffer("synthesis_filter", synthesis_filter, persistent=False)
 
         # filter for downsampling & upsampling
         updown_filter = torch.zeros((subbands, subbands, subbands)).float().to(device)
         for k in range(subbands):
             updown_filter[k, k, 0] = 1.0
-        self.register_buffer("updown_filter", updown_filter)
+        self.register_buffer("updown_filter", updown_filter, persistent=False)
         self.subbands = subbands
 
         # keep padding info
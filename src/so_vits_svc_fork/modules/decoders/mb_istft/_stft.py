@@ -196,7 +196,18 @@ class TorchSTFT(torch.nn.Module):
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
-        self.window = torch.from_numpy(get_window(window, win_length, fftbins=True).astype(np.float32))
+        # the windows and the basis are not saved, they only depend on the arguments
+        window_ = get_window(window, win_length, fftbins=True).astype(np.float32)
+        self.register_buffer("window", torch.from_numpy(window_), persistent=False)
+
+        # inverse real DFT basis for exporting inverse() without complex tensors
+        window_padded = pad_center(window_, size=filter_length)
+        n = np.arange(filter_length)
+        k = np.arange(filter_length // 2 + 1)[:, None]
+        scale = np.where((k == 0) | (k * 2 == filter_length), 1.0, 2.0) / filter_length * window_padded
+        inverse_basis = np.concatenate([scale * np.cos(2 * np.pi * k * n / filter_length), -scale * np.sin(2 * np.pi * k * n / filter_length)])
+        self.register_buffer("inverse_basis", torch.from_numpy(inverse_basis[:, None, :].astype(np.float32)), persistent=False)
+        self.register_buffer("window_padded", torch.from_numpy(window_padded.astype(np.float32)), persistent=False)
 
     def transform(self, input_data):
         forward_transform = torch.stft(
@@ -211,6 +222,8 @@ class TorchSTFT(torch.nn.Module):
         return torch.abs(forward_transform), torch.angle(forward_transform)
 
     def inverse(self, magnitude, phase):
+        if torch.onnx.is_in_onnx_export():
+            return self.inverse_conv(magnitude, phase)
         inverse_transform = torch.istft(
             magnitude * torch.exp(phase * 1j),
             self.filter_length,
@@ -221,6 +234,22 @@ class TorchSTFT(torch.nn.Module):
 
         return inverse_transform.unsqueeze(-2)  # unsqueeze to stay consistent with conv_transpose1d implementation
 
+    def inverse_conv(self, magnitude, phase):
+        """Same as inverse() (torch.istft with center=True) using only real-valued transposed convolutions."""
+        inverse_basis = self.inverse_basis.to(magnitude)
+        inverse_transform = F.conv_transpose1d(
+            torch.cat([magnitude * torch.cos(phase), magnitude * torch.sin(phase)], dim=1),
+            inverse_basis,
+            stride=self.hop_length,
+        )
+        window_envelope = F.conv_transpose1d(
+            torch.ones_like(magnitude[:1, :1, :]),
+            (self.window_padded.to(magnitude) ** 2)[None, None, :],
+            stride=self.hop_length,
+        )
+        inverse_transform = inverse_transform / window_envelope
+        return inverse_transform[:, :, self.filter_length // 2 : -(self.filter_length // 2)]
+
     def forward(self, input_data):
         self.magnitude, self.phase = self.transform(input_data)
         reconstruction = self.inverse(self.magnitude, self.phase)
@@ -38,11 +38,18 @@ class ResidualCouplingBlock(nn.Module):
             )
             self.flows.append(modules.Flip())
 
-    def forward(self, x, x_mask, g=None, reverse=False):
+    def get_cond(self, g):
+        """The projections of g of each flow (None for the flips), see forward"""
+        return [flow.enc.cond_layer(g) if isinstance(flow, modules.ResidualCouplingLayer) else None for flow in self.flows]
+
+    def forward(self, x, x_mask, g=None, reverse=False, g_conds=None):
+        """g_conds: get_cond(g) if it is precomputed"""
+        if g_conds is None:
+            g_conds = [None] * len(self.flows)
         if not reverse:
-            for flow in self.flows:
-                x, _ = flow(x, x_mask, g=g, reverse=reverse)
+            for flow, g_cond in zip(self.flows, g_conds):
+                x, _ = flow(x, x_mask, g=g, reverse=reverse, g_cond=g_cond)
         else:
-            for flow in reversed(self.flows):
-                x = flow(x, x_mask, g=g, reverse=reverse)
+            for flow, g_cond in reversed(list(zip(self.flows, g_conds))):
+                x = flow(x, x_mask, g=g, reverse=reverse, g_cond=g_cond)
         return x
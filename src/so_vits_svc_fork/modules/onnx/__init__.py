@@ -0,0 +1,3 @@
+from ._export import SynthesizerInfer, export_synthesizer, onnx_export
+
+__all__ = ["SynthesizerInfer", "export_synthesizer", "onnx_export"]
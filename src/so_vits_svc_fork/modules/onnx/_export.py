@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from logging import getLogger
+from pathlib import Path
+
+import torch
+from torch import nn
+
+from ... import utils
+from ..synthesizers import SynthesizerTrn
+
+LOG = getLogger(__name__)
+
+INPUT_NAMES = ["c", "f0", "uv", "sid", "noise_scale", "c_lengths"]
+OUTPUT_NAMES = ["audio"]
+
+
+class SynthesizerInfer(nn.Module):
+    """
+    SynthesizerTrn.infer as forward() for tracing.
+    c: [B, C, T], f0: [B, T], uv: [B, T], sid: [B, 1], noise_scale: [B, 1, 1], c_lengths: [B]
+    return audio: [B, T * hop_length]
+    """
+
+    def __init__(self, net_g: SynthesizerTrn, predict_f0: bool = False) -> None:
+        super().__init__()
+        self.net_g = net_g
+        self.predict_f0 = predict_f0
+
+    def forward(
+        self,
+        c: torch.Tensor,
+        f0: torch.Tensor,
+        uv: torch.Tensor,
+        sid: torch.Tensor,
+        noise_scale: torch.Tensor,
+        c_lengths: torch.Tensor,
+    ) -> torch.Tensor:
+        return self.net_g.infer(
+            c,
+            f0=f0,
+            uv=uv,
+            g=sid,
+            noice_scale=noise_scale,
+            predict_f0=self.predict_f0,
+            c_lengths=c_lengths,
+        )[:, 0]
+
+
+def export_synthesizer(
+    net_g: SynthesizerTrn,
+    output_path: Path | str,
+    *,
+    ssl_dim: int,
+    predict_f0: bool = False,
+    opset_version: int = 17,
+    n_frames: int = 100,
+) -> None:
+    """Export net_g (in eval mode, weight norm removed) with dynamic batch and time axes."""
+    device = next(net_g.parameters()).device
+    c = torch.randn(1, ssl_dim, n_frames, device=device)
+    f0 = torch.full((1, n_frames), 440.0, device=device)
+    uv = torch.ones(1, n_frames, device=device)
+    sid = torch.zeros(1, 1, dtype=torch.long, device=device)
+    noise_scale = torch.full((1, 1, 1), 0.4, device=device)
+    c_lengths = torch.full((1,), n_frames, dtype=torch.long, device=device)
+    with torch.no_grad():
+        torch.onnx.export(
+            SynthesizerInfer(net_g, predict_f0=predict_f0).eval(),
+            (c, f0, uv, sid, noise_scale, c_lengths),
+            Path(output_path).as_posix(),
+            input_names=INPUT_NAMES,
+            output_names=OUTPUT_NAMES,
+            dynamic_axes={
+                "c": {0: "batch", 2: "frames"},
+                "f0": {0: "batch", 1: "frames"},
+                "uv": {0: "batch", 1: "frames"},
+                "sid": {0: "batch"},
+                "noise_scale": {0: "batch"},
+                "c_lengths": {0: "batch"},
+                "audio": {0: "batch", 1: "samples"},
+            },
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+    import onnx
+
+    model = onnx.load(Path(output_path).as_posix())
+    onnx.helper.set_model_props(model, {"predict_f0": str(predict_f0)})
+    onnx.save(model, Path(output_path).as_posix())
+
+
+def onnx_export(
+    input_path: Path | str,
+    output_path: Path | str,
+    config_path: Path | str,
+    device: torch.device | str = "cpu",
+    predict_f0: bool = False,
+    opset_version: int = 17,
+) -> None:
+    hps = utils.get_hparams(config_path)
+    net_g = SynthesizerTrn(
+        hps.data.filter_length // 2 + 1,
+        hps.train.segment_size // hps.data.hop_length,
+        **hps.model,
+    )
+    _ = utils.load_checkpoint(input_path, net_g, None)
+    _ = net_g.eval()
+    for m in net_g.modules():
+        utils.remove_weight_norm_if_exists(m)
+    _ = net_g.to(device)
+    export_synthesizer(
+        net_g,
+        output_path,
+        ssl_dim=hps.model.ssl_dim,
+        predict_f0=predict_f0,
+        opset_version=opset_version,
+    )
+    LOG.info(f"Exported {input_path} to {output_path}")
@@ -1,7 +1,9 @@
+from __future__ import annotations
+
 import warnings
 from collections.abc import Sequence
 from logging import getLogger
-from typing import Any, Literal
+from typing import Any, Literal, NamedTuple
 
 import torch
 from torch import nn
@@ -22,6 +24,35 @@ from so_vits_svc_fork.modules.flows import ResidualCouplingBlock
 LOG = getLogger(__name__)
 
 
+class SpeakerConditioning(NamedTuple):
+    """The tensors SynthesizerTrn.infer derives from the speaker embedding (see get_speaker_conditioning)."""
+
+    # speaker embedding: [B, gin_channels, 1]
+    g: torch.Tensor
+    # cond_layer(g) of each flow, None for the flips
+    flow: list[torch.Tensor | None]
+    # dec.cond(g), None for MB-iSTFT decoders
+    dec: torch.Tensor | None
+    # f0_decoder.cond(g)
+    f0_decoder: torch.Tensor
+
+    @classmethod
+    def cat(cls, conds: Sequence[SpeakerConditioning]) -> SpeakerConditioning:
+        """Concatenate the conditionings of the items of a batch."""
+        if len(conds) == 1:
+            return conds[0]
+
+        def cat_or_none(tensors: Sequence[Any]) -> Any:
+            return None if tensors[0] is None else torch.cat(list(tensors))
+
+        return cls(
+            g=cat_or_none([cond.g for cond in conds]),
+            flow=[cat_or_none(flows) for flows in zip(*(cond.flow for cond in conds))],
+            dec=cat_or_none([cond.dec for cond in conds]),
+            f0_decoder=cat_or_none([cond.f0_decoder for cond in conds]),
+        )
+
+
 class SynthesizerTrn(nn.Module):
     """
     Synthesizer for Training
@@ -199,24 +230,57 @@ class SynthesizerTrn(nn.Module):
             lf0,
         )
 
-    def infer(self, c, f0, uv, g=None, noice_scale=0.35, predict_f0=False):
-        c_lengths = (torch.ones(c.size(0)) * c.size(-1)).to(c.device)
+    def get_speaker_conditioning(self, g):
+        """
+        Everything infer() computes from the speaker ids g: [B, 1] alone,
+        to be passed as cond to infer() as long as the speakers and the weights are the same.
+        """
         g = self.emb_g(g).transpose(1, 2)
+        return SpeakerConditioning(
+            g=g,
+            flow=self.flow.get_cond(g),
+            dec=None if self.mb else self.dec.cond(g),
+            f0_decoder=self.f0_decoder.cond(g),
+        )
+
+    def infer_latent(self, c, f0, uv, g=None, noice_scale=0.35, predict_f0=False, c_lengths=None, cond=None):
+        """
+        Everything of infer() but the decoder.
+        return z (masked): [B, inter_channels, T], f0 (predicted if predict_f0): [B, T], g: [B, gin_channels, 1]
+        """
+        if c_lengths is None:
+            c_lengths = (torch.ones(c.size(0)) * c.size(-1)).to(c.device)
+        if cond is None:
+            cond = self.get_speaker_conditioning(g)
+        g = cond.g
         x_mask = torch.unsqueeze(commons.sequence_mask(c_lengths, c.size(2)), 1).to(c.dtype)
         x = self.pre(c) * x_mask + self.emb_uv(uv.long()).transpose(1, 2)
 
         if predict_f0:
             lf0 = 2595.0 * torch.log10(1.0 + f0.unsqueeze(1) / 700.0) / 500
             norm_lf0 = so_vits_svc_fork.f0.normalize_f0(lf0, x_mask, uv, random_scale=False)
-            pred_lf0 = self.f0_decoder(x, norm_lf0, x_mask, spk_emb=g)
+            pred_lf0 = self.f0_decoder(x, norm_lf0, x_mask, spk_emb=g, spk_cond=cond.f0_decoder)
             f0 = (700 * (torch.pow(10, pred_lf0 * 500 / 2595) - 1)).squeeze(1)
 
         z_p, m_p, logs_p, c_mask = self.enc_p(x, x_mask, f0=f0_to_coarse(f0), noice_scale=noice_scale)
-        z = self.flow(z_p, c_mask, g=g, reverse=True)
+        z = self.flow(z_p, c_mask, g=g, reverse=True, g_conds=cond.flow)
+        return z * c_mask, f0, g
+
+    def infer(self, c, f0, uv, g=None, noice_scale=0.35, predict_f0=False, c_lengths=None, phase=None, cond=None):
+        """
+        phase: [B, harmonic_num + 1] initial phase of the sines of the NSF-HiFiGAN source (ignored by MB-iSTFT-VITS),
+        or a function of the f0: [B, T] of the decoder (predicted if predict_f0) returning it
+        cond: get_speaker_conditioning(g) if it is precomputed (g is ignored then)
+        """
+        if cond is None:
+            cond = self.get_speaker_conditioning(g)
+        z, f0, g = self.infer_latent(c, f0, uv, noice_scale=noice_scale, predict_f0=predict_f0, c_lengths=c_lengths, cond=cond)
 
         # MB-iSTFT-VITS
         if self.mb:
-            o, o_mb = self.dec(z * c_mask, g=g)
+            o, o_mb = self.dec(z, g=g)
         else:
-            o = self.dec(z * c_mask, g=g, f0=f0)
+            if callable(phase):
+                phase = phase(f0)
+            o = self.dec(z, g=g, f0=f0, phase=phase, g_cond=cond.dec)
         return o
@@ -25,29 +25,36 @@ from .preprocess_utils import check_hubert_min_duration
 LOG = getLogger(__name__)
 HUBERT_MEMORY = 2900
 HUBERT_MEMORY_CREPE = 3900
+# number of files whose crepe frames are packed into shared batches
+CREPE_FILES_PER_BATCH = 32
+
+
+def _load_one(filepath: Path, force_rebuild: bool, hps: HParams) -> np.ndarray | None:
+    """Load audio of filepath, or return None if it should be skipped."""
+    data_path = filepath.parent / (filepath.name + ".data.pt")
+    if data_path.exists() and not force_rebuild:
+        return None
+
+    audio, sr = librosa.load(filepath, sr=hps.data.sampling_rate, mono=True)
+
+    if not check_hubert_min_duration(audio, sr):
+        LOG.info(f"Skip {filepath} because it is too short.")
+        return None
+    return audio
 
 
 def _process_one(
     *,
     filepath: Path,
+    audio: np.ndarray,
+    f0: np.ndarray,
     content_model: HubertModel,
     device: torch.device | str = get_optimal_device(),
-    f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
-    force_rebuild: bool = False,
     hps: HParams,
 ):
-    audio, sr = librosa.load(filepath, sr=hps.data.sampling_rate, mono=True)
-
-    if not check_hubert_min_duration(audio, sr):
-        LOG.info(f"Skip {filepath} because it is too short.")
-        return
-
+    sr = hps.data.sampling_rate
     data_path = filepath.parent / (filepath.name + ".data.pt")
-    if data_path.exists() and not force_rebuild:
-        return
 
-    # Compute f0
-    f0 = so_vits_svc_fork.f0.compute_f0(audio, sampling_rate=sr, hop_length=hps.data.hop_length, method=f0_method)
     f0, uv = so_vits_svc_fork.f0.interpolate_f0(f0)
     f0 = torch.from_numpy(f0).float()
     uv = torch.from_numpy(uv).float()
@@ -105,16 +112,46 @@ def _process_one(
         torch.save(data, f)
 
 
-def _process_batch(filepaths: Iterable[Path], pbar_position: int, **kwargs):
-    hps = kwargs["hps"]
+def _process_batch(
+    filepaths: Iterable[Path],
+    pbar_position: int,
+    *,
+    f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
+    force_rebuild: bool = False,
+    f0_n_jobs: int = 1,
+    hps: HParams,
+):
     content_model = utils.get_hubert_model(get_optimal_device(), hps.data.get("contentvec_final_proj", True))
 
-    for filepath in tqdm(filepaths, position=pbar_position):
-        _process_one(
-            content_model=content_model,
-            filepath=filepath,
-            **kwargs,
-        )
+    filepaths = list(filepaths)
+    files_per_batch = CREPE_FILES_PER_BATCH if f0_method in ["crepe", "crepe-tiny"] else 1
+    with tqdm(total=len(filepaths), position=pbar_position) as pbar:
+        for i in range(0, len(filepaths), files_per_batch):
+            audios = {filepath: _load_one(filepath, force_rebuild, hps) for filepath in filepaths[i : i + files_per_batch]}
+            audios = {filepath: audio for filepath, audio in audios.items() if audio is not None}
+            if audios:
+                # Compute f0
+                if files_per_batch > 1:
+                    f0s = so_vits_svc_fork.f0.compute_f0_batch(
+                        list(audios.values()),
+                        sampling_rate=hps.data.sampling_rate,
+                        hop_length=hps.data.hop_length,
+                        method=f0_method,
+                    )
+                else:
+                    f0s = [
+                        so_vits_svc_fork.f0.compute_f0(
+                            audio,
+                            sampling_rate=hps.data.sampling_rate,
+                            hop_length=hps.data.hop_length,
+                            method=f0_method,
+                            n_jobs=f0_n_jobs,
+                        )
+                        for audio in audios.values()
+                    ]
+                for (filepath, audio), f0 in zip(audios.items(), f0s):
+                    _process_one(filepath=filepath, audio=audio, f0=f0, content_model=content_model, hps=hps)
+            pbar.update(len(filepaths[i : i + files_per_batch]))
 
 
 def preprocess_hubert_f0(
@@ -123,6 +160,7 @@ def preprocess_hubert_f0(
     n_jobs: int | None = None,
     f0_method: Literal["crepe", "crepe-tiny", "parselmouth", "dio", "harvest"] = "dio",
     force_rebuild: bool = False,
+    f0_n_jobs: int = 1,
 ):
     input_dir = Path(input_dir)
     config_path = Path(config_path)
@@ -149,6 +187,7 @@ def preprocess_hubert_f0(
             pbar_position=pbar_position,
             f0_method=f0_method,
             force_rebuild=force_rebuild,
+            f0_n_jobs=f0_n_jobs,
             hps=hps,
         )
         for (pbar_position, chunk) in enumerate(filepath_chunks)
@@ -149,6 +149,12 @@ class VitsLightning(pl.LightningModule):
             **self.hparams.model,
         )
         self.net_d = MultiPeriodDiscriminator(self.hparams.model.use_spectral_norm)
+        if self.hparams.model.get("type_") == "mb-istft":
+            from .modules.decoders.mb_istft import PQMF, get_subband_stft_loss
+
+            # built once, their filters and windows move with the module
+            self.pqmf = PQMF(subbands=self.hparams.model.subbands)
+            self.subband_stft_loss = get_subband_stft_loss(self.hparams)
         self.automatic_optimization = False
         self.learning_rate = self.hparams.train.learning_rate
         self.optim_g = torch.optim.AdamW(
@@ -420,10 +426,10 @@ class VitsLightning(pl.LightningModule):
             # MB-iSTFT-VITS
             loss_subband = torch.tensor(0.0)
             if self.hparams.model.get("type_") == "mb-istft":
-                from .modules.decoders.mb_istft import PQMF, subband_stft_loss
+                from .modules.decoders.mb_istft import subband_stft_loss
 
-                y_mb = PQMF(y.device, self.hparams.model.subbands).analysis(y)
-                loss_subband = subband_stft_loss(self.hparams, y_mb, y_hat_mb)
+                y_mb = self.pqmf.analysis(y)
+                loss_subband = subband_stft_loss(self.hparams, y_mb, y_hat_mb, self.subband_stft_loss)
             loss_gen_all += loss_subband
 
         # log loss
@@ -28,6 +28,9 @@ from so_vits_svc_fork.hparams import HParams
 
 LOG = getLogger(__name__)
 HUBERT_SAMPLING_RATE = 16000
+# the legacy contentvec features are final_proj applied to the output of this layer
+CONTENTVEC_FINAL_PROJ_LAYER = 9
+CONTENT_OVERLAP_SECONDS = 3
 IS_COLAB = os.getenv("COLAB_RELEASE_TAG", False)
 
 
@@ -182,9 +185,26 @@ def remove_weight_norm_if_exists(module, name: str = "weight"):
             return module
 
 
+def truncate_hubert_model(model: HubertModel, n_layers: int) -> HubertModel:
+    """
+    Remove the transformer layers after the first n_layers in place
+    so that last_hidden_state equals hidden_states[n_layers] of the original model.
+    """
+    if n_layers >= len(model.encoder.layers):
+        return model
+    model.encoder.layers = model.encoder.layers[:n_layers]
+    model.config.num_hidden_layers = n_layers
+    if model.config.do_stable_layer_norm:
+        # hidden_states[n_layers] is taken before the final layer norm
+        model.encoder.layer_norm = nn.Identity()
+    return model
+
+
 def get_hubert_model(device: str | torch.device, final_proj: bool = True) -> HubertModel:
     if final_proj:
         model = HubertModelWithFinalProj.from_pretrained("lengyue233/content-vec-best")
+        # the layers after CONTENTVEC_FINAL_PROJ_LAYER are never used
+        truncate_hubert_model(model, CONTENTVEC_FINAL_PROJ_LAYER)
     else:
         model = HubertModel.from_pretrained("lengyue233/content-vec-best")
     # Hubert is always used in inference mode, we can safely remove weight-norms
@@ -195,33 +215,145 @@ def get_hubert_model(device: str | torch.device, final_proj: bool = True) -> Hub
     return model.to(device)
 
 
+def _forward_content(cmodel: HubertModel, audio: torch.Tensor, legacy_final_proj: bool, attention_mask: torch.Tensor | None = None) -> torch.Tensor:
+    """audio: [B, L] at HUBERT_SAMPLING_RATE, return c: [B, T, C]"""
+    if legacy_final_proj:
+        if not hasattr(cmodel, "final_proj"):
+            raise ValueError("HubertModel does not have final_proj")
+        if len(cmodel.encoder.layers) == CONTENTVEC_FINAL_PROJ_LAYER:
+            c = cmodel(audio, attention_mask=attention_mask)["last_hidden_state"]
+        else:
+            c = cmodel(audio, attention_mask=attention_mask, output_hidden_states=True)["hidden_states"][CONTENTVEC_FINAL_PROJ_LAYER]
+        return cmodel.final_proj(c)
+    return cmodel(audio, attention_mask=attention_mask)["last_hidden_state"]
+
+
+def _masked_group_norm(norm: nn.GroupNorm, x: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """norm (one group per channel) of x: [B, C, T] over the first lengths[b] frames of each item."""
+    mask = (torch.arange(x.shape[-1], device=x.device) < lengths[:, None])[:, None].to(x.dtype)
+    n = lengths[:, None, None].to(x.dtype)
+    mean = (x * mask).sum(-1, keepdim=True) / n
+    var = ((x - mean) ** 2 * mask).sum(-1, keepdim=True) / n
+    x = (x - mean) / torch.sqrt(var + norm.eps)
+    return x * norm.weight[:, None] + norm.bias[:, None]
+
+
+def _forward_content_padded(cmodel: HubertModel, audio: torch.Tensor, lengths: torch.Tensor, legacy_final_proj: bool) -> torch.Tensor:
+    """
+    _forward_content of audio: [B, L] zero-padded from lengths: [B] samples,
+    such that the frames of each item are those of the item alone.
+    """
+    attention_mask = (torch.arange(audio.shape[-1], device=audio.device) < lengths[:, None]).long()
+    handle = None
+    if cmodel.config.feat_extract_norm == "group":
+        # the group norm of the first conv layer normalizes over time, where the attention mask does not reach
+        layer = cmodel.feature_extractor.conv_layers[0]
+        conv_lengths = (lengths - layer.conv.kernel_size[0]) // layer.conv.stride[0] + 1
+        handle = layer.layer_norm.register_forward_hook(lambda norm, args, output: _masked_group_norm(norm, args[0], conv_lengths))
+    try:
+        return _forward_content(cmodel, audio, legacy_final_proj, attention_mask)
+    finally:
+        if handle is not None:
+            handle.remove()
+
+
+def _get_feat_extract_input_length(cmodel: HubertModel, n_frames: int) -> int:
+    """Smallest input length for which the feature extractor outputs n_frames frames."""
+    length = n_frames
+    for kernel_size, stride in reversed(list(zip(cmodel.config.conv_kernel, cmodel.config.conv_stride))):
+        length = (length - 1) * stride + kernel_size
+    return length
+
+
+def _get_content_windowed(
+    cmodel: HubertModel,
+    audio: torch.Tensor,
+    legacy_final_proj: bool,
+    window_seconds: float,
+    overlap_seconds: float,
+    window_batch_size: int,
+) -> torch.Tensor:
+    """
+    Run HuBERT on overlapping windows of audio: [B, L] and stitch the frames
+    at the middle of each overlap, so that peak memory does not depend on L.
+    return c: [B, T, C]
+    """
+    frame_stride = int(np.prod(cmodel.config.conv_stride))
+    n_frames = int(cmodel._get_feat_extract_output_lengths(audio.shape[-1]))
+    window_frames = max(int(window_seconds * HUBERT_SAMPLING_RATE) // frame_stride, 1)
+    overlap_frames = min(int(overlap_seconds * HUBERT_SAMPLING_RATE) // frame_stride, window_frames - 1)
+    if n_frames <= window_frames:
+        return _forward_content(cmodel, audio, legacy_final_proj)
+
+    # window k covers frames [starts[k], starts[k] + window_frames), the last one ends at n_frames
+    window_length = _get_feat_extract_input_length(cmodel, window_frames)
+    starts = list(range(0, n_frames - window_frames, window_frames - overlap_frames)) + [n_frames - window_frames]
+    bounds = [0] + [(start + next_start + window_frames) // 2 for start, next_start in zip(starts, starts[1:])] + [n_frames]
+    windows = torch.stack([audio[:, start * frame_stride : start * frame_stride + window_length] for start in starts], dim=1)
+    windows = windows.reshape(-1, window_length)  # [B * K, window_length]
+    cs = torch.cat(
+        [_forward_content(cmodel, windows[i : i + window_batch_size], legacy_final_proj) for i in range(0, len(windows), window_batch_size)]
+    )
+    cs = cs.reshape(audio.shape[0], len(starts), window_frames, -1)
+    return torch.cat([cs[:, k, bounds[k] - start : bounds[k + 1] - start] for k, start in enumerate(starts)], dim=1)
+
+
 def get_content(
     cmodel: HubertModel,
     audio: torch.Tensor | ndarray[Any, Any],
     device: torch.device | str,
     sr: int,
     legacy_final_proj: bool = False,
+    window_seconds: float | None = None,
+    overlap_seconds: float = CONTENT_OVERLAP_SECONDS,
+    window_batch_size: int = 4,
+    lengths: Sequence[int] | None = None,
 ) -> torch.Tensor:
+    """
+    return c: [B, C, T]
+    window_seconds: if set, run HuBERT on windows of this length overlapping by
+    overlap_seconds, window_batch_size windows at a time, so that peak memory does not depend
+    on the length of audio. The frames near the window boundaries see less context.
+    lengths: number of samples of each audio of a zero-padded batch. The first
+    get_content_lengths(lengths) frames of each audio are then those of the audio alone.
+    """
+    if lengths is not None and window_seconds:
+        raise ValueError("lengths is not supported with windows")
     audio = torch.as_tensor(audio)
     if sr != HUBERT_SAMPLING_RATE:
         audio = torchaudio.transforms.Resample(sr, HUBERT_SAMPLING_RATE).to(audio.device)(audio).to(device)
     if audio.ndim == 1:
         audio = audio.unsqueeze(0)
+    if legacy_final_proj:
+        warnings.warn("legacy_final_proj is deprecated")
     with torch.no_grad(), timer() as t:
-        if legacy_final_proj:
-            warnings.warn("legacy_final_proj is deprecated")
-            if not hasattr(cmodel, "final_proj"):
-                raise ValueError("HubertModel does not have final_proj")
-            c = cmodel(audio, output_hidden_states=True)["hidden_states"][9]
-            c = cmodel.final_proj(c)
+        if lengths is not None:
+            resampled_lengths = torch.as_tensor(_get_resampled_lengths(lengths, sr), device=audio.device)
+            c = _forward_content_padded(cmodel, audio, resampled_lengths, legacy_final_proj)
+        elif window_seconds:
+            c = _get_content_windowed(cmodel, audio, legacy_final_proj, window_seconds, overlap_seconds, window_batch_size)
         else:
-            c = cmodel(audio)["last_hidden_state"]
+            c = _forward_content(cmodel, audio, legacy_final_proj)
         c = c.transpose(1, 2)
     wav_len = audio.shape[-1] / HUBERT_SAMPLING_RATE
     LOG.info(f"HuBERT inference time  : {t.elapsed:.3f}s, RTF: {t.elapsed / wav_len:.3f}")
     return c
 
 
+def _get_resampled_lengths(audio_lengths: Sequence[int], sr: int) -> list[int]:
+    """Number of samples of audios of the given lengths resampled to HUBERT_SAMPLING_RATE."""
+    lengths = torch.as_tensor(audio_lengths, dtype=torch.long)
+    if sr != HUBERT_SAMPLING_RATE:
+        # same as torchaudio.transforms.Resample
+        lengths = torch.ceil(lengths * HUBERT_SAMPLING_RATE / sr).long()
+    return lengths.tolist()
+
+
+def get_content_lengths(cmodel: HubertModel, audio_lengths: Sequence[int], sr: int) -> list[int]:
+    """Number of content frames get_content() returns for audios of the given lengths."""
+    return cmodel._get_feat_extract_output_lengths(torch.as_tensor(_get_resampled_lengths(audio_lengths, sr))).tolist()
+
+
 def _substitute_if_same_shape(to_: dict[str, Any], from_: dict[str, Any]) -> None:
     not_in_to = list(filter(lambda x: x not in to_, from_.keys()))
     not_in_from = list(filter(lambda x: x not in from_, to_.keys()))
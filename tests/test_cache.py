@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from so_vits_svc_fork.inference.cache import FeatureCache, get_feature_key
+
+
+def create_features(seed: int, n_frames: int = 100):
+    rng = np.random.default_rng(seed)
+    return (
+        rng.normal(size=(8, n_frames)).astype(np.float32),
+        rng.uniform(100, 200, n_frames).astype(np.float32),
+        (rng.uniform(size=n_frames) > 0.5).astype(np.float32),
+    )
+
+
+def assert_features_equal(actual, expected):
+    assert actual is not None
+    for x, y in zip(actual, expected):
+        np.testing.assert_array_equal(x, y)
+
+
+class TestFeatureCache(TestCase):
+    def test_key(self):
+        audio = np.random.default_rng(0).normal(size=44100).astype(np.float32)
+        kwargs = dict(
+            sampling_rate=44100,
+            hop_length=512,
+            f0_method="dio",
+            contentvec_final_proj=False,
+            content_window=(None, 3),
+            f0_segment_seconds=None,
+        )
+        key = get_feature_key(audio, **kwargs)
+        self.assertEqual(get_feature_key(audio.copy(), **kwargs), key)
+        self.assertNotEqual(get_feature_key(audio[:-1], **kwargs), key)
+        for name, value in [
+            ("sampling_rate", 48000),
+            ("hop_length", 320),
+            ("f0_method", "harvest"),
+            ("contentvec_final_proj", True),
+            ("content_window", (20, 3)),
+            ("f0_segment_seconds", 30),
+        ]:
+            with self.subTest(name=name):
+                self.assertNotEqual(get_feature_key(audio, **{**kwargs, name: value}), key)
+
+    def test_svc_key(self):
+        from so_vits_svc_fork.inference.core import Svc
+
+        audio = np.random.default_rng(0).normal(size=44100).astype(np.float32)
+        svc_model = SimpleNamespace(
+            target_sample=44100, hop_size=512, contentvec_final_proj=False, content_window_seconds=None, content_overlap_seconds=3, f0_n_jobs=1
+        )
+        key = Svc._get_feature_key(svc_model, audio, "dio")
+        # f0 computed in segments may differ slightly from f0 computed at once
+        self.assertNotEqual(Svc._get_feature_key(SimpleNamespace(**{**vars(svc_model), "f0_n_jobs": -1}), audio, "dio"), key)
+        self.assertEqual(Svc._get_feature_key(SimpleNamespace(**{**vars(svc_model), "f0_n_jobs": 1}), audio, "dio"), key)
+
+    def test_memory_eviction(self):
+        features = {key: create_features(i) for i, key in enumerate("abcd")}
+        nbytes = sum(x.nbytes for x in features["a"])
+        cache = FeatureCache(max_memory_bytes=3 * nbytes)
+        for key in "abc":
+            cache.put(key, *features[key])
+        # a is now the most recently used, so b is evicted first
+        assert_features_equal(cache.get("a"), features["a"])
+        cache.put("d", *features["d"])
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get("b"))
+        for key in "acd":
+            assert_features_equal(cache.get(key), features[key])
+        # an entry larger than the limit is still kept alone
+        cache = FeatureCache(max_memory_bytes=nbytes // 2)
+        cache.put("a", *features["a"])
+        cache.put("b", *features["b"])
+        self.assertEqual(len(cache), 1)
+        assert_features_equal(cache.get("b"), features["b"])
+
+    def test_disk_eviction(self):
+        features = {key: create_features(i) for i, key in enumerate("abcd")}
+        with TemporaryDirectory() as tempdir:
+            cache_dir = Path(tempdir)
+            cache = FeatureCache(cache_dir=cache_dir)
+            cache.put("a", *features["a"])
+            file_size = (cache_dir / "a.npz").stat().st_size
+            cache = FeatureCache(cache_dir=cache_dir, max_disk_bytes=int(2.5 * file_size))
+            cache.put("b", *features["b"])
+            # the files are ordered by their access times, a is the least recently used
+            for t, key in enumerate("ab"):
+                os.utime(cache_dir / f"{key}.npz", (t + 1, t + 1))
+            cache.put("c", *features["c"])
+            self.assertEqual(sorted(path.name for path in cache_dir.glob("*.npz")), ["b.npz", "c.npz"])
+
+            # loading from disk makes b the most recently used
+            cache = FeatureCache(cache_dir=cache_dir, max_disk_bytes=int(2.5 * file_size))
+            os.utime(cache_dir / "c.npz", (3, 3))
+            assert_features_equal(cache.get("b"), features["b"])
+            self.assertEqual(len(cache), 1)
+            cache.put("d", *features["d"])
+            self.assertEqual(sorted(path.name for path in cache_dir.glob("*.npz")), ["b.npz", "d.npz"])
+            self.assertNotIn("c", cache)
+
+    def test_corrupt_file(self):
+        features = create_features(0)
+        with TemporaryDirectory() as tempdir:
+            cache_dir = Path(tempdir)
+            FeatureCache(cache_dir=cache_dir).put("a", *features)
+            path = cache_dir / "a.npz"
+            path.write_bytes(path.read_bytes()[:100])
+
+            cache = FeatureCache(cache_dir=cache_dir)
+            self.assertIn("a", cache)
+            self.assertIsNone(cache.get("a"))
+            self.assertFalse(path.exists())
+            # and the features can be cached again
+            cache.put("a", *features)
+            assert_features_equal(FeatureCache(cache_dir=cache_dir).get("a"), features)
+
+    def test_infer(self):
+        from so_vits_svc_fork.inference.main import infer
+
+        with TemporaryDirectory() as tempdir:
+            for kwargs, memory_only in [({}, None), ({"feature_cache": True}, True), ({"feature_cache_dir": tempdir}, False)]:
+                with self.subTest(**kwargs), patch("so_vits_svc_fork.inference.main.Svc") as svc:
+                    infer(input_path=[], output_path=[], model_path="G_0.pth", config_path="config.json", speaker="a", **kwargs)
+                    feature_cache = svc.call_args.kwargs["feature_cache"]
+                    if memory_only is None:
+                        self.assertIsNone(feature_cache)
+                    else:
+                        self.assertIsInstance(feature_cache, FeatureCache)
+                        self.assertEqual(feature_cache.cache_dir is None, memory_only)
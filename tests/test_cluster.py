@@ -0,0 +1,198 @@
+import warnings
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import numpy as np
+import torch
+from sklearn.cluster import KMeans
+
+
+class TestCluster(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.x = rng.normal(size=(3000, 32)).astype(np.float32)
+        self.kmeans = KMeans(n_clusters=200, n_init=1, max_iter=10, random_state=0).fit(self.x)
+        self.tempdir = TemporaryDirectory()
+        self.path = Path(self.tempdir.name) / "kmeans.pt"
+        torch.save(
+            {
+                "speaker": {
+                    "n_features_in_": self.kmeans.n_features_in_,
+                    "_n_threads": self.kmeans._n_threads,
+                    "cluster_centers_": self.kmeans.cluster_centers_,
+                }
+            },
+            self.path,
+        )
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_same_as_sklearn(self):
+        from so_vits_svc_fork import cluster
+
+        model = cluster.get_cluster_model(self.path)
+        x = np.random.default_rng(1).normal(size=(5000, 32)).astype(np.float32)
+        expected = self.kmeans.predict(x)
+        np.testing.assert_array_equal(cluster.get_cluster_result(model, x, "speaker"), expected)
+        np.testing.assert_array_equal(
+            cluster.get_cluster_center_result(model, x, "speaker"),
+            self.kmeans.cluster_centers_[expected],
+        )
+
+        # half precision centers and inputs give the same labels
+        model_half = cluster.get_cluster_model(self.path, dtype=torch.float16)
+        x_half = torch.from_numpy(x).half()
+        expected_half = self.kmeans.predict(x_half.float().numpy())
+        np.testing.assert_array_equal(cluster.get_cluster_result(model_half, x_half, "speaker").numpy(), expected_half)
+        center_half = cluster.get_cluster_center_result(model_half, x_half, "speaker")
+        self.assertEqual(center_half.dtype, torch.float16)
+
+    def test_top_k(self):
+        from so_vits_svc_fork import cluster
+
+        model = cluster.get_cluster_model(self.path)
+        x = torch.from_numpy(self.x[:100])
+        distances, labels = model["speaker"].kneighbors(x, k=3)
+        expected = ((x[:, None, :] - model["speaker"].cluster_centers_[None]) ** 2).sum(-1).topk(3, largest=False)
+        np.testing.assert_array_equal(labels.numpy(), expected.indices.numpy())
+        torch.testing.assert_close(distances, expected.values, rtol=1e-4, atol=1e-4)
+
+        soft = cluster.get_cluster_center_result(model, x, "speaker", k=3)
+        self.assertEqual(soft.shape, x.shape)
+        # k=1 is the hard assignment
+        torch.testing.assert_close(cluster.get_cluster_center_result(model, x, "speaker", k=1), model["speaker"].cluster_centers_[labels[:, 0]])
+
+    def test_compact_format(self):
+        from so_vits_svc_fork import cluster
+
+        x = torch.from_numpy(self.x[:500])
+        expected = self.kmeans.predict(self.x[:500])
+        for half in [False, True]:
+            with self.subTest(half=half):
+                path = Path(self.tempdir.name) / f"kmeans{half}.clusters"
+                cluster.convert_cluster_model(self.path, path, half=half)
+                model = cluster.get_cluster_model(path)
+                self.assertIsInstance(model, cluster.LazyClusterModel)
+                self.assertEqual(list(model.keys()), ["speaker"])
+                self.assertEqual(model._loaded, {})
+                centers = model.get_array("speaker")
+                self.assertEqual(centers.dtype, np.float16 if half else np.float32)
+                np.testing.assert_array_equal(centers, self.kmeans.cluster_centers_.astype(centers.dtype))
+                labels = cluster.get_cluster_result(model, x, "speaker").numpy()
+                if not half:
+                    np.testing.assert_array_equal(labels, expected)
+                with self.assertRaises(ValueError):
+                    cluster.check_speaker(model, "unknown")
+
+    def test_feature_store(self):
+        from so_vits_svc_fork.cluster.train_cluster import build_feature_store, train_cluster
+
+        speaker_dir = Path(self.tempdir.name) / "speaker"
+        speaker_dir.mkdir()
+        contents = [torch.randn(1, 32, n) for n in [300, 1, 500]]
+        for i, content in enumerate(contents):
+            torch.save({"content": content, "spec": torch.randn(513, 100), "audio": torch.randn(1, 1000)}, speaker_dir / f"{i}.data.pt")
+        paths = sorted(speaker_dir.rglob("*.data.pt"))
+        features = build_feature_store(paths, Path(self.tempdir.name) / "content.f32")
+        np.testing.assert_array_equal(features, torch.cat(contents, dim=-1).squeeze(0).numpy().T)
+        del features
+
+        result = train_cluster(speaker_dir, n_clusters=10, batch_size=64)
+        self.assertEqual(result["cluster_centers_"].shape, (10, 32))
+        # the feature store is removed
+        self.assertEqual(sorted(speaker_dir.iterdir()), paths)
+
+    def test_select_cluster_jobs(self):
+        from so_vits_svc_fork.cluster.train_cluster import ClusterJob, select_cluster_jobs
+
+        jobs = [ClusterJob(speaker=str(memory), input_dir=Path(), memory=memory, n_frames=0) for memory in [9, 6, 4, 3, 1]]
+
+        def names(jobs):
+            return [job.speaker for job in jobs]
+
+        # largest first, smaller ones fill the remaining budget
+        self.assertEqual(names(select_cluster_jobs(jobs, [], 10, 4)), ["9", "1"])
+        self.assertEqual(names(select_cluster_jobs(jobs[1:], [], 10, 4)), ["6", "4"])
+        self.assertEqual(names(select_cluster_jobs(jobs[1:], [], 10, 1)), ["6"])
+        self.assertEqual(names(select_cluster_jobs(jobs[2:], jobs[1:2], 10, 4)), ["4"])
+        # a job over the budget is started alone
+        self.assertEqual(names(select_cluster_jobs(jobs, [], 5, 4)), ["9"])
+        self.assertEqual(names(select_cluster_jobs(jobs, jobs[3:4], 5, 4)), ["1"])
+
+    def test_torch_kmeans(self):
+        from so_vits_svc_fork.cluster import ClusterCenters
+        from so_vits_svc_fork.cluster.torch_kmeans import TorchMiniBatchKMeans
+
+        # well separated blobs are found exactly
+        rng = np.random.default_rng(0)
+        blobs = rng.normal(scale=10, size=(20, 8)).astype(np.float32)
+        x = blobs[rng.integers(0, 20, 5000)] + rng.normal(scale=0.1, size=(5000, 8)).astype(np.float32)
+        kmeans = TorchMiniBatchKMeans(n_clusters=20, batch_size=256, random_state=0).fit(x)
+        self.assertEqual(kmeans.cluster_centers_.shape, (20, 8))
+        self.assertEqual(kmeans.cluster_centers_.dtype, np.float32)
+        distances, labels = ClusterCenters(kmeans.cluster_centers_).kneighbors(torch.from_numpy(blobs))
+        self.assertEqual(sorted(labels[:, 0].tolist()), list(range(20)))
+        self.assertLess(float(distances.max()), 0.1)
+
+    def test_retrieval_index(self):
+        from so_vits_svc_fork.cluster import retrieval
+
+        index_dir = Path(self.tempdir.name) / "dataset"
+        for speaker, n_frames in [("alice", 1500), ("bob", 1)]:
+            (index_dir / speaker).mkdir(parents=True)
+            torch.save({"content": torch.from_numpy(self.x[:n_frames].T[None].copy())}, index_dir / speaker / "0.data.pt")
+        path = Path(self.tempdir.name) / "features.index"
+        retrieval.main(index_dir, path, n_lists=20, half=False)
+        model = retrieval.get_retrieval_index(path, n_probe=4)
+        self.assertEqual(list(model.keys()), ["alice", "bob"])
+        self.assertEqual(model._loaded, {})
+        index = model["alice"]
+        self.assertEqual((len(index), index.n_lists), (1500, 20))
+        self.assertEqual(sorted(index.vectors.numpy().tolist()), sorted(self.x[:1500].tolist()))
+
+        # probing all lists is an exact search
+        x = torch.from_numpy(self.x[1500:1600])
+        expected = ((x[:, None, :] - torch.from_numpy(self.x[:1500])[None]) ** 2).sum(-1).topk(3, largest=False)
+        index.n_probe = index.n_lists
+        distances, indices = index.search(x, k=3)
+        np.testing.assert_array_equal(index.vectors[indices].numpy(), self.x[:1500][expected.indices.numpy()])
+        torch.testing.assert_close(distances, expected.values, rtol=1e-4, atol=1e-4)
+        # a training frame retrieves itself
+        np.testing.assert_array_equal(retrieval.get_retrieval_result(model, self.x[:10], "alice", k=1), self.x[:10])
+        self.assertEqual(retrieval.get_retrieval_result(model, self.x[:10], "alice", k=4).shape, (10, 32))
+
+        # fewer frames than k
+        distances, indices = model["bob"].search(x, k=3)
+        self.assertTrue(torch.isinf(distances[:, 1:]).all())
+        np.testing.assert_allclose(retrieval.get_retrieval_result(model, x, "bob", k=3), np.broadcast_to(self.x[:1], (100, 32)))
+        with self.assertRaises(ValueError):
+            retrieval.check_speaker(model, "unknown")
+
+    def test_build_ivf_index_memmap(self):
+        from so_vits_svc_fork.cluster import ArrayFileWriter, memmap_array, read_array_file_header
+        from so_vits_svc_fork.cluster.retrieval import build_ivf_index
+
+        store_path = Path(self.tempdir.name) / "content.f32"
+        self.x.tofile(store_path)
+        features = np.memmap(store_path, dtype=np.float32, mode="r", shape=self.x.shape)
+        # from a read-only memmap into a memmap, without warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            arrays = build_ivf_index(features, n_lists=20, half=True, chunk_size=256, vectors_path=Path(self.tempdir.name) / "vectors")
+        self.assertIsInstance(arrays["vectors"], np.memmap)
+        self.assertEqual(arrays["vectors"].dtype, np.float16)
+        self.assertEqual(sorted(arrays["vectors"].tolist()), sorted(self.x.astype(np.float16).tolist()))
+        np.testing.assert_allclose(arrays["sq_norms"], (arrays["vectors"].astype(np.float32) ** 2).sum(axis=1), rtol=1e-6)
+        self.assertEqual(arrays["offsets"][-1], len(self.x))
+
+        # the arrays are streamed into the file in chunks
+        path = Path(self.tempdir.name) / "arrays"
+        with ArrayFileWriter(path, b"MAGIC", ["a/vectors", "a/sq_norms"], "arrays", chunk_bytes=1000) as writer:
+            writer.write("a/vectors", arrays["vectors"])
+            writer.write("a/sq_norms", arrays["sq_norms"])
+        header, data_start = read_array_file_header(path, b"MAGIC", "arrays")
+        for name in ["vectors", "sq_norms"]:
+            np.testing.assert_array_equal(memmap_array(path, header[f"a/{name}"], data_start), arrays[name])
+        del features, arrays
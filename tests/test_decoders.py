@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from unittest import TestCase
+
+import torch
+
+
+def _generator(resblock: str = "1"):
+    from so_vits_svc_fork.modules.decoders.hifigan import NSFHifiGANGenerator
+
+    h = {
+        "sampling_rate": 44100,
+        "inter_channels": 16,
+        "resblock": resblock,
+        "resblock_kernel_sizes": [3, 7, 11],
+        "resblock_dilation_sizes": [[1, 3, 5]] * 3 if resblock == "1" else [[1, 3]] * 3,
+        "upsample_rates": [8, 8, 2, 2],
+        "upsample_initial_channel": 64,
+        "upsample_kernel_sizes": [16, 16, 4, 4],
+        "gin_channels": 8,
+    }
+    generator = NSFHifiGANGenerator(h).eval()
+    generator.remove_weight_norm()
+    return generator
+
+
+class TestDecoders(TestCase):
+    def test_sine_phase(self):
+        from so_vits_svc_fork.modules.decoders.hifigan._models import SineGen
+
+        torch.manual_seed(0)
+        sine_gen = SineGen(44100, harmonic_num=8, noise_std=0)
+        f0 = torch.rand(1, 1000, 1) * 300
+        phase = torch.rand(1, 9)
+        expected, _, _, expected_phase = sine_gen(f0, phase)
+        first, _, _, phase = sine_gen(f0[:, :333], phase)
+        second, _, _, phase = sine_gen(f0[:, 333:], phase)
+        torch.testing.assert_close(torch.cat([first, second], dim=1), expected, rtol=0, atol=1e-5)
+        torch.testing.assert_close(phase, expected_phase, rtol=0, atol=1e-5)
+
+    def test_source_phase(self):
+        torch.manual_seed(0)
+        generator = _generator()
+        m_source = generator.m_source
+        m_source.l_sin_gen.noise_std = 0
+        # voiced frames only, the noise of unvoiced frames is random
+        f0 = torch.rand(1, 40) * 300 + 100
+        f0_upsampled = generator.f0_upsamp(f0[:, None]).transpose(1, 2)
+        phase = m_source.l_sin_gen.initial_phase(1)
+        with torch.no_grad():
+            expected, _, _, expected_phase = m_source(f0_upsampled, phase)
+            first, _, _, next_phase = m_source(f0_upsampled[:, :3000], phase)
+            second, _, _, _ = m_source(f0_upsampled[:, 3000:], next_phase)
+        torch.testing.assert_close(torch.cat([first, second], dim=1), expected, rtol=0, atol=1e-4)
+        # the phase after a prefix of the frames without generating the sines
+        torch.testing.assert_close(generator.advance_phase(f0, phase, 3000), next_phase, rtol=0, atol=1e-4)
+        torch.testing.assert_close(generator.advance_phase(f0, phase, 40 * 256), expected_phase, rtol=0, atol=1e-4)
+
+    def test_streaming(self):
+        from so_vits_svc_fork.modules.decoders.hifigan import NSFHifiGANStream
+
+        torch.manual_seed(0)
+        for resblock in ["1", "2"]:
+            with self.subTest(resblock=resblock):
+                generator = _generator(resblock)
+                # without the random noise and initial phase of the source
+                generator.m_source.l_sin_gen.sine_amp = 0
+                generator.m_source.l_sin_gen.noise_std = 0
+                x, f0, g = torch.randn(1, 16, 60), torch.full((1, 60), 220.0), torch.randn(1, 8, 1)
+                with torch.no_grad():
+                    expected = generator(x, f0, g)
+                stream = NSFHifiGANStream(generator)
+                outputs = [stream(x[:, :, i:j], f0[:, i:j], g) for i, j in [(0, 1), (1, 8), (8, 30), (30, 31), (31, 60)]]
+                output = torch.cat(outputs, dim=-1)
+                # every sample is output once its right context has arrived
+                self.assertEqual(output.shape[-1], 60 * 256 - stream.latency)
+                torch.testing.assert_close(output, expected[..., : output.shape[-1]], rtol=0, atol=1e-5)
+
+    def test_f0_decoder_padding(self):
+        from so_vits_svc_fork.modules.commons import sequence_mask
+        from so_vits_svc_fork.modules.decoders.f0 import F0Decoder
+
+        torch.manual_seed(0)
+        decoder = F0Decoder(1, 32, 64, 2, 2, 3, 0.1, spk_channels=8).eval()
+        lengths = torch.tensor([50, 37])
+        x_mask = sequence_mask(lengths, 50)[:, None].float()
+        # the frames after the lengths are not zero, as in SynthesizerTrn.infer_latent
+        x, norm_f0, spk_emb = torch.randn(2, 32, 50), torch.randn(2, 1, 50) * x_mask, torch.randn(2, 8, 1)
+        with torch.no_grad():
+            batch = decoder(x, norm_f0, x_mask, spk_emb=spk_emb)
+            for j, length in enumerate(lengths.tolist()):
+                single = decoder(x[j : j + 1, :, :length], norm_f0[j : j + 1, :, :length], x_mask[j : j + 1, :, :length], spk_emb=spk_emb[j : j + 1])
+                torch.testing.assert_close(batch[j : j + 1, :, :length], single, rtol=1e-5, atol=1e-5)
+
+    def test_speaker_conditioning(self):
+        from so_vits_svc_fork.modules.synthesizers import SpeakerConditioning
+
+        from .test_onnx import create_synthesizer
+
+        for template, type_ in [("so-vits-svc-4.0v1.json", "hifi-gan"), ("quickvc.json", "mb-istft")]:
+            with self.subTest(type_=type_):
+                net_g, ssl_dim = create_synthesizer(template, type_)
+                c, f0, uv = torch.randn(2, ssl_dim, 20), torch.rand(2, 20) * 300 + 100, torch.ones(2, 20)
+                sid = torch.LongTensor([[0], [1]])
+                with torch.no_grad():
+                    torch.manual_seed(0)
+                    expected = net_g.infer(c, f0, uv, g=sid, predict_f0=True)
+                    # the conditionings of single speakers concatenated as a batch
+                    cond = SpeakerConditioning.cat([net_g.get_speaker_conditioning(sid[i : i + 1]) for i in range(2)])
+                    torch.manual_seed(0)
+                    output = net_g.infer(c, f0, uv, predict_f0=True, cond=cond)
+                torch.testing.assert_close(output, expected)
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Any
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+from numpy import ndarray
+
+
+def interpolate_f0_reference(f0: ndarray[Any, Any]) -> tuple[ndarray[Any, Any], ndarray[Any, Any]]:
+    """The original loop implementation of interpolate_f0."""
+    data = np.reshape(f0, (f0.size, 1)).copy()
+
+    vuv_vector = np.zeros((data.size, 1), dtype=np.float32)
+    vuv_vector[data > 0.0] = 1.0
+    vuv_vector[data <= 0.0] = 0.0
+
+    ip_data = data
+
+    frame_number = data.size
+    last_value = 0.0
+    for i in range(frame_number):
+        if data[i] <= 0.0:
+            j = i + 1
+            for j in range(i + 1, frame_number):
+                if data[j] > 0.0:
+                    break
+            if j < frame_number - 1:
+                if last_value > 0.0:
+                    step = (data[j] - data[i - 1]) / float(j - i)
+                    for k in range(i, j):
+                        ip_data[k] = data[i - 1] + step * (k - i + 1)
+                else:
+                    for k in range(i, j):
+                        ip_data[k] = data[j]
+            else:
+                for k in range(i, frame_number):
+                    ip_data[k] = last_value
+        else:
+            ip_data[i] = data[i]
+            last_value = data[i]
+
+    return ip_data[:, 0], vuv_vector[:, 0]
+
+
+def random_f0(rng: np.random.Generator, n: int, dtype: Any) -> ndarray[Any, Any]:
+    """f0 track of voiced and unvoiced runs of random lengths."""
+    f0 = np.zeros(n, dtype=dtype)
+    pos = 0
+    voiced = rng.random() < 0.5
+    while pos < n:
+        length = int(rng.geometric(rng.choice([0.5, 0.1, 0.01])))
+        if voiced:
+            f0[pos : pos + length] = rng.uniform(50, 1100, size=len(f0[pos : pos + length]))
+        elif rng.random() < 0.2:
+            f0[pos : pos + length] = -rng.uniform(0, 1, size=len(f0[pos : pos + length]))
+        pos += length
+        voiced = not voiced
+    return f0
+
+
+class TestInterpolateF0(TestCase):
+    def assert_equivalent(self, f0: ndarray[Any, Any]) -> None:
+        from so_vits_svc_fork.f0 import interpolate_f0
+
+        expected_f0, expected_vuv = interpolate_f0_reference(f0)
+        f0_copy = f0.copy()
+        actual_f0, actual_vuv = interpolate_f0(f0)
+        np.testing.assert_array_equal(f0, f0_copy)
+        np.testing.assert_array_equal(actual_f0, expected_f0, err_msg=f"{f0}")
+        np.testing.assert_array_equal(actual_vuv, expected_vuv, err_msg=f"{f0}")
+        self.assertEqual(actual_f0.dtype, expected_f0.dtype)
+        self.assertEqual(actual_vuv.dtype, expected_vuv.dtype)
+
+    def test_edge_cases(self):
+        for f0 in [
+            [],
+            [0],
+            [100],
+            [0, 0, 0],
+            [100, 200, 300],
+            [0, 0, 100],
+            [100, 0, 0],
+            [100, 0, 200],
+            [100, 0, 0, 200, 300],
+            [0, 100, 0, 0],
+            [0, 0, 100, 0, 200, 0],
+            [100, 0, 200, 0, 300],
+            [-1, 100, -2, 200, 300],
+        ]:
+            with self.subTest(f0=f0):
+                self.assert_equivalent(np.array(f0, dtype=np.float64))
+
+    def test_random(self):
+        rng = np.random.default_rng(0)
+        for i in range(500):
+            dtype = np.float64 if i % 2 else np.float32
+            f0 = random_f0(rng, int(rng.integers(1, 300)), dtype)
+            with self.subTest(i=i):
+                self.assert_equivalent(f0)
+
+
+def harmonic_audio(sr: int, seconds: float, seed: int = 0) -> ndarray[Any, Any]:
+    """Harmonic tone of slowly varying f0, interrupted by silence, with some noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sr * seconds)) / sr
+    phase = 2 * np.pi * np.cumsum(150 + 50 * np.sin(2 * np.pi * 0.3 * t)) / sr
+    voiced = np.sin(2 * np.pi * 0.7 * t) > -0.3
+    audio = sum(np.sin(k * phase) / k for k in range(1, 6)) * voiced * 0.3 + rng.normal(scale=0.01, size=len(t))
+    return audio.astype(np.float32)
+
+
+class TestComputeF0Segmented(TestCase):
+    def test_whole_file(self):
+        from so_vits_svc_fork.f0 import compute_f0, compute_f0_segmented
+
+        # longer than two segments and not a multiple of hop_length
+        sr, hop = 48000, 512
+        audio = harmonic_audio(sr, 3.6)[:-100]
+        for method in ["dio", "harvest", "parselmouth"]:
+            with self.subTest(method=method):
+                expected = compute_f0(audio, sampling_rate=sr, hop_length=hop, method=method)
+                # compute_f0 normalizes the audio before segmenting it
+                audio_normalized = audio / np.quantile(np.abs(audio), 0.999)
+                actual = compute_f0_segmented(audio_normalized, None, sr, hop, method, n_jobs=1, segment_seconds=1)
+                self.assertEqual(actual.shape, (len(audio) // hop,))
+                self.assertGreater(np.mean(expected > 0), 0.5)
+                if method == "dio":
+                    np.testing.assert_array_equal(actual, expected)
+                elif method == "parselmouth":
+                    # parselmouth normalizes each window on its own
+                    np.testing.assert_allclose(actual, expected, atol=0.05)
+                else:
+                    # harvest also depends on the length of the audio, but the frames are aligned
+                    self.assertGreater(np.mean(np.abs(actual - expected) < 1), 0.9)
+                    errors = [np.mean(np.abs(np.roll(actual, lag) - expected)[2:-2]) for lag in range(-2, 3)]
+                    self.assertEqual(np.argmin(errors), 2)
+
+
+class TestComputeF0Crepe(TestCase):
+    sr, hop = 44100, 512
+
+    def create_audios(self, n: int) -> list[ndarray[Any, Any]]:
+        rng = np.random.default_rng(0)
+        return [harmonic_audio(self.sr, rng.uniform(0.1, 0.3), seed=i) for i in range(n)]
+
+    def compute_f0s(self, audios: list[ndarray[Any, Any]]) -> list[ndarray[Any, Any]]:
+        from so_vits_svc_fork.f0 import compute_f0_crepe
+
+        # torchcrepe dithers the pitch with noise from the global numpy random state
+        np.random.seed(0)
+        return [compute_f0_crepe(audio, None, self.sr, self.hop, device="cpu", model="tiny") for audio in audios]
+
+    def test_batch_size(self):
+        from so_vits_svc_fork.f0 import CREPE_MAX_BATCH_SIZE, CREPE_MEMORY_PER_FRAME, get_crepe_batch_size
+
+        self.assertEqual(get_crepe_batch_size("tiny", "cpu", 10 * CREPE_MEMORY_PER_FRAME["tiny"]), 10)
+        self.assertEqual(get_crepe_batch_size("full", "cpu", 10 * CREPE_MEMORY_PER_FRAME["tiny"]), 1)
+        self.assertEqual(get_crepe_batch_size("tiny", "cpu", 1024**4), CREPE_MAX_BATCH_SIZE)
+        self.assertGreaterEqual(get_crepe_batch_size("tiny", "cpu"), 1)
+
+    def test_batch(self):
+        from so_vits_svc_fork.f0 import compute_f0_crepe_batch
+
+        audios = self.create_audios(5)
+        expected = self.compute_f0s(audios)
+        # batches of 7 frames split the frames of most audios across batches
+        for batch_size in [7, None]:
+            with self.subTest(batch_size=batch_size):
+                np.random.seed(0)
+                actual = compute_f0_crepe_batch(audios, None, self.sr, self.hop, device="cpu", model="tiny", batch_size=batch_size)
+                self.assertEqual(len(actual), len(audios))
+                for f0, expected_f0, audio in zip(actual, expected, audios):
+                    self.assertEqual(f0.shape, (len(audio) // self.hop,))
+                    np.testing.assert_allclose(f0, expected_f0, rtol=1e-5)
+
+    def test_preprocess_batch(self):
+        from so_vits_svc_fork.hparams import HParams
+        from so_vits_svc_fork.preprocessing import preprocess_hubert_f0
+
+        audios = self.create_audios(preprocess_hubert_f0.CREPE_FILES_PER_BATCH + 5)
+        filepaths = [Path(f"{i}.wav") for i in range(len(audios))]
+        # the files already preprocessed are skipped
+        loaded = {filepath: None if i % 10 == 3 else audio for i, (filepath, audio) in enumerate(zip(filepaths, audios))}
+        hps = HParams(data={"sampling_rate": self.sr, "hop_length": self.hop})
+        import so_vits_svc_fork.f0
+
+        with ExitStack() as stack:
+            stack.enter_context(patch.object(preprocess_hubert_f0, "_load_one", lambda filepath, *args: loaded[filepath]))
+            stack.enter_context(patch.object(preprocess_hubert_f0.utils, "get_hubert_model"))
+            process_one = stack.enter_context(patch.object(preprocess_hubert_f0, "_process_one"))
+            compute_f0_batch = stack.enter_context(patch.object(so_vits_svc_fork.f0, "compute_f0_batch", wraps=so_vits_svc_fork.f0.compute_f0_batch))
+            np.random.seed(0)
+            preprocess_hubert_f0._process_batch(filepaths, 0, f0_method="crepe-tiny", hps=hps)
+
+        # the files are loaded in groups of CREPE_FILES_PER_BATCH
+        files_per_batch = preprocess_hubert_f0.CREPE_FILES_PER_BATCH
+        n_loaded = [
+            sum(loaded[filepath] is not None for filepath in filepaths[i : i + files_per_batch]) for i in range(0, len(filepaths), files_per_batch)
+        ]
+        self.assertEqual([len(call.args[0]) for call in compute_f0_batch.call_args_list], n_loaded)
+        f0s = {call.kwargs["filepath"]: call.kwargs["f0"] for call in process_one.call_args_list}
+        self.assertEqual(sorted(f0s, key=filepaths.index), [filepath for filepath, audio in loaded.items() if audio is not None])
+        expected = self.compute_f0s([loaded[filepath] for filepath in f0s])
+        for (filepath, f0), expected_f0 in zip(f0s.items(), expected):
+            np.testing.assert_allclose(f0, expected_f0, rtol=1e-5, err_msg=str(filepath))
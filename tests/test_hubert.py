@@ -0,0 +1,107 @@
+import warnings
+from copy import deepcopy
+from unittest import TestCase
+from unittest.mock import patch
+
+import torch
+
+
+class TestTruncatedHubert(TestCase):
+    def test_legacy_final_proj_parity(self):
+        from transformers import HubertConfig
+
+        from so_vits_svc_fork.utils import (
+            CONTENTVEC_FINAL_PROJ_LAYER,
+            HubertModelWithFinalProj,
+            get_content,
+            truncate_hubert_model,
+        )
+
+        torch.manual_seed(0)
+        audio = torch.randn(2, 16000)
+        for do_stable_layer_norm in [False, True]:
+            with self.subTest(do_stable_layer_norm=do_stable_layer_norm):
+                config = HubertConfig(
+                    hidden_size=64,
+                    num_hidden_layers=12,
+                    num_attention_heads=4,
+                    intermediate_size=128,
+                    classifier_proj_size=32,
+                    conv_dim=(32,) * 7,
+                    num_conv_pos_embeddings=16,
+                    do_stable_layer_norm=do_stable_layer_norm,
+                )
+                model = HubertModelWithFinalProj(config).eval()
+                truncated = truncate_hubert_model(deepcopy(model), CONTENTVEC_FINAL_PROJ_LAYER)
+                self.assertEqual(len(truncated.encoder.layers), CONTENTVEC_FINAL_PROJ_LAYER)
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    expected = get_content(model, audio, "cpu", 16000, legacy_final_proj=True)
+                    actual = get_content(truncated, audio, "cpu", 16000, legacy_final_proj=True)
+                self.assertEqual(actual.shape, (2, 32, 49))
+                torch.testing.assert_close(actual, expected, rtol=0, atol=1e-6)
+
+
+class TestPaddedContent(TestCase):
+    def test_lengths(self):
+        from transformers import HubertConfig
+
+        from so_vits_svc_fork.utils import HubertModelWithFinalProj, get_content, get_content_lengths
+
+        torch.manual_seed(0)
+        for feat_extract_norm in ["group", "layer"]:
+            with self.subTest(feat_extract_norm=feat_extract_norm):
+                config = HubertConfig(
+                    hidden_size=64,
+                    num_hidden_layers=2,
+                    num_attention_heads=4,
+                    intermediate_size=128,
+                    conv_dim=(32,) * 7,
+                    num_conv_pos_embeddings=16,
+                    feat_extract_norm=feat_extract_norm,
+                )
+                model = HubertModelWithFinalProj(config).eval()
+                lengths = [44100, 30000, 12345]
+                audios = [torch.randn(length) for length in lengths]
+                audio = torch.stack([torch.nn.functional.pad(a, (0, max(lengths) - len(a))) for a in audios])
+                actual = get_content(model, audio, "cpu", 44100, lengths=lengths)
+                for a, c, length in zip(audios, actual, get_content_lengths(model, lengths, 44100)):
+                    expected = get_content(model, a, "cpu", 44100)[0]
+                    self.assertEqual(expected.shape[-1], length)
+                    torch.testing.assert_close(c[:, :length], expected, rtol=1e-5, atol=1e-5)
+
+
+class TestWindowedContent(TestCase):
+    def test_windowed(self):
+        from transformers import HubertConfig
+
+        from so_vits_svc_fork.utils import (
+            HubertModelWithFinalProj,
+            get_content,
+            get_content_lengths,
+        )
+
+        torch.manual_seed(0)
+        config = HubertConfig(
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=128,
+            conv_dim=(32,) * 7,
+            num_conv_pos_embeddings=16,
+        )
+        model = HubertModelWithFinalProj(config).eval()
+        for sr, length in [(16000, 16000 * 5 + 123), (16000, 16000 * 12), (44100, 44100 * 3)]:
+            with self.subTest(sr=sr, length=length):
+                audio = torch.randn(2, length)
+                expected = get_content(model, audio, "cpu", sr, window_seconds=0)
+                actual = get_content(model, audio, "cpu", sr, window_seconds=1.5, overlap_seconds=0.5)
+                self.assertEqual(actual.shape[-1], get_content_lengths(model, [length], sr)[0])
+                self.assertEqual(actual.shape, expected.shape)
+                # the windows only differ by the context they see
+                self.assertLess(float((actual - expected).abs().mean() / expected.abs().mean()), 0.03)
+                torch.testing.assert_close(get_content(model, audio, "cpu", sr, window_seconds=60), expected)
+        # windows are opt-in, also for long inputs
+        with patch("so_vits_svc_fork.utils._get_content_windowed") as get_content_windowed:
+            get_content(model, torch.randn(16000 * 40), "cpu", 16000)
+        get_content_windowed.assert_not_called()
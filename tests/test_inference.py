@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+import itertools
+import json
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import SkipTest, TestCase
+from unittest.mock import patch
+
+import numpy as np
+import torch
+
+from .test_onnx import CONFIG_TEMPLATES, create_synthesizer
+
+
+def create_svc(tempdir: Path, template: str = "so-vits-svc-4.0v1.json", type_: str = "hifi-gan", **svc_kwargs):
+    """Svc of a small SynthesizerTrn with random weights and a small random HuBERT, without downloading anything."""
+    from transformers import HubertConfig
+
+    from so_vits_svc_fork.inference.core import Svc
+    from so_vits_svc_fork.utils import HubertModelWithFinalProj
+
+    torch.manual_seed(0)
+    model_overrides = {"ssl_dim": 64}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        net_g, _ = create_synthesizer(template, type_, remove_weight_norm=False, **model_overrides)
+    config = json.loads((CONFIG_TEMPLATES / template).read_text())
+    config["model"].update(
+        type_=type_,
+        n_speakers=2,
+        hidden_channels=32,
+        inter_channels=32,
+        filter_channels=64,
+        upsample_initial_channel=64,
+        **model_overrides,
+    )
+    config["spk"] = {"a": 0, "b": 1}
+    config_path = tempdir / "config.json"
+    config_path.write_text(json.dumps(config))
+    net_g_path = tempdir / "G_0.pth"
+    torch.save({"model": net_g.state_dict(), "iteration": 0, "learning_rate": 0, "optimizer": None}, net_g_path)
+
+    hubert_config = HubertConfig(hidden_size=64, num_hidden_layers=2, num_attention_heads=4, intermediate_size=128, conv_dim=(32,) * 7)
+    hubert_model = HubertModelWithFinalProj(hubert_config).eval()
+    with patch("so_vits_svc_fork.utils.get_hubert_model", return_value=hubert_model), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        svc_model = Svc(net_g_path=net_g_path, config_path=config_path, device="cpu", **svc_kwargs)
+    if not svc_model.net_g.mb:
+        # the noise of the source depends on the batch
+        svc_model.net_g.dec.m_source.l_sin_gen.noise_std = 0
+    return svc_model
+
+
+def create_speech(sr: int = 44100, seed: int = 0) -> np.ndarray:
+    """Voiced segments of different lengths separated by silence."""
+    rng = np.random.default_rng(seed)
+    audio = []
+    for seconds, f0 in [(0.3, 0), (0.8, 180), (1, 0), (0.6, 220), (1, 0), (1.1, 150), (0.2, 0)]:
+        t = np.arange(int(sr * seconds)) / sr
+        if f0 == 0:
+            audio.append(np.zeros_like(t))
+        else:
+            f0_t = f0 * (1 + 0.05 * np.sin(2 * np.pi * 3 * t))
+            phase = 2 * np.pi * np.cumsum(f0_t) / sr
+            audio.append(sum(np.sin(k * phase) / k for k in range(1, 6)) * 0.3 + rng.normal(scale=0.01, size=len(t)))
+    return np.concatenate(audio).astype(np.float32)
+
+
+@contextmanager
+def framed_content(hop_size: int):
+    """Replace utils.get_content by a fake that returns the audio itself, hop_size samples per frame."""
+
+    def get_content(cmodel, audio, device, sr, *args, **kwargs):
+        audio = torch.as_tensor(audio)
+        if audio.ndim == 1:
+            audio = audio.unsqueeze(0)
+        n_frames = audio.shape[-1] // hop_size + 1
+        audio = torch.nn.functional.pad(audio, (0, n_frames * hop_size - audio.shape[-1]))
+        return audio.reshape(audio.shape[0], n_frames, hop_size).transpose(1, 2)
+
+    def get_content_lengths(cmodel, audio_lengths, sr):
+        return [length // hop_size + 1 for length in audio_lengths]
+
+    with patch("so_vits_svc_fork.utils.get_content", get_content), patch("so_vits_svc_fork.utils.get_content_lengths", get_content_lengths):
+        yield
+
+
+def echo_features(speaker_id, c, f0, uv, lengths=None, **kwargs):
+    """A fake Svc.infer_features that decodes the content of framed_content back to the audio."""
+    return c.transpose(1, 2).reshape(c.shape[0], -1)
+
+
+@contextmanager
+def fixed_noise(svc_model):
+    """Replace the random noise of the encoder and the random initial phases of the sines by constants."""
+    sine_gen = svc_model.net_g.dec.m_source.l_sin_gen
+
+    def initial_phase(batch_size, device=None):
+        return (torch.arange(sine_gen.dim, device=device) / sine_gen.dim).repeat(batch_size, 1)
+
+    with patch("torch.randn_like", lambda x, **kwargs: torch.full_like(x, 0.5)), patch.object(sine_gen, "initial_phase", initial_phase):
+        yield
+
+
+def infer_silence(svc_model, audio: np.ndarray, seed: int = 0, **kwargs) -> np.ndarray:
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        return svc_model.infer_silence(audio, speaker="a", noise_scale=0, **kwargs)
+
+
+class TestInference(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tempdir = TemporaryDirectory()
+        cls.svc_model = create_svc(Path(cls.tempdir.name))
+        cls.audio = create_speech(cls.svc_model.target_sample)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.tempdir.cleanup()
+
+    def test_bucket_by_length(self):
+        from so_vits_svc_fork.inference.core import _bucket_by_length
+
+        rng = np.random.default_rng(0)
+        lengths = {i: int(length) for i, length in enumerate(rng.integers(100, 1000, 50))}
+        for batch_size, sort in itertools.product([1, 2, 3, 8], [True, False]):
+            buckets = _bucket_by_length(lengths, batch_size, sort=sort)
+            keys = [key for bucket in buckets for key in bucket]
+            if sort:
+                self.assertEqual(sorted(keys), sorted(lengths))
+            else:
+                # consecutive keys, so that the phases can be continued through the predicted f0 of the chunks
+                self.assertEqual(keys, list(lengths))
+            for bucket in buckets:
+                self.assertLessEqual(len(bucket), batch_size)
+                self.assertLessEqual(max(lengths[k] for k in bucket), min(lengths[k] for k in bucket) * 1.5)
+
+    def test_infer_silence_batch(self):
+        for auto_predict_f0 in [False, True]:
+            # HuBERT draws from the torch RNG, so the random initial phase would depend on the buckets
+            with fixed_noise(self.svc_model):
+                expected = infer_silence(self.svc_model, self.audio, batch_size=1, auto_predict_f0=auto_predict_f0)
+            self.assertEqual(expected.shape, self.audio.shape)
+            self.assertGreater(np.abs(expected).max(), 0)
+            for batch_size in [2, 4]:
+                with self.subTest(auto_predict_f0=auto_predict_f0, batch_size=batch_size), fixed_noise(self.svc_model):
+                    actual = infer_silence(self.svc_model, self.audio, batch_size=batch_size, auto_predict_f0=auto_predict_f0)
+                    self.assertEqual(actual.shape, self.audio.shape)
+                    np.testing.assert_allclose(actual, expected, atol=1e-4)
+
+    def test_infer_silence_phase(self):
+        svc_model = self.svc_model
+        sr, hop = svc_model.target_sample, svc_model.hop_size
+        pad_len = int(sr * 0.5)
+        chunks = [chunk for chunk in svc_model._split_silence(self.audio, -40, 0.5, False, 40) if chunk.is_speech]
+        frame_ranges = svc_model._get_frame_ranges(chunks, pad_len, len(self.audio) // hop)
+        dec = svc_model.net_g.dec
+        forward = dec.forward
+        calls = []
+
+        def forward_spy(x, f0, g=None, phase=None, g_cond=None):
+            calls.append((f0, phase(f0) if callable(phase) else phase))
+            return forward(x, f0, g=g, phase=calls[-1][1], g_cond=g_cond)
+
+        for auto_predict_f0, whole_file_features in itertools.product([False, True], [False, True]):
+            with self.subTest(auto_predict_f0=auto_predict_f0, whole_file_features=whole_file_features), patch.object(dec, "forward", forward_spy):
+                calls.clear()
+                # one chunk per call, in time order
+                infer_silence(svc_model, self.audio, auto_predict_f0=auto_predict_f0, whole_file_features=whole_file_features)
+                self.assertEqual(len(calls), len(chunks))
+                for k in range(1, len(chunks)):
+                    if whole_file_features:
+                        decode_starts = [frame_ranges[k - 1][0] * hop, frame_ranges[k][0] * hop]
+                    else:
+                        decode_starts = [chunks[k - 1].start - pad_len, chunks[k].start - pad_len]
+                    # the sines of each chunk continue those of the previous one where it starts
+                    (last_f0, last_phase), (f0, phase) = calls[k - 1], calls[k]
+                    self.assertIsNotNone(phase)
+                    expected = svc_model.advance_phase(last_f0, last_phase, chunks[k].start - decode_starts[0])
+                    actual = svc_model.advance_phase(f0, phase, chunks[k].start - decode_starts[1])
+                    difference = (actual - expected + 0.5) % 1 - 0.5
+                    torch.testing.assert_close(difference, torch.zeros_like(difference), rtol=0, atol=1e-4)
+
+    def test_get_unit_f0_batch(self):
+        sr = self.svc_model.target_sample
+        audios = [self.audio[: sr // 2], self.audio[sr // 2 : sr], self.audio[: int(sr * 0.7)]]
+        c, f0, uv, lengths = self.svc_model.get_unit_f0_batch(audios, 0, 0, "a", "dio")
+        for j, audio in enumerate(audios):
+            c_single, f0_single, uv_single = self.svc_model.get_unit_f0(audio, 0, 0, "a", "dio")
+            length = int(lengths[j])
+            self.assertEqual(length, f0_single.shape[1])
+            torch.testing.assert_close(c[j, :, :length], c_single[0], atol=1e-5, rtol=1e-5)
+            torch.testing.assert_close(f0[j, :length], f0_single[0])
+            torch.testing.assert_close(uv[j, :length], uv_single[0])
+
+    def test_infer_silence_alignment(self):
+        # speech until the end, which is not a multiple of hop_size
+        hop = self.svc_model.hop_size
+        audio = self.audio[: -int(self.svc_model.target_sample * 0.2) - hop // 3]
+        chunks = self.svc_model._split_silence(audio, -40, 0.5, False, 40)
+        self.assertGreater(sum(chunk.is_speech for chunk in chunks), 2)
+        # the first frame range is clamped at 0 and the last one at the end of the audio
+        frame_ranges = self.svc_model._get_frame_ranges(chunks, int(self.svc_model.target_sample * 0.5), len(audio) // hop)
+        self.assertEqual(min(start for start, _ in frame_ranges.values()), 0)
+        self.assertEqual(max(end for _, end in frame_ranges.values()), len(audio) // hop)
+
+        speech = np.zeros(len(audio), dtype=bool)
+        for chunk in chunks:
+            speech[chunk.start : chunk.end] = chunk.is_speech
+        with framed_content(hop), patch.object(self.svc_model, "infer_features", echo_features):
+            for whole_file_features in [False, True]:
+                for batch_size in [1, 2]:
+                    with self.subTest(whole_file_features=whole_file_features, batch_size=batch_size):
+                        actual = infer_silence(self.svc_model, audio, batch_size=batch_size, whole_file_features=whole_file_features)
+                        self.assertEqual(actual.shape, audio.shape)
+                        expected = np.where(speech, audio, 0)
+                        if whole_file_features:
+                            # the samples after the last frame are padded with zeros
+                            n_decoded = len(audio) // hop * hop
+                            np.testing.assert_array_equal(actual[n_decoded:], 0)
+                            expected[n_decoded:] = 0
+                        np.testing.assert_array_equal(actual, expected)
+
+    def test_infer_silence_whole_file_features(self):
+        padded = infer_silence(self.svc_model, self.audio, batch_size=2)
+        whole_file = infer_silence(self.svc_model, self.audio, batch_size=2, whole_file_features=True)
+        self.assertEqual(whole_file.shape, padded.shape)
+        # the same chunks are decoded, except the samples after the last frame of the whole file
+        hop = self.svc_model.hop_size
+        n_frames = len(padded) // hop
+        np.testing.assert_array_equal(whole_file[: n_frames * hop] != 0, padded[: n_frames * hop] != 0)
+        # and aligned: the envelopes correlate best without lag
+        envelopes = [np.abs(a[: n_frames * hop]).reshape(n_frames, hop).mean(axis=1) for a in (padded, whole_file)]
+        envelopes = [e - e.mean() for e in envelopes]
+        correlation = np.correlate(envelopes[0], envelopes[1], mode="full")
+        self.assertEqual(np.argmax(correlation) - (n_frames - 1), 0)
+
+    def test_infer_silence_onnx(self):
+        try:
+            import onnx  # noqa
+            import onnxruntime  # noqa
+        except ImportError:
+            raise SkipTest("onnx and onnxruntime are required")
+        from so_vits_svc_fork.inference.core import Svc
+        from so_vits_svc_fork.modules.onnx import export_synthesizer
+
+        tempdir = Path(self.tempdir.name)
+        net_g_path = tempdir / "model.onnx"
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            export_synthesizer(self.svc_model.net_g, net_g_path, ssl_dim=self.svc_model.hps.model.ssl_dim)
+        with patch("so_vits_svc_fork.utils.get_hubert_model", return_value=self.svc_model.hubert_model):
+            onnx_model = Svc(net_g_path=net_g_path, config_path=tempdir / "config.json", device="cpu", backend="onnx")
+        for whole_file_features, batch_size in itertools.product([False, True], [1, 2]):
+            with self.subTest(whole_file_features=whole_file_features, batch_size=batch_size):
+                kwargs = dict(whole_file_features=whole_file_features, batch_size=batch_size)
+                expected = infer_silence(self.svc_model, self.audio, **kwargs)
+                actual = infer_silence(onnx_model, self.audio, **kwargs)
+                self.assertEqual(actual.shape, expected.shape)
+                self.assertEqual(actual.dtype, expected.dtype)
+                # the same chunks are decoded
+                np.testing.assert_array_equal(actual != 0, expected != 0)
+
+    def test_infer_sweep(self):
+        combinations = [("a", 0, 0.0), ("b", 0, 0.4), ("a", 5, 0.4), ("b", -3, 0.8)]
+        with fixed_noise(self.svc_model), torch.no_grad():
+            for auto_predict_f0, batch_size in [(False, None), (False, 3), (True, 3)]:
+                with self.subTest(auto_predict_f0=auto_predict_f0, batch_size=batch_size):
+                    audios = self.svc_model.infer_sweep(self.audio, combinations=combinations, batch_size=batch_size, auto_predict_f0=auto_predict_f0)
+                    self.assertEqual(len(audios), len(combinations))
+                    for (speaker, transpose, noise_scale), actual in zip(combinations, audios):
+                        expected = self.svc_model.infer_silence(
+                            self.audio,
+                            speaker=speaker,
+                            transpose=transpose,
+                            noise_scale=noise_scale,
+                            whole_file_features=True,
+                            auto_predict_f0=auto_predict_f0,
+                        )
+                        np.testing.assert_allclose(actual, expected, atol=1e-4)
+            # the combinations are rendered differently
+            self.assertGreater(min(np.abs(audios[k] - audios[0]).max() for k in range(1, len(combinations))), 1e-3)
+
+    def test_infer_silence_result(self):
+        # the result is the concatenation of the inferred speech chunks and the silence chunks as zeros
+        chunks = self.svc_model._split_silence(self.audio, -40, 0.5, False, 40)
+        self.assertTrue(any(chunk.is_speech for chunk in chunks) and not all(chunk.is_speech for chunk in chunks))
+        for whole_file_features in [False, True]:
+            with self.subTest(whole_file_features=whole_file_features):
+                name = "_infer_chunks_whole_file" if whole_file_features else "_infer_chunks_padded"
+                infer_chunks = getattr(self.svc_model, name)
+                audio_chunk_infers = {}
+
+                def infer_chunks_spy(*args, **kwargs):
+                    audio_chunk_infers.update(infer_chunks(*args, **kwargs))
+                    return audio_chunk_infers
+
+                with patch.object(self.svc_model, name, infer_chunks_spy):
+                    actual = infer_silence(self.svc_model, self.audio, batch_size=2, whole_file_features=whole_file_features)
+                expected = np.concatenate(
+                    [audio_chunk_infers[i] if chunk.is_speech else np.zeros_like(chunk.audio) for i, chunk in enumerate(chunks)]
+                )[: len(self.audio)]
+                self.assertEqual(actual.dtype, np.float32)
+                np.testing.assert_array_equal(actual, expected)
+
+    def test_realtime_vc2(self):
+        from so_vits_svc_fork.inference.core import RealtimeVC2
+
+        class ConcatenatingRealtimeVC2(RealtimeVC2):
+            """RealtimeVC2 which concatenates the input audio as before it was preallocated."""
+
+            def __init__(self, svc_model) -> None:
+                super().__init__(svc_model)
+                self._input_audio = np.zeros(0, dtype=np.float32)
+
+            @property
+            def input_audio_store(self):
+                return self._input_audio
+
+            def _append_input_audio(self, audio) -> None:
+                self._input_audio = np.concatenate([self._input_audio, audio])
+
+            def _keep_input_audio(self, audio) -> None:
+                self._input_audio = audio
+
+        sr = self.svc_model.target_sample
+        rng = np.random.default_rng(0)
+        audio = np.concatenate([self.audio, self.audio[::-1]])
+        block_ends = np.cumsum(rng.integers(sr // 10, sr // 2, len(audio) // (sr // 10)))
+        blocks = np.split(audio, block_ends[block_ends < len(audio)])
+        models = [RealtimeVC2(self.svc_model), ConcatenatingRealtimeVC2(self.svc_model)]
+        output_max = 0.0
+        for block in blocks:
+            outputs = []
+            for model in models:
+                torch.manual_seed(0)
+                with torch.no_grad():
+                    outputs.append(model.process(block, speaker="a", transpose=0, noise_scale=0))
+            self.assertEqual(len(outputs[0]), len(block))
+            np.testing.assert_array_equal(outputs[0], outputs[1])
+            np.testing.assert_array_equal(models[0].input_audio_store, models[1].input_audio_store)
+            output_max = max(output_max, np.abs(outputs[0]).max())
+        self.assertGreater(output_max, 0)
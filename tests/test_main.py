@@ -11,8 +11,7 @@ class TestMain(TestCase):
     def test_import(self):
         import so_vits_svc_fork.cluster.train_cluster
         import so_vits_svc_fork.inference.main
-
-        # import so_vits_svc_fork.modules.onnx._export
+        import so_vits_svc_fork.modules.onnx._export
         import so_vits_svc_fork.preprocessing.preprocess_flist_config
         import so_vits_svc_fork.preprocessing.preprocess_hubert_f0
         import so_vits_svc_fork.preprocessing.preprocess_resample
@@ -0,0 +1,90 @@
+import json
+import warnings
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import SkipTest, TestCase
+
+import numpy as np
+import torch
+
+CONFIG_TEMPLATES = Path(__file__).parents[1] / "src/so_vits_svc_fork/preprocessing/config_templates"
+
+
+def create_synthesizer(template: str, type_: str, remove_weight_norm: bool = True, **model_overrides):
+    from so_vits_svc_fork import utils
+    from so_vits_svc_fork.modules.synthesizers import SynthesizerTrn
+
+    config = json.loads((CONFIG_TEMPLATES / template).read_text())
+    model_config = {
+        **config["model"],
+        "type_": type_,
+        "n_speakers": 2,
+        "hidden_channels": 32,
+        "inter_channels": 32,
+        "filter_channels": 64,
+        "upsample_initial_channel": 64,
+        **model_overrides,
+    }
+    torch.manual_seed(0)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        net_g = SynthesizerTrn(
+            config["data"]["filter_length"] // 2 + 1,
+            config["train"]["segment_size"] // config["data"]["hop_length"],
+            **model_config,
+        ).eval()
+    if remove_weight_norm:
+        for m in net_g.modules():
+            utils.remove_weight_norm_if_exists(m)
+    return net_g, model_config["ssl_dim"]
+
+
+class TestOnnx(TestCase):
+    def setUp(self):
+        try:
+            import onnx  # noqa
+            import onnxruntime  # noqa
+        except ImportError:
+            raise SkipTest("onnx and onnxruntime are required")
+
+    def test_parity(self):
+        import onnxruntime
+
+        from so_vits_svc_fork.modules.onnx import export_synthesizer
+
+        for template, type_ in [
+            ("quickvc.json", "istft"),
+            ("quickvc.json", "ms-istft"),
+            ("quickvc.json", "mb-istft"),
+            ("so-vits-svc-4.0v1.json", "hifi-gan"),
+        ]:
+            with self.subTest(type_=type_), TemporaryDirectory() as tempdir:
+                net_g, ssl_dim = create_synthesizer(template, type_)
+                path = Path(tempdir) / "model.onnx"
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    export_synthesizer(net_g, path, ssl_dim=ssl_dim)
+                session = onnxruntime.InferenceSession(path.as_posix(), providers=["CPUExecutionProvider"])
+                for n_frames in [37, 150]:
+                    inputs = {
+                        "c": torch.randn(2, ssl_dim, n_frames),
+                        "f0": torch.rand(2, n_frames) * 300 + 100,
+                        "uv": (torch.rand(2, n_frames) > 0.2).float(),
+                        "sid": torch.tensor([[0], [1]]),
+                        "noise_scale": torch.zeros(2, 1, 1),
+                        "c_lengths": torch.tensor([n_frames, n_frames - 5]),
+                    }
+                    with torch.no_grad():
+                        expected = net_g.infer(
+                            inputs["c"],
+                            f0=inputs["f0"],
+                            uv=inputs["uv"],
+                            g=inputs["sid"],
+                            noice_scale=inputs["noise_scale"],
+                            c_lengths=inputs["c_lengths"],
+                        )[:, 0].numpy()
+                    (actual,) = session.run(None, {k: v.numpy() for k, v in inputs.items()})
+                    self.assertEqual(actual.shape, expected.shape)
+                    # the NSF source of hifi-gan draws random phases and noise
+                    atol = 5e-3 if type_ == "hifi-gan" else 1e-5
+                    np.testing.assert_allclose(actual, expected, atol=atol)
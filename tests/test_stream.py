@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+import torch
+
+from .test_inference import create_speech, create_svc, framed_content
+
+
+class TestStream(TestCase):
+    def test_ring_buffer(self):
+        from so_vits_svc_fork.inference.stream import RingBuffer
+
+        buffer = RingBuffer(10)
+        data = np.arange(100, dtype=np.float32)
+        out = np.zeros(4, dtype=np.float32)
+        pos = 0
+        for _ in range(20):
+            self.assertTrue(buffer.write(data[pos : pos + 4]))
+            buffer.read_into(out)
+            np.testing.assert_array_equal(out, data[pos : pos + 4])
+            pos += 4
+        self.assertTrue(buffer.write(data[:10]))
+        self.assertFalse(buffer.write(data[:1]))
+        buffer.skip(3)
+        buffer.read_into(out, pos=buffer.read_pos + 2)
+        np.testing.assert_array_equal(out, data[5:9])
+        self.assertEqual(len(buffer), 1)
+        with self.assertRaises(ValueError):
+            buffer.read_into(out)
+
+    def test_engine(self):
+        from so_vits_svc_fork.inference.stream import RealtimeEngine
+
+        block_size = 16
+        audio = np.random.default_rng(0).normal(size=block_size * 20).astype(np.float32)
+        for fallback in ["silence", "passthrough"]:
+            with self.subTest(fallback=fallback):
+                engine = RealtimeEngine(lambda x: -x, block_size, max_queue_blocks=3, fallback=fallback)
+                output = np.zeros_like(audio)
+                for i in range(0, len(audio), block_size):
+                    engine.callback(audio[i : i + block_size], output[i : i + block_size])
+                    # the worker is late for blocks 5 and 6
+                    if i // block_size not in (5, 6):
+                        engine.process_pending()
+                # the output is the processed input one block later, except for the late blocks
+                expected = np.concatenate([np.zeros(block_size, dtype=np.float32), -audio[:-block_size]])
+                for late in [slice(0, block_size), slice(6 * block_size, 8 * block_size)]:
+                    expected[late] = audio[late] if fallback == "passthrough" else 0
+                np.testing.assert_array_equal(output, expected)
+                self.assertEqual((engine.stats.underruns, engine.stats.late_blocks, engine.stats.overruns), (2, 2, 0))
+
+        # the worker skips blocks when it is too far behind
+        engine = RealtimeEngine(lambda x: x, block_size, max_queue_blocks=2)
+        output = np.zeros(block_size, dtype=np.float32)
+        for i in range(4):
+            engine.callback(audio[i * block_size : (i + 1) * block_size], output)
+        self.assertEqual(engine.process_pending(), 2)
+        self.assertEqual(engine.stats.overruns, 2)
+        engine.callback(audio[4 * block_size : 5 * block_size], output)
+        np.testing.assert_array_equal(output, audio[3 * block_size : 4 * block_size])
+
+    def test_engine_thread(self):
+        from so_vits_svc_fork.inference.stream import RealtimeEngine
+
+        block_size = 64
+
+        def process(x):
+            time.sleep(0.002)
+            return x * 2
+
+        audio = np.random.default_rng(0).normal(size=block_size * 10).astype(np.float32)
+        output = np.zeros_like(audio)
+        with RealtimeEngine(process, block_size, latency=2 * block_size) as engine:
+            for i in range(0, len(audio), block_size):
+                engine.callback(audio[i : i + block_size], output[i : i + block_size])
+                # the callback returns at once, the block is processed while the next one is captured
+                time.sleep(0.02)
+        np.testing.assert_array_equal(output[2 * block_size :], audio[: -2 * block_size] * 2)
+        self.assertEqual(engine.stats.underruns, 0)
+        self.assertEqual(engine.stats.n_blocks, 10)
+
+    def test_simulate_realtime(self):
+        from so_vits_svc_fork.inference.core import Crossfader
+        from so_vits_svc_fork.inference.stream import RealtimeEngine, simulate_realtime
+
+        sr = 1000
+        audio = np.sin(np.arange(5 * sr) * 0.05).astype(np.float32)
+        # the output of the crossfader without inference is its input delayed by its latency
+        model = Crossfader(additional_infer_before_len=50, additional_infer_after_len=20, crossfade_len=10, sola_search_len=8)
+        simulation = simulate_realtime(RealtimeEngine(model.process, 100), audio, sr, model_latency=model.latency)
+        np.testing.assert_array_equal(simulation.output, audio)
+        self.assertAlmostEqual(simulation.latency_seconds, 0.138)
+        self.assertEqual(simulation.missed_deadlines, 0)
+        self.assertEqual(simulation.report()["n_blocks"], len(simulation.process_times))
+
+        # processing slower than realtime misses deadlines and falls behind
+        def process(x):
+            time.sleep(0.2)
+            return x
+
+        simulation = simulate_realtime(RealtimeEngine(process, 100), audio[:sr], sr)
+        self.assertGreater(simulation.rtf, 1)
+        self.assertGreater(simulation.missed_deadlines, 0)
+        self.assertGreater(simulation.stats.overruns, 0)
+
+    def test_sola_shift(self):
+        import torch
+
+        from so_vits_svc_fork.inference.core import _sola_scores_direct, get_sola_shift
+
+        rng = np.random.default_rng(0)
+        for crossfade_len, sola_search_len in [(64, 32), (441, 384), (2205, 2048)]:
+            t = np.arange(sola_search_len + 2 * crossfade_len)
+            signals = {
+                "noise": rng.normal(size=len(t)),
+                "sine": np.sin(t * 0.03) + rng.normal(scale=0.01, size=len(t)),
+                "silence": np.zeros(len(t)),
+            }
+            for name, signal in signals.items():
+                with self.subTest(crossfade_len=crossfade_len, signal=name):
+                    signal = signal.astype(np.float32)
+                    first_tail, second_window = signal[:crossfade_len], signal[crossfade_len - 7 :][: sola_search_len + crossfade_len]
+                    expected = int(np.argmax(_sola_scores_direct(first_tail, second_window)))
+                    self.assertEqual(get_sola_shift(first_tail, second_window), expected)
+                    self.assertEqual(get_sola_shift(torch.from_numpy(first_tail), torch.from_numpy(second_window)), expected)
+
+    def test_incremental_features(self):
+        from types import SimpleNamespace
+
+        import torch
+        from transformers import HubertConfig
+
+        from so_vits_svc_fork.f0 import compute_f0, interpolate_f0
+        from so_vits_svc_fork.inference.core import IncrementalFeatures
+        from so_vits_svc_fork.utils import HubertModelWithFinalProj
+
+        torch.manual_seed(0)
+        config = HubertConfig(hidden_size=64, num_hidden_layers=2, num_attention_heads=4, intermediate_size=128, conv_dim=(32,) * 7)
+        sr, hop = 44100, 512
+        svc_model = SimpleNamespace(
+            hubert_model=HubertModelWithFinalProj(config).eval(),
+            target_sample=sr,
+            hop_size=hop,
+            device=torch.device("cpu"),
+            dtype=torch.float32,
+            contentvec_final_proj=False,
+            content_window_seconds=None,
+            content_overlap_seconds=3,
+        )
+        features = IncrementalFeatures(svc_model, context_seconds=0.1, margin_seconds=0.05)
+        t = np.arange(4 * sr) / sr
+        stream = (0.5 * np.sin(2 * np.pi * (200 + 50 * t) * t)).astype(np.float32)
+        expected_f0, _ = interpolate_f0(compute_f0(stream, sampling_rate=sr, hop_length=hop))
+
+        block_size, window_size = 11025, 44100
+        for end in range(block_size, len(stream) + 1, block_size):
+            start = end - window_size
+            window = np.concatenate([np.zeros(max(-start, 0), dtype=np.float32), stream[max(start, 0) : end]])
+            c, f0, uv, offset = features.update(window, end)
+            self.assertEqual((c.shape[1], len(f0), len(uv)), (-(-end // hop) - start // hop,) * 3)
+            self.assertEqual(offset, start % hop)
+            if end > window_size:
+                # only the new frames and the margins are computed
+                self.assertLessEqual(features.n_computed_frames, block_size // hop + 1 + features.context_frames + features.margin_frames)
+                self.assertLess(features.n_computed_frames, window_size // hop / 2)
+                # f0 away from the edges of the computed segments matches f0 of the whole stream
+                frames = slice(start // hop + 10, end // hop - 10)
+                np.testing.assert_allclose(f0[10:-11].numpy(), expected_f0[frames], rtol=0.02)
+
+
+class EchoStream:
+    """A fake NSFHifiGANStream that returns the frames of framed_content as audio, latency samples late."""
+
+    def __init__(self, latency: int) -> None:
+        self.latency = latency
+        self.reset()
+
+    def reset(self) -> None:
+        self._pending = torch.zeros(1, 1, 0)
+
+    def __call__(self, x, f0, g, g_cond=None):
+        self._pending = torch.cat([self._pending, x.transpose(1, 2).reshape(1, 1, -1)], dim=-1)
+        n_output = self._pending.shape[-1] - self.latency
+        output, self._pending = self._pending[..., :n_output], self._pending[..., n_output:]
+        return output
+
+
+class TestRealtimeVC3(TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tempdir = TemporaryDirectory()
+        cls.svc_model = create_svc(Path(cls.tempdir.name))
+        audio = create_speech(cls.svc_model.target_sample)
+        # uneven blocks, some shorter than a frame
+        rng = np.random.default_rng(0)
+        block_ends = np.cumsum(rng.integers(100, 6000, len(audio) // 100))
+        cls.blocks = np.split(audio, block_ends[block_ends < len(audio)])
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.tempdir.cleanup()
+
+    def process(self, model) -> np.ndarray:
+        outputs = []
+        for block in self.blocks:
+            with torch.no_grad():
+                output = model.process(block, speaker="a", transpose=0, noise_scale=0)
+            self.assertEqual(output.shape, block.shape)
+            outputs.append(output)
+        return np.concatenate(outputs)
+
+    def test_latency(self):
+        from so_vits_svc_fork.inference.core import RealtimeVC3
+
+        model = RealtimeVC3(self.svc_model)
+        hop = self.svc_model.hop_size
+        output = self.process(model)
+        audio = np.concatenate(self.blocks)
+        # the decoded stream starts after latency samples and covers the frames with their lookahead
+        self.assertEqual(model.next_frame, len(audio) // hop - model.lookahead_frames)
+        self.assertEqual(len(output) + len(model._output), model.latency + model.next_frame * hop - model.decoder.latency)
+        self.assertEqual(np.flatnonzero(output)[0], model.latency)
+
+        # with a decoder returning its input frames, the output is the input delayed by latency
+        model = RealtimeVC3(self.svc_model)
+        model.decoder = EchoStream(model.decoder.latency)
+
+        def infer_latent(c, f0, uv, **kwargs):
+            return c, f0, None
+
+        with framed_content(hop), patch.object(self.svc_model.net_g, "infer_latent", infer_latent):
+            output = self.process(model)
+        np.testing.assert_array_equal(output[: model.latency], 0)
+        np.testing.assert_array_equal(output[model.latency :], audio[: len(audio) - model.latency])